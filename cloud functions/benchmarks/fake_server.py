@@ -0,0 +1,326 @@
+"""
+Local stand-in for the Tahoe and Shopify APIs the functions call, so they
+can be benchmarked offline and reproducibly.
+
+Tahoe sites are served under /sites/<name>, every site has `courses`
+courses served `page_size` per page. Shopify admin API is served under
+/admin/api/<version>, REST calls go through a leaky bucket of
+`bucket_size` calls leaking `leak_rate` calls per second and a full bucket
+answers 429 with Retry-After like Shopify does. Every response waits `latency` seconds first.
+"""
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+shopify_api_version = "2020-01"
+
+
+def course_id(site, number):
+    return "course-v1:{}+course{}+2020".format(site, number)
+
+
+class FakeStore:
+    """Products and variants of the fake Shopify store"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.products = {}
+        self.next_id = 1
+
+    def add_product(self, title, sku, tags):
+        with self.lock:
+            product_id, variant_id = self.next_id, self.next_id + 1
+            self.next_id += 2
+            self.products[product_id] = {
+                "id": product_id,
+                "title": title,
+                "tags": tags,
+                "published_at": None,
+                "variants": [
+                    {"id": variant_id, "product_id": product_id, "sku": sku}
+                ],
+            }
+            return self.products[product_id]
+
+    def variants(self):
+        with self.lock:
+            return [
+                variant
+                for product in self.products.values()
+                for variant in product["variants"]
+            ]
+
+
+class FakeServer:
+    """
+    Fake Tahoe sites and Shopify store served from a background thread.
+    `url` is the server root, `site_url(name)` the root of a Tahoe site and
+    `shopify_url` the Shopify admin API to give to shopify.ShopifyResource.
+    """
+
+    def __init__(self, sites=("site-a",), courses=100, page_size=20,
+                 latency=0.0, bucket_size=40, leak_rate=2.0):
+        self.sites = list(sites)
+        self.courses = courses
+        self.page_size = page_size
+        self.latency = latency
+        self.bucket_size = bucket_size
+        self.leak_rate = leak_rate
+        self.lock = threading.Lock()
+        self.bucket = 0.0
+        self.bucket_updated = time.monotonic()
+        self.store = FakeStore()
+        self.users = set()
+        self.stats = {"requests": 0, "throttled": 0}
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    @property
+    def shopify_url(self):
+        return "{}/admin/api/{}".format(self.url, shopify_api_version)
+
+    def site_url(self, site):
+        return "{}/sites/{}".format(self.url, site)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.store = FakeStore()
+            self.users = set()
+            self.bucket = 0.0
+
+    def courses_page(self, site, page):
+        pages = max(1, -(-self.courses // self.page_size))
+        first = (page - 1) * self.page_size
+        results = [
+            {
+                "course_id": course_id(site, number),
+                "name": "Course {}".format(number),
+                "short_description": "Course {} of {}".format(number, site),
+                "media": {"image": {"large": ""}},
+            }
+            for number in range(first, min(first + self.page_size, self.courses))
+        ]
+        next_url = None
+        if page < pages:
+            next_url = "{}/api/courses/v1/courses/?page={}".format(
+                self.site_url(site), page + 1
+            )
+        return {
+            "results": results,
+            "pagination": {
+                "next": next_url, "count": self.courses, "num_pages": pages
+            },
+        }
+
+    def take_call(self):
+        """Count a Shopify call in the bucket, return False when it's full"""
+        with self.lock:
+            now = time.monotonic()
+            leaked = (now - self.bucket_updated) * self.leak_rate
+            self.bucket = max(0.0, self.bucket - leaked)
+            self.bucket_updated = now
+            if self.bucket + 1 > self.bucket_size:
+                self.stats["throttled"] += 1
+                return False
+            self.bucket += 1
+            return True
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    tahoe_path = re.compile(r"^/sites/([^/]+)(/.*)$")
+    course_id_pattern = re.compile(r"^course-v1:(.+)\+course(\d+)\+2020$")
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if "json" in (self.headers.get("Content-Type") or ""):
+            return json.loads(body or b"{}")
+        return {
+            key: values if len(values) > 1 or key == "identifiers" else values[0]
+            for key, values in parse_qs(body.decode("utf-8")).items()
+        }
+
+    def do_GET(self):
+        self.handle_call("GET")
+
+    def do_POST(self):
+        self.handle_call("POST")
+
+    def do_PUT(self):
+        self.handle_call("PUT")
+
+    def handle_call(self, method):
+        fake = self.fake
+        with fake.lock:
+            fake.stats["requests"] += 1
+        if fake.latency:
+            time.sleep(fake.latency)
+        parts = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        tahoe = self.tahoe_path.match(parts.path)
+        if tahoe:
+            return self.tahoe(method, tahoe.group(1), tahoe.group(2), query)
+        prefix = "/admin/api/{}".format(shopify_api_version)
+        if parts.path.startswith(prefix):
+            return self.shopify(method, parts.path[len(prefix):], query)
+        if parts.path.startswith("/functions/"):
+            self.read_body()
+            return self.send_json(200, {})
+        self.send_json(404, {"errors": "Not Found"})
+
+    # Tahoe
+    def tahoe(self, method, site, path, query):
+        fake = self.fake
+        if site not in fake.sites:
+            return self.send_json(404, {"detail": "Not found."})
+        if path == "/api/courses/v1/courses/":
+            return self.send_json(
+                200, fake.courses_page(site, int(query.get("page", 1)))
+            )
+        if path.startswith("/api/courses/v1/courses/"):
+            requested = unquote(path[len("/api/courses/v1/courses/"):].strip("/"))
+            match = self.course_id_pattern.match(requested)
+            exists = bool(match) and match.group(1) == site and int(
+                match.group(2)
+            ) < fake.courses
+            return self.send_json(200 if exists else 404, {"course_id": requested})
+        if path == "/tahoe/api/v1/users/":
+            email = query.get("email", "").lower()
+            results = [{"email": email}] if (site, email) in fake.users else []
+            return self.send_json(200, {"results": results, "next": None})
+        if path == "/tahoe/api/v1/registrations/" and method == "POST":
+            email = self.read_body().get("email", "").lower()
+            with fake.lock:
+                if (site, email) in fake.users:
+                    return self.send_json(409, {"email": "already exists"})
+                fake.users.add((site, email))
+            return self.send_json(200, {"user_id": len(fake.users)})
+        if path == "/tahoe/api/v1/enrollments/" and method == "POST":
+            body = self.read_body()
+            courses = body.get("courses", [])
+            courses = [courses] if isinstance(courses, str) else courses
+            identifiers = body.get("identifiers", [])
+            return self.send_json(200, {
+                "action": "enroll",
+                "courses": {
+                    course: {
+                        "action": "enroll",
+                        "results": [
+                            {"identifier": identifier, "before": {}, "after": {}}
+                            for identifier in identifiers
+                        ],
+                    }
+                    for course in courses
+                },
+            })
+        self.send_json(404, {"detail": "Not found."})
+
+    # Shopify
+    def shopify(self, method, path, query):
+        fake = self.fake
+        # GraphQL is limited by query cost, not by the REST call bucket
+        if path != "/graphql.json" and not fake.take_call():
+            return self.send_json(
+                429, {"errors": "Exceeded 2 calls per second for api client."},
+                {"Retry-After": "1.0"},
+            )
+        headers = {
+            "X-Shopify-Shop-Api-Call-Limit": "{}/{}".format(
+                int(fake.bucket), fake.bucket_size
+            )
+        }
+        store = fake.store
+        if path == "/shop.json":
+            return self.send_json(200, {"shop": {
+                "id": 1, "name": "Store Admin", "shop_owner": "Store Admin",
+                "email": "admin@example.com",
+                "customer_email": "admin@example.com",
+            }}, headers)
+        if path == "/products.json" and method == "GET":
+            ids = [int(product_id) for product_id in query.get("ids", "").split(",") if product_id]
+            with store.lock:
+                products = [store.products[i] for i in ids if i in store.products]
+            return self.send_json(200, {"products": products}, headers)
+        if path == "/products.json" and method == "POST":
+            product = self.read_body()["product"]
+            created = store.add_product(
+                product.get("title"),
+                (product.get("variants") or [{}])[0].get("sku"),
+                product.get("tags", ""),
+            )
+            return self.send_json(201, {"product": created}, headers)
+        if path == "/variants.json":
+            variants = store.variants()
+            limit = int(query.get("limit", 50))
+            start = int(query.get("page_info", 0))
+            page = variants[start:start + limit]
+            if start + limit < len(variants):
+                headers["Link"] = '<{}/variants.json?limit={}&page_info={}>; rel="next"'.format(
+                    fake.shopify_url, limit, start + limit
+                )
+            return self.send_json(200, {"variants": page}, headers)
+        if path == "/graphql.json" and method == "POST":
+            return self.graphql(self.read_body(), headers)
+        self.send_json(404, {"errors": "Not Found"}, headers)
+
+    def graphql(self, body, headers):
+        """Answer the aliased productSet mutations of the product creator"""
+        data = {}
+        variables = body.get("variables") or {}
+        for alias in re.findall(r"(\w+): productSet\(input: \$(\w+)", body["query"]):
+            product_input = variables[alias[1]]
+            created = self.fake.store.add_product(
+                product_input["title"],
+                product_input["variants"][0]["inventoryItem"]["sku"],
+                ", ".join(product_input.get("tags", [])),
+            )
+            data[alias[0]] = {
+                "product": {
+                    "id": "gid://shopify/Product/{}".format(created["id"]),
+                    "variants": {"edges": [{"node": {
+                        "id": "gid://shopify/ProductVariant/{}".format(
+                            created["variants"][0]["id"]
+                        )
+                    }}]},
+                },
+                "userErrors": [],
+            }
+        self.send_json(200, {"data": data}, headers)
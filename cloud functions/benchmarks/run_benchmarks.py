@@ -0,0 +1,282 @@
+"""
+Benchmark the functions against the local fake Tahoe and Shopify server.
+
+    python run_benchmarks.py --courses 10,1000,10000,100000 --latency 0.02
+
+For every catalog size it reports throughput and p50/p99 latency of
+call_validator, the purchase listener, shopify_product_validator and the
+product creator. Nothing leaves the machine, so results are reproducible.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import importlib.util
+import json
+import logging
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+import flask
+
+from fake_server import FakeServer, course_id, shopify_api_version
+
+functions_dir = path.dirname(path.dirname(path.abspath(__file__)))
+functions_modules = {
+    "call_validator": "call validator and redirector",
+    "purchase_listener": "successful purchase listener",
+    "product_validator": "product validator",
+    "product_creator": "product creator",
+}
+shopify_store_url = "https://bench.myshopify.com"
+shopify_secret = "bench-secret"
+
+
+class JsonRequest:
+    """The part of a flask request the functions read"""
+
+    def __init__(self, payload, headers=None):
+        self.payload = payload
+        self.headers = headers or {}
+
+    def get_json(self, *args, **kwargs):
+        return self.payload
+
+    def get_data(self, *args, **kwargs):
+        return json.dumps(self.payload).encode("utf-8")
+
+
+def load_function(name):
+    """Import the functions.py of a function under its own module name"""
+    spec = importlib.util.spec_from_file_location(
+        name, path.join(functions_dir, functions_modules[name], "functions.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(latencies, fraction):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(calls, concurrency):
+    """
+    Run the calls with `concurrency` in flight, return their latencies, the
+    number of calls which raised and the elapsed time
+    """
+    def timed(call):
+        started = time.perf_counter()
+        try:
+            call()
+            failed = False
+        except Exception as e:
+            logging.error("Benchmark call failed: {!r}".format(e))
+            failed = True
+        return time.perf_counter() - started, failed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, calls))
+    latencies = [latency for latency, _ in results]
+    errors = sum(failed for _, failed in results)
+    return latencies, errors, time.perf_counter() - started
+
+
+def configure(module, fake, options):
+    module.environment = "bench"
+    module.shopify_store_url = shopify_store_url
+    module.shopify_store_admin_api = fake.shopify_url
+    if hasattr(module, "shopify_graphql_version"):
+        module.shopify_graphql_version = shopify_api_version
+    module.tahoe_courses_api = "/api/courses/v1/courses/"
+    module.tahoe_sites = [fake.site_url(site) for site in fake.sites]
+    if hasattr(module, "shopify_scheduler"):
+        module.shopify_scheduler = module.ShopifyScheduler(
+            options.shopify_bucket, options.shopify_leak_rate,
+            module.shopify_bucket_margin,
+        )
+        module.invalidate_store_admin()
+
+
+def bench_call_validator(module, fake, options, courses):
+    module.shopify_secret = shopify_secret
+    module.forward_queue = module.SQLiteForwardQueue(
+        tempfile.mktemp(suffix=".sqlite3")
+    )
+    module.webhook_dedup = module.WebhookDedup(3600, options.requests)
+    module.routes = module.load_routes([
+        {"topic": "orders/paid", "url": fake.url + "/functions/listener",
+         "filter": "financial_status == paid", "validate": "order"},
+    ])
+    app = flask.Flask(__name__)
+
+    def call(number):
+        body = json.dumps(paid_order(number, [course_id(fake.sites[0], 0)], [1])).encode()
+        digest = hmac.new(shopify_secret.encode(), body, hashlib.sha256).digest()
+        headers = {
+            "X-Shopify-Topic": "orders/paid",
+            "X-Shopify-Shop-Domain": shopify_store_url[len("https://"):],
+            "X-Shopify-Hmac-SHA256": base64.b64encode(digest).decode(),
+            "X-Shopify-Webhook-Id": "bench-{}-{}".format(courses, number),
+        }
+        with app.test_request_context(
+            method="POST", data=body, content_type="application/json",
+            headers=headers,
+        ):
+            module.call_validator(flask.request)
+
+    return [lambda number=number: call(number) for number in range(options.requests)]
+
+
+def paid_order(number, skus, product_ids):
+    return {
+        "id": number,
+        "email": "learner{}@example.com".format(number),
+        "confirmed": True,
+        "financial_status": "paid",
+        "billing_address": {"name": "Learner {}".format(number)},
+        "line_items": [
+            {"sku": sku, "product_id": product_id}
+            for sku, product_id in zip(skus, product_ids)
+        ],
+    }
+
+
+def bench_purchase_listener(module, fake, options, courses):
+    module.tahoe_registration_api = "/tahoe/api/v1/registrations/"
+    module.tahoe_enrollment_api = "/tahoe/api/v1/enrollments/"
+    module.tahoe_users_api = "/tahoe/api/v1/users/"
+    module.tahoe_sites_tokens = ",".join(
+        "{};token".format(fake.site_url(site)) for site in fake.sites
+    )
+    module.courses_cache = module.CoursesCache(900, 50)
+    module.users_cache.clear()
+    module.notification_outbox = module.NotificationOutbox(
+        module.MemoryTransport(), background=False
+    )
+    orders = []
+    for number in range(options.requests):
+        site = random.choice(fake.sites)
+        sku = course_id(site, random.randrange(courses))
+        product = fake.store.add_product(sku, sku, fake.site_url(site))
+        orders.append(JsonRequest(paid_order(number, [sku], [product["id"]])))
+    return [lambda order=order: module.main(order) for order in orders]
+
+
+def bench_product_validator(module, fake, options, courses):
+    module.courses_cache = module.CoursesCache(900, 50)
+    products = [
+        JsonRequest({
+            "id": number,
+            "variants": [{"sku": course_id(
+                random.choice(fake.sites), random.randrange(courses)
+            )}],
+        })
+        for number in range(options.requests)
+    ]
+    return [
+        lambda product=product: module.shopify_product_validator(product)
+        for product in products
+    ]
+
+
+def bench_product_creator(module, fake, options, courses):
+    module.sync_state_file = tempfile.mktemp(suffix=".json")
+
+    def create():
+        fake.reset()
+        module.main(None)
+
+    return [create for _ in range(options.creator_runs)]
+
+
+benchmarks = {
+    "call_validator": bench_call_validator,
+    "purchase_listener": bench_purchase_listener,
+    "product_validator": bench_product_validator,
+    "product_creator": bench_product_creator,
+}
+
+
+def run(options):
+    results = []
+    modules = {name: load_function(name) for name in options.functions}
+    logging.getLogger().setLevel(logging.WARNING)
+    for courses in options.courses:
+        sites = ["site-{}".format(chr(ord("a") + index)) for index in range(options.sites)]
+        fake = FakeServer(
+            sites=sites,
+            courses=max(1, courses // options.sites),
+            page_size=options.page_size,
+            latency=options.latency,
+            bucket_size=options.shopify_bucket,
+            leak_rate=options.shopify_leak_rate,
+        ).start()
+        try:
+            for name, module in modules.items():
+                configure(module, fake, options)
+                calls = benchmarks[name](module, fake, options, fake.courses)
+                concurrency = 1 if name == "product_creator" else options.concurrency
+                latencies, errors, elapsed = measure(calls, concurrency)
+                result = {
+                    "function": name,
+                    "courses": courses,
+                    "calls": len(calls),
+                    "errors": errors,
+                    "throughput": len(calls) / elapsed,
+                    "p50_ms": percentile(latencies, 0.5) * 1000,
+                    "p99_ms": percentile(latencies, 0.99) * 1000,
+                    "fake_requests": fake.stats["requests"],
+                    "throttled": fake.stats["throttled"],
+                }
+                fake.stats.update(requests=0, throttled=0)
+                results.append(result)
+                if not options.json:
+                    print(
+                        "{function:<18} {courses:>7} courses {calls:>5} calls "
+                        "{errors:>3} errors "
+                        "{throughput:>9.1f}/s p50 {p50_ms:>8.1f} ms "
+                        "p99 {p99_ms:>8.1f} ms {fake_requests:>6} API calls "
+                        "{throttled:>4} throttled".format(**result)
+                    )
+        finally:
+            fake.stop()
+    if options.json:
+        print(json.dumps(results, indent=2))
+    return results
+
+
+def parse_options(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--courses", default="10,1000,10000",
+        type=lambda value: [int(size) for size in value.split(",")],
+        help="comma separated catalog sizes, split over the sites",
+    )
+    parser.add_argument("--sites", type=int, default=2)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds every fake API response waits")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="webhooks sent to each webhook function")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--creator-runs", type=int, default=3)
+    parser.add_argument("--shopify-bucket", type=int, default=40)
+    parser.add_argument("--shopify-leak-rate", type=float, default=40.0,
+                        help="Shopify calls per second, 2 for a standard store")
+    parser.add_argument(
+        "--functions", default=",".join(benchmarks),
+        type=lambda value: value.split(","),
+    )
+    parser.add_argument("--json", action="store_true")
+    return parser.parse_args(arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run(parse_options()) else 1)
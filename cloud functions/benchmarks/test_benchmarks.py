@@ -0,0 +1,50 @@
+import time
+import unittest
+
+import requests
+
+import run_benchmarks
+from fake_server import FakeServer, course_id
+
+
+class FakeServerTests(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeServer(
+            courses=25, page_size=10, bucket_size=2, leak_rate=1
+        ).start()
+        self.site_url = self.fake.site_url("site-a")
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def test_courses_are_paginated(self):
+        url = self.site_url + "/api/courses/v1/courses/"
+        courses = []
+        while url:
+            page = requests.get(url).json()
+            courses += [course["course_id"] for course in page["results"]]
+            url = page["pagination"]["next"]
+        self.assertEqual(courses, [course_id("site-a", n) for n in range(25)])
+
+    def test_shopify_throttles_a_full_bucket(self):
+        url = self.fake.shopify_url + "/shop.json"
+        statuses = [requests.get(url).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        time.sleep(1)
+        self.assertEqual(requests.get(url).status_code, 200)
+
+
+class BenchmarkTests(unittest.TestCase):
+    def test_every_function_runs_offline(self):
+        results = run_benchmarks.run(run_benchmarks.parse_options([
+            "--courses", "10", "--requests", "5", "--creator-runs", "1",
+        ]))
+        self.assertEqual(
+            [result["function"] for result in results],
+            list(run_benchmarks.benchmarks),
+        )
+        self.assertTrue(all(result["errors"] == 0 for result in results))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,41 +1,1014 @@
+import atexit
 import hmac
 import hashlib
 import base64
+import binascii
+import json
 import logging
+import sqlite3
+import threading
+import time
+import functools
+import sys
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
 from hmac import digest
-from os import environ, stat
+from os import environ, replace, stat
+from urllib.parse import urlsplit
 from flask import Response
-from multiprocessing.dummy import Pool
-
-
-import requests
-from google.cloud import error_reporting
 
+# requests, google.cloud and the thread pools are imported on first use,
+# a cold start only loads what verifying and routing a webhook needs
 
 shopify_topics_handler = {
     "orders/paid": "https://us-central1-appsembler-tahoe-0.cloudfunctions.net/test_successful_purchase_listener",
     "products/create": "https://us-central1-appsembler-tahoe-0.cloudfunctions.net/test_shopify_product_validator",
     "products/update": "https://us-central1-appsembler-tahoe-0.cloudfunctions.net/test_shopify_product_validator"
 }
+# routing table as JSON, inline or in a file, see load_routes
+shopify_routes = environ.get("shopify_routes", "")
+shopify_routes_file = environ.get("shopify_routes_file", "")
+# comma separated in-process handlers the host registers after importing
+# this module, routes can target them before they are registered
+shopify_route_handlers = environ.get("shopify_route_handlers", "")
 shopify_secret = environ.get("shopify_secret", "")
+# comma separated secrets which are still accepted while rotating app secrets
+shopify_previous_secrets = environ.get("shopify_previous_secrets", "")
 shopify_store_url = environ.get("shopify_store_url", "")
 environment = environ.get("env", "")
+http_timeout = int(environ.get("http_timeout", "60"))
+http_pool_size = int(environ.get("http_pool_size", "10"))
+http_retries = int(environ.get("http_retries", "3"))
+http_backoff = float(environ.get("http_backoff", "0.5"))
+# sqlite, or module:factory of another queue called with the path and the
+# claim timeout
+forward_queue_backend = environ.get("forward_queue_backend", "sqlite")
+forward_queue_path = environ.get(
+    "forward_queue_path", "/tmp/call_validator_forwards.sqlite3"
+)
+forward_concurrency = int(environ.get("forward_concurrency", "4"))
+forward_max_attempts = int(environ.get("forward_max_attempts", "8"))
+forward_claim_timeout = int(environ.get("forward_claim_timeout", "120"))
+# dead letters are kept this many seconds, and at most this many of them
+forward_dead_letter_ttl = int(environ.get("forward_dead_letter_ttl", "604800"))
+forward_dead_letter_size = int(environ.get("forward_dead_letter_size", "1000"))
+webhook_dedup_ttl = int(environ.get("webhook_dedup_ttl", "86400"))
+webhook_dedup_size = int(environ.get("webhook_dedup_size", "10000"))
+webhook_dedup_path = environ.get("webhook_dedup_path", "")
+log_field_size = int(environ.get("log_field_size", "200"))
+metrics_service = "call_validator"
+# json, prometheus or opentelemetry, metrics are off without a sink
+metrics_sink = environ.get("metrics_sink", "")
+metrics_path = environ.get("metrics_path", "")
+metrics_export_interval = float(environ.get("metrics_export_interval", "60"))
+
+stackdriver_client = None
+
+
+class NullSpan:
+    """Span used while metrics are disabled, it records nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+
+null_span = NullSpan()
+
+
+class Span:
+    """Times a block of code and records it into `metrics` when it exits"""
+
+    __slots__ = ("metrics", "name", "labels", "started", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.metrics.record(
+            self.name, time.perf_counter() - self.start, self.labels,
+            error_type is not None, self.started,
+        )
+        return False
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the function's stages, exported to
+    `sink` at most every `export_interval` seconds. Without a sink nothing
+    is recorded and span() returns a shared no-op span, so instrumentation
+    only costs a check.
+    """
+
+    buckets = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+    )
+
+    def __init__(self, sink=None, export_interval=60):
+        self.sink = sink
+        self.export_interval = export_interval
+        self.exported_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def span(self, name, **labels):
+        if self.sink is None:
+            return null_span
+        return Span(self, name, labels)
+
+    def increment(self, name, value=1, **labels):
+        if self.sink is None:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def record(self, name, seconds, labels, error=False, started=None):
+        """Record a finished span of `seconds`"""
+        if self.sink is None:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": [0] * (len(self.buckets) + 1),
+                    "count": 0,
+                    "sum": 0.0,
+                }
+            histogram["buckets"][bisect_left(self.buckets, seconds)] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            if error:
+                errors_key = (name + "_errors", key[1])
+                self.counters[errors_key] = self.counters.get(errors_key, 0) + 1
+        self.sink.span(
+            name, started or time.time() - seconds, seconds, labels, error
+        )
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    dict(histogram, name=name, labels=dict(labels),
+                         buckets=list(histogram["buckets"]))
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            }
+
+    def export(self, force=True):
+        """Export to the sink, unless `export_interval` didn't pass yet"""
+        if self.sink is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.exported_at < self.export_interval:
+            return
+        self.exported_at = now
+        try:
+            self.sink.export(self)
+        except Exception as e:
+            logging.error("Metrics export failed: {}".format(e))
+
+
+class JsonSink:
+    """Writes spans and metrics as JSON lines, Cloud Logging parses them"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+    def span(self, name, started, seconds, labels, error):
+        self.write({
+            "type": "span", "service": metrics_service, "name": name,
+            "start": started, "duration_ms": round(seconds * 1000, 3),
+            "labels": labels, "error": error,
+        })
+
+    def export(self, metrics):
+        self.write(dict(metrics.snapshot(), type="metrics", service=metrics_service))
+
+
+def render_prometheus(metrics):
+    """Return the metrics in Prometheus text exposition format"""
+    def series(name, labels, extra=()):
+        pairs = sorted(labels.items()) + list(extra)
+        if not pairs:
+            return name
+        return "{}{{{}}}".format(name, ",".join(
+            '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for key, value in pairs
+        ))
+
+    snapshot = metrics.snapshot()
+    lines = []
+    for counter in snapshot["counters"]:
+        name = "{}_{}_total".format(metrics_service, counter["name"])
+        lines.append("# TYPE {} counter".format(name))
+        lines.append("{} {}".format(series(name, counter["labels"]), counter["value"]))
+    for histogram in snapshot["histograms"]:
+        name = "{}_{}_seconds".format(metrics_service, histogram["name"])
+        lines.append("# TYPE {} histogram".format(name))
+        cumulative = 0
+        bounds = [str(bound) for bound in metrics.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, histogram["buckets"]):
+            cumulative += count
+            lines.append("{} {}".format(
+                series(name + "_bucket", histogram["labels"], [("le", bound)]),
+                cumulative,
+            ))
+        lines.append("{} {}".format(
+            series(name + "_sum", histogram["labels"]), histogram["sum"]
+        ))
+        lines.append("{} {}".format(
+            series(name + "_count", histogram["labels"]), histogram["count"]
+        ))
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusSink:
+    """Writes the metrics in Prometheus text format to `path` on export"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def span(self, name, started, seconds, labels, error):
+        pass
+
+    def export(self, metrics):
+        with open(self.path + ".tmp", "w") as metrics_file:
+            metrics_file.write(render_prometheus(metrics))
+        replace(self.path + ".tmp", self.path)
+
+
+class OpenTelemetrySink:
+    """
+    Sends spans and their durations to the OpenTelemetry API. It needs the
+    opentelemetry-api package, and an SDK configured in the process to
+    export them.
+    """
+
+    def __init__(self):
+        from opentelemetry import metrics as otel_metrics, trace
+        self.trace = trace
+        self.tracer = trace.get_tracer(metrics_service)
+        self.meter = otel_metrics.get_meter(metrics_service)
+        self.histograms = {}
+
+    def span(self, name, started, seconds, labels, error):
+        start_time = int(started * 1e9)
+        attributes = {key: str(value) for key, value in labels.items()}
+        span = self.tracer.start_span(
+            name, start_time=start_time, attributes=attributes
+        )
+        if error:
+            span.set_status(self.trace.Status(self.trace.StatusCode.ERROR))
+        span.end(end_time=start_time + int(seconds * 1e9))
+        if name not in self.histograms:
+            self.histograms[name] = self.meter.create_histogram(
+                name + "_seconds", unit="s"
+            )
+        self.histograms[name].record(seconds, attributes=attributes)
+
+    def export(self, metrics):
+        pass
+
+
+def build_metrics_sink(name):
+    if not name:
+        return None
+    if name == "json":
+        return JsonSink()
+    if name == "prometheus":
+        return PrometheusSink(
+            metrics_path or "/tmp/{}.prom".format(metrics_service)
+        )
+    if name == "opentelemetry":
+        return OpenTelemetrySink()
+    raise ValueError("Unknown metrics sink {!r}".format(name))
 
-if environment == "prod":
+
+metrics = Metrics(build_metrics_sink(metrics_sink), metrics_export_interval)
+atexit.register(metrics.export)
+
+
+def record_http_response(response, *args, **kwargs):
+    """requests response hook, records every HTTP call as a span"""
+    if metrics.sink is None:
+        return
+    metrics.record(
+        "http_request",
+        response.elapsed.total_seconds(),
+        {
+            "host": urlsplit(response.url).netloc,
+            "method": response.request.method,
+            "status": str(response.status_code),
+        },
+        error=response.status_code >= 500,
+    )
+
+
+def timed(name):
+    """Decorator recording every call of the function as a span"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+http_session = None
+http_session_lock = threading.Lock()
+
+
+def report_exception():
+    """Report the current exception to Stackdriver, creating the client once"""
+    global stackdriver_client
     try:
-        stackdriver_client = error_reporting.Client()
+        if stackdriver_client is None:
+            from google.cloud import error_reporting
+            stackdriver_client = error_reporting.Client()
+        stackdriver_client.report_exception()
     except Exception as e:
         logging.error(str(e))
 
 
+def get_session():
+    """
+    Return the shared requests Session. It is created on first use and kept
+    between warm invocations so calls to the same host reuse a pooled
+    keep-alive connection. Idempotent requests are retried with backoff on
+    connection errors, 429 and 5xx responses.
+    """
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(
+                total=http_retries,
+                backoff_factor=http_backoff,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=http_pool_size,
+                pool_maxsize=http_pool_size,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.hooks["response"].append(record_http_response)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            http_session = session
+    return http_session
+
+
+class SQLiteForwardQueue:
+    """
+    Durable queue of webhooks to forward, kept in a SQLite file.
+    A forward stays in the queue until its function accepted it. Claimed
+    forwards which were never acked, because the instance got frozen or
+    killed, are claimed again after `claim_timeout` seconds. Forwards which
+    can't succeed are dead-lettered, they stay in the table for inspection
+    but are never claimed again, until they're older than
+    `forward_dead_letter_ttl` or more than `forward_dead_letter_size` newer
+    ones were dead-lettered. Any object with the same
+    put/claim/ack/nack/dead_letter methods can be used instead.
+    """
+
+    def __init__(self, path, claim_timeout=120):
+        self.claim_timeout = claim_timeout
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS forwards ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT, payload TEXT, "
+            "attempts INTEGER DEFAULT 0, available_at REAL DEFAULT 0, "
+            "claimed_at REAL)"
+        )
+
+    def put(self, url, payload):
+        """Queue a payload, either a JSON document or its raw encoded body"""
+        if isinstance(payload, bytes):
+            payload = payload.decode("utf-8")
+        elif not isinstance(payload, str):
+            payload = json.dumps(payload)
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO forwards (url, payload) VALUES (?, ?)",
+                (url, payload),
+            )
+            return cursor.lastrowid
+
+    def claim(self, limit):
+        """Claim due forwards, return them as (id, url, payload, attempts)"""
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            rows = self.connection.execute(
+                "SELECT id, url, payload, attempts FROM forwards "
+                "WHERE attempts < ? AND available_at <= ? "
+                "AND (claimed_at IS NULL OR claimed_at < ?) "
+                "ORDER BY id LIMIT ?",
+                (forward_max_attempts, now, now - self.claim_timeout, limit),
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE forwards SET claimed_at = ? WHERE id = ?",
+                [(now, row[0]) for row in rows],
+            )
+            self.connection.execute("COMMIT")
+        return [(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
+
+    def ack(self, forward_id):
+        with self.lock:
+            self.connection.execute("DELETE FROM forwards WHERE id = ?", (forward_id,))
+
+    def nack(self, forward_id, attempts):
+        # exponential backoff, send_forward dead-letters the last attempt
+        with self.lock:
+            self.connection.execute(
+                "UPDATE forwards SET attempts = ?, available_at = ?, "
+                "claimed_at = NULL WHERE id = ?",
+                (attempts + 1, time.time() + 2 ** attempts, forward_id),
+            )
+
+    def dead_letter(self, forward_id):
+        # available_at of a dead letter is when it was dead-lettered
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "UPDATE forwards SET attempts = ?, available_at = ?, "
+                "claimed_at = NULL WHERE id = ?",
+                (forward_max_attempts, now, forward_id),
+            )
+            self.connection.execute(
+                "DELETE FROM forwards WHERE attempts >= ? AND ("
+                "available_at < ? OR id NOT IN ("
+                "SELECT id FROM forwards WHERE attempts >= ? "
+                "ORDER BY id DESC LIMIT ?))",
+                (
+                    forward_max_attempts, now - forward_dead_letter_ttl,
+                    forward_max_attempts, forward_dead_letter_size,
+                ),
+            )
+
+    def dead_letters(self, limit=100):
+        """Return the dead-lettered forwards as (id, url, payload, attempts)"""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, url, payload, attempts FROM forwards "
+                "WHERE attempts >= ? ORDER BY id LIMIT ?",
+                (forward_max_attempts, limit),
+            ).fetchall()
+        return [(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
+
+    def size(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM forwards WHERE attempts < ?",
+                (forward_max_attempts,),
+            ).fetchone()[0]
+
+
+forward_queue = None
+forward_worker = None
+forward_wakeup = threading.Event()
+forward_lock = threading.Lock()
+
+
+def build_forward_queue(backend):
+    if backend == "sqlite":
+        return SQLiteForwardQueue(forward_queue_path, forward_claim_timeout)
+    module_name, _, factory = backend.partition(":")
+    if not factory:
+        raise ValueError("Unknown forward queue backend {!r}".format(backend))
+    import importlib
+    module = importlib.import_module(module_name)
+    return getattr(module, factory)(forward_queue_path, forward_claim_timeout)
+
+
+def get_forward_queue():
+    global forward_queue
+    with forward_lock:
+        if forward_queue is None:
+            forward_queue = build_forward_queue(forward_queue_backend)
+    return forward_queue
+
+
+class ForwardedRequest:
+    """The part of a flask request in-process handlers read"""
+
+    def __init__(self, payload, topic=""):
+        self.payload = payload
+        self.headers = {"X-Shopify-Topic": topic}
+
+    def get_json(self, *args, **kwargs):
+        return self.payload
+
+    def get_data(self, *args, **kwargs):
+        return json.dumps(self.payload).encode("utf-8")
+
+
+def call_handler(name, payload):
+    """
+    Run a forward in-process and return its status code, a handler which
+    returns nothing failed like a Cloud Function returning nothing does
+    """
+    response = route_handlers[name](ForwardedRequest(payload))
+    if response is None:
+        return 500
+    return getattr(response, "status_code", 200)
+
+
+def is_permanent_failure(status_code):
+    """The function rejected the forward, sending it again won't help"""
+    return 400 <= status_code < 500 and status_code not in (408, 429)
+
+
+@timed("forward")
+def send_forward(forward):
+    forward_id, url, payload, attempts = forward
+    queue = get_forward_queue()
+    try:
+        if url.startswith(handler_target):
+            status_code = call_handler(url[len(handler_target):], payload)
+            sent = status_code < 400
+        else:
+            response = get_session().post(
+                url, json=payload, timeout=http_timeout
+            )
+            status_code, sent = response.status_code, response.ok
+        if sent:
+            queue.ack(forward_id)
+            logging.info("sent a request to {}".format(url))
+            return True
+        error = "status {}".format(status_code)
+        if is_permanent_failure(status_code):
+            dead_letter_forward(queue, forward, error, "rejected")
+            return False
+    except Exception as e:
+        error = str(e)
+    if attempts + 1 >= forward_max_attempts:
+        dead_letter_forward(queue, forward, error, "exhausted")
+        return False
+    logging.error("Forward {} to {} failed: {}".format(forward_id, url, error))
+    queue.nack(forward_id, attempts)
+    return False
+
+
+def dead_letter_forward(queue, forward, error, reason):
+    forward_id, url, payload, attempts = forward
+    logging.error(
+        "Forward {} to {} dead-lettered after {} attempt(s): {}".format(
+            forward_id, url, attempts + 1, error
+        )
+    )
+    metrics.increment("forwards_dead_lettered", reason=reason)
+    queue.dead_letter(forward_id)
+
+
+def drain_forward_queue(executor=None):
+    """
+    Send all due forwards with at most `forward_concurrency` in flight and
+    return how many were sent
+    """
+    queue = get_forward_queue()
+    if executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=forward_concurrency) as executor:
+            return drain_forward_queue(executor)
+    sent = 0
+    forwards = queue.claim(forward_concurrency)
+    while forwards:
+        sent += sum(executor.map(send_forward, forwards))
+        forwards = queue.claim(forward_concurrency)
+    return sent
+
+
+def run_forward_worker():
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=forward_concurrency) as executor:
+        while True:
+            forward_wakeup.wait(timeout=1)
+            forward_wakeup.clear()
+            try:
+                drain_forward_queue(executor)
+            except Exception as e:
+                logging.error(str(e))
+
+
+@timed("enqueue_forward")
+def enqueue_forward(function_url, request_json):
+    """
+    Persist the forward and wake up the background worker, the webhook can
+    be acked as soon as this returns
+    """
+    global forward_worker
+    get_forward_queue().put(function_url, request_json)
+    with forward_lock:
+        if forward_worker is None or not forward_worker.is_alive():
+            forward_worker = threading.Thread(target=run_forward_worker, daemon=True)
+            forward_worker.start()
+    forward_wakeup.set()
+
+
+class WebhookDedup:
+    """
+    Keys of handled webhooks, kept for `ttl` seconds and at most `max_size`
+    of them in memory. If `path` is given keys are also stored in a SQLite
+    table so a retry reaching a new instance is dropped as well.
+    """
+
+    def __init__(self, ttl, max_size, path=""):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+        self.connection = None
+        if path:
+            self.connection = sqlite3.connect(
+                path, check_same_thread=False, isolation_level=None
+            )
+            # several processes can share the file
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS webhooks "
+                "(key TEXT PRIMARY KEY, seen_at REAL)"
+            )
+
+    def add(self, key):
+        """Remember the key, return False if it was already seen"""
+        now = time.time()
+        with self.lock:
+            while self.seen and next(iter(self.seen.values())) < now - self.ttl:
+                self.seen.popitem(last=False)
+            if key in self.seen:
+                return False
+            self.seen[key] = now
+            while len(self.seen) > self.max_size:
+                self.seen.popitem(last=False)
+            if self.connection is None:
+                return True
+            self.connection.execute(
+                "DELETE FROM webhooks WHERE seen_at < ?", (now - self.ttl,)
+            )
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO webhooks (key, seen_at) VALUES (?, ?)",
+                (key, now),
+            )
+            return cursor.rowcount == 1
+
+    def discard(self, key):
+        """Forget the key, so a retry of the webhook is handled again"""
+        with self.lock:
+            self.seen.pop(key, None)
+            if self.connection is not None:
+                self.connection.execute("DELETE FROM webhooks WHERE key = ?", (key,))
+
+    def clear(self):
+        with self.lock:
+            self.seen.clear()
+            if self.connection is not None:
+                self.connection.execute("DELETE FROM webhooks")
+
+
+webhook_dedup = WebhookDedup(
+    webhook_dedup_ttl, webhook_dedup_size, webhook_dedup_path
+)
+
+
+class Webhook:
+    """
+    A Shopify webhook request. The raw body is read once, the JSON payload
+    is only parsed when a field of it is needed
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.data = request.get_data()
+        self.topic = request.headers.get("X-Shopify-Topic", "")
+        self.shop_domain = request.headers.get("X-Shopify-Shop-Domain", "")
+        self.hmac = request.headers.get("X-Shopify-Hmac-SHA256", "")
+        self.webhook_id = request.headers.get("X-Shopify-Webhook-Id", "")
+        self.parsed = None
+
+    @property
+    def payload(self):
+        if self.parsed is None:
+            with metrics.span("parse_payload"):
+                self.parsed = self.request.get_json()
+        return self.parsed
+
+    def get(self, key, default=None):
+        return self.payload.get(key, default)
+
+
+def log_webhook(level, event, webhook, **fields):
+    """
+    Log one structured record about a webhook. Payloads aren't logged since
+    they contain customer data, and every field is capped to
+    `log_field_size` characters.
+    """
+    metrics.increment(
+        "webhooks", event=event,
+        topic=webhook.topic if webhook.topic in routes else "other",
+    )
+    if not logging.getLogger().isEnabledFor(level):
+        return
+    record = {
+        "event": event,
+        "topic": webhook.topic,
+        "shop": webhook.shop_domain,
+        "webhook_id": webhook.webhook_id,
+        "size": len(webhook.data),
+    }
+    record.update(fields)
+    for key, value in record.items():
+        if isinstance(value, str) and len(value) > log_field_size:
+            record[key] = value[:log_field_size] + "..."
+    logging.log(level, "%s", json.dumps(record))
+
+
+def get_webhook_key(webhook):
+    """
+    Shopify sends the same X-Shopify-Webhook-Id when it retries a webhook,
+    without it the topic, resource id and update time identify the event
+    """
+    if webhook.webhook_id:
+        return webhook.webhook_id
+    return "{}:{}:{}".format(
+        webhook.topic, webhook.get("id"), webhook.get("updated_at")
+    )
+
+
+def forward_webhook(webhook, function_url, **fields):
+    """
+    Queue the raw webhook body for its function, unless it's a retry of a
+    webhook which is already queued. `function_url` is either a URL or an
+    in-process handler target.
+    """
+    key = get_webhook_key(webhook)
+    if not webhook_dedup.add(key):
+        log_webhook(logging.INFO, "duplicate", webhook)
+        return Response("Duplicate webhook ignored", status=200)
+    try:
+        enqueue_forward(function_url, webhook.data)
+    except Exception:
+        # it wasn't queued, Shopify's retry must not be dropped as duplicate
+        webhook_dedup.discard(key)
+        raise
+    log_webhook(logging.INFO, "queued", webhook, url=function_url, **fields)
+    return Response(
+        "Call is valid redirected to {}".format(function_url),
+        status=200
+    )
+
+
+class WebhookVerifier:
+    """
+    Verifies Shopify webhook signatures against one or more secrets.
+    The HMAC of every secret is keyed once and copied per request, so a
+    request only pays for hashing its body. Several secrets are accepted
+    at the same time to rotate the app secret without dropping webhooks.
+    """
+
+    def __init__(self, secrets):
+        self.secrets = tuple(secrets)
+        self.states = [
+            hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+            for secret in self.secrets if secret
+        ]
+
+    def verify(self, data, hmac_header):
+        try:
+            expected = base64.b64decode(hmac_header, validate=True)
+        except (binascii.Error, ValueError):
+            return False
+        if len(expected) != hashlib.sha256().digest_size:
+            return False
+        for state in self.states:
+            computed = state.copy()
+            computed.update(data)
+            if hmac.compare_digest(computed.digest(), expected):
+                return True
+        return False
+
+
+webhook_verifier = None
+
+
+def get_webhook_verifier():
+    """Return the verifier, rebuilt when the configured secrets change"""
+    global webhook_verifier
+    secrets = (shopify_secret,) + tuple(
+        secret.strip() for secret in shopify_previous_secrets.split(",")
+    )
+    if webhook_verifier is None or webhook_verifier.secrets != secrets:
+        webhook_verifier = WebhookVerifier(secrets)
+    return webhook_verifier
+
+
 # 1. Verify recieved data from Shopify is valid
+@timed("verify_webhook")
 def verify_webhook(data, hmac_header):
-    secret_utf8 = shopify_secret.encode("utf-8")
-    digest = hmac.new(secret_utf8, data, hashlib.sha256).digest()
-    computed_hmac = base64.b64encode(digest)
-    return hmac.compare_digest(computed_hmac, hmac_header.encode("utf-8"))
+    return get_webhook_verifier().verify(data, hmac_header)
+
+
+# Routing table
+# Every route sends webhooks of one topic, which match its filters, either
+# to a function URL or to a handler running in this process. The first
+# matching route of a topic is used.
+Route = namedtuple("Route", ["topic", "matches", "target", "validate", "unmatched"])
+handler_target = "handler:"
+route_handlers = {}
+
+
+def register_handler(name, handler):
+    """
+    Register a function taking a request, which routes can use with
+    {"handler": name} instead of a URL to skip the network hop
+    """
+    route_handlers[name] = handler
+
+
+def validate_order(webhook):
+    """
+    Return the error of a paid order which can't be enrolled or None, and
+    the order fields to log
+    """
+    # Verify that Shopify's call contains email, fullname and SKU
+    # Only purchase call contains this data
+    email = webhook.get("email")
+    fullname = (webhook.get("billing_address") or {}).get("name")
+    skus = [
+        item["sku"] for item in webhook.get("line_items", []) if item.get("sku")
+    ]
+    fields = {"order_id": webhook.get("id"), "skus": ", ".join(skus)}
+    if not email or not fullname or not skus:
+        return "Email or fullname or sku missing", fields
+    return None, fields
+
+
+route_validators = {"order": validate_order}
+filter_operators = {
+    "==": lambda value, expected: value == expected,
+    "!=": lambda value, expected: value != expected,
+    "in": lambda value, expected: value in expected.split(","),
+}
 
 
+def compile_filter(expression):
+    """
+    Compile a filter like `financial_status == paid` into a function of a
+    webhook. Conditions are joined with `and`, fields can be dotted paths
+    and values are compared as strings.
+    """
+    if not isinstance(expression, str):
+        raise ValueError("Route filter must be a string, not {!r}".format(expression))
+    conditions = []
+    for condition in expression.split(" and "):
+        parts = condition.split(None, 2)
+        if (len(parts) != 3 or parts[1] not in filter_operators
+                or not all(parts[0].split("."))):
+            raise ValueError("Invalid route filter {!r}".format(condition))
+        path, operator, expected = parts
+        conditions.append(
+            (path.split("."), filter_operators[operator], expected.strip("\"'"))
+        )
+
+    def matches(webhook):
+        for path, operator, expected in conditions:
+            value = webhook.payload
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            if not operator("" if value is None else str(value), expected):
+                return False
+        return True
+
+    return matches
+
+
+route_fields = {"topic", "filter", "url", "handler", "validate", "unmatched"}
+
+
+def load_route(entry, handlers):
+    if not isinstance(entry, dict):
+        raise ValueError("Route must be an object")
+    unknown = set(entry) - route_fields
+    if unknown:
+        raise ValueError("Unknown route field(s) {}".format(", ".join(sorted(unknown))))
+    if not entry.get("topic") or bool(entry.get("url")) == bool(entry.get("handler")):
+        raise ValueError("Route needs a topic and a url or a handler")
+    handler = entry.get("handler")
+    if handler and handler not in handlers:
+        raise ValueError("Route handler {!r} isn't registered".format(handler))
+    validate = entry.get("validate")
+    if validate and validate not in route_validators:
+        raise ValueError("Unknown route validator {!r}".format(validate))
+    return Route(
+        topic=entry["topic"],
+        matches=compile_filter(entry["filter"]) if entry.get("filter") else None,
+        target=entry.get("url") or handler_target + handler,
+        validate=route_validators.get(validate),
+        unmatched=entry.get("unmatched", "No route for this call"),
+    )
+
+
+def load_routes(config, handlers=None):
+    """
+    Build the routing table from a list of routes like
+    {"topic": "orders/paid", "filter": "financial_status == paid",
+     "url": "https://...", "validate": "order",
+     "unmatched": "Cant handle unpaid call"}
+    where "handler" can be given instead of "url", naming one of `handlers`,
+    the registered handlers by default. Raise ValueError on an invalid route
+    so a bad config fails at startup instead of when a webhook arrives.
+    """
+    if handlers is None:
+        handlers = route_handlers
+    routes = {}
+    for number, entry in enumerate(config, 1):
+        try:
+            route = load_route(entry, handlers)
+        except ValueError as e:
+            raise ValueError("Route {} is invalid: {}".format(number, e))
+        routes.setdefault(route.topic, []).append(route)
+    return routes
+
+
+def read_routes_config():
+    if shopify_routes_file:
+        with open(shopify_routes_file) as routes_file:
+            return json.load(routes_file)
+    if shopify_routes:
+        return json.loads(shopify_routes)
+    return [
+        {
+            "topic": "orders/paid",
+            "filter": "financial_status == paid",
+            "url": shopify_topics_handler["orders/paid"],
+            "validate": "order",
+            "unmatched": "Cant handle unpaid call",
+        },
+        {"topic": "products/create", "url": shopify_topics_handler["products/create"]},
+        {"topic": "products/update", "url": shopify_topics_handler["products/update"]},
+    ]
+
+
+routes = load_routes(
+    read_routes_config(),
+    set(route_handlers) | set(filter(None, shopify_route_handlers.split(","))),
+)
+
+
+@timed("route_webhook")
+def route_webhook(webhook):
+    """Forward the webhook to the first route of its topic it matches"""
+    topic_routes = routes.get(webhook.topic)
+    if not topic_routes:
+        return Response("Invalid topic to handle", status=200)
+    for route in topic_routes:
+        if route.matches is not None and not route.matches(webhook):
+            continue
+        error, fields = None, {}
+        if route.validate:
+            error, fields = route.validate(webhook)
+        if error:
+            log_webhook(
+                logging.ERROR, "invalid payload", webhook, error=error, **fields
+            )
+            return Response(error, status=200)
+        return forward_webhook(webhook, route.target, **fields)
+    return Response(topic_routes[-1].unmatched, status=200)
+
+
+@timed("call_validator")
 def call_validator(request):
     """
     This function recieves a call from shopify when user makes a paid
@@ -45,87 +1018,31 @@ def call_validator(request):
     2- call is coming from the store and not from unauthorized caller
     3- if the call made by product purchase we need to make sure the request
     contains necessary data for us to register and enroll the user in Tahoe
-    After validation is done we send the request object to internal google
-    functions to take action.
+    After validation is done we send the request object to the google
+    function or in-process handler of its route to take action.
     In this function we need to return 200 in any case, because shopify waits
     for 5 seconds to recieve a 200 ack from us and if they don't recieve it
     they keep making a call to the function because they assume we didn't
     recieve the call
     """
     try:
-        logging.info("Start validating a call")
-        # 1.1 Verify store signature
-        request_json = request.get_json()
-        # request only contains non critical data
-        logging.info(request_json)
-        data = request.get_data()
-        topic = request.headers.get("X-Shopify-Topic", "")
-        caller = request.headers.get("X-Shopify-Shop-Domain", "")
-        caller = "https://" + caller
-        hmac_sha = request.headers.get("X-Shopify-Hmac-SHA256", "")
-        varified_signature = verify_webhook(data, hmac_sha)
-        if not varified_signature:
-            msg = "Unauthorized access - Store signature is not valid"
-            logging.info(request_json)
-            logging.error(msg)
+        # 1.1 Verify store signature, the payload isn't parsed before that
+        webhook = Webhook(request)
+        if not verify_webhook(webhook.data, webhook.hmac):
+            log_webhook(logging.ERROR, "invalid signature", webhook)
             return Response("Store signature is not valid", status=200)
 
         # 1.2 Verify caller is Shopify not a third party
+        caller = "https://" + webhook.shop_domain
         if caller != shopify_store_url:
-            msg = "Unauthorized access - Unauthorized caller"
-            logging.info(request_json)
-            logging.error(msg)
+            log_webhook(logging.ERROR, "unauthorized caller", webhook)
             return Response("Unauthorized caller", status=200)
 
-        if topic == "orders/paid":
-            if request_json['financial_status'] == "paid":
-                # 1.3 Verify that Shopify's call contains email, fullname and SKU
-                # Only purchase call contains this data
-                email = request_json["email"]
-                fullname = request_json["billing_address"]["name"]
-                sku = request_json["line_items"][0]["sku"]
-                if not email or not fullname or not sku:
-                    msg = "Bad request - Email or fullname or sku missing"
-                    logging.info(request_json)
-                    logging.error(msg)
-                    return Response("Email or fullname or sku missing", status=200)
-                else:
-                    msg = "call from {} - {} for purchasing {} is valid".format(
-                        caller, email, sku
-                    )
-                    logging.info(msg)
-                    function_url = shopify_topics_handler["orders/paid"]
-                    pool = Pool(1)
-                    pool.apply_async(
-                        requests.post,
-                        args=[function_url],
-                        kwds={'json': request_json}
-                    )
-                    logging.info("sent a request to {}".format(function_url))
-                    logging.info("End of call validation")
-                    return Response(
-                        "Call is valid redirected to {}".format(function_url),
-                        status=200
-                        )
-            else:
-                return Response("Cant handle unpaid call", status=200)
-        elif topic == "products/create" or topic == "products/update":
-            function_url = shopify_topics_handler["products/create"]
-            pool = Pool(1)
-            pool.apply_async(
-                requests.post,
-                args=[function_url],
-                kwds={'json': request_json}
-            )
-            logging.info("sent a request to {}".format(function_url))
-            logging.info("End of call validation")
-            return Response(
-                "Call is valid redirected to {}".format(function_url),
-                status=200
-            )
-        else:
-            return Response("Invalid topic to handle", status=200)
+        # 1.3 Send the call to the route of its topic
+        return route_webhook(webhook)
     except Exception as e:
         logging.error(str(e))
         if environment == "prod":
-            stackdriver_client.report_exception()
+            report_exception()
+    finally:
+        metrics.export(force=False)
@@ -1,7 +1,19 @@
+import base64
+import hashlib
+import hmac
+import io
 import json
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import Mock
-from os import environ
+from unittest.mock import Mock, patch
+from os import environ, path
+
+import flask
 
 import functions
 
@@ -378,5 +390,536 @@ class CallValidatorTests(unittest.TestCase):
         )
 
 
+class ForwardQueueTests(unittest.TestCase):
+    def setUp(self):
+        functions.forward_queue = functions.SQLiteForwardQueue(":memory:")
+        self.url = "https://functions.example.com/listener"
+
+    @patch("functions.get_session")
+    def test_drain_sends_and_removes_forwards(self, get_session):
+        get_session.return_value.post.return_value.ok = True
+        functions.forward_queue.put(self.url, {"id": 1})
+        functions.forward_queue.put(self.url, {"id": 2})
+        self.assertEqual(functions.drain_forward_queue(), 2)
+        self.assertEqual(functions.forward_queue.size(), 0)
+        get_session.return_value.post.assert_any_call(
+            self.url, json={"id": 1}, timeout=functions.http_timeout
+        )
+
+    @patch("functions.get_session")
+    def test_failed_forward_stays_in_queue(self, get_session):
+        get_session.return_value.post.return_value.ok = False
+        functions.forward_queue.put(self.url, {"id": 1})
+        self.assertEqual(functions.drain_forward_queue(), 0)
+        self.assertEqual(functions.forward_queue.size(), 1)
+        # it's backed off, so it's not due yet
+        self.assertEqual(functions.forward_queue.claim(10), [])
+
+    @patch("functions.get_session")
+    def test_rejected_forward_is_dead_lettered(self, get_session):
+        get_session.return_value.post.return_value = Mock(ok=False, status_code=409)
+        functions.forward_queue.put(self.url, {"id": 1})
+        with self.assertLogs(level="ERROR") as logs:
+            self.assertEqual(functions.drain_forward_queue(), 0)
+        self.assertIn("dead-lettered", logs.output[0])
+        self.assertEqual(functions.forward_queue.size(), 0)
+        self.assertEqual(
+            functions.forward_queue.dead_letters(), [(1, self.url, {"id": 1}, functions.forward_max_attempts)]
+        )
+        self.assertEqual(get_session.return_value.post.call_count, 1)
+
+    @patch("functions.get_session")
+    def test_last_failed_attempt_is_dead_lettered(self, get_session):
+        get_session.return_value.post.return_value = Mock(ok=False, status_code=503)
+        functions.forward_queue.put(self.url, {"id": 1})
+        forward = functions.forward_queue.claim(1)[0]
+        forward = forward[:3] + (functions.forward_max_attempts - 1,)
+        with self.assertLogs(level="ERROR") as logs:
+            self.assertFalse(functions.send_forward(forward))
+        self.assertIn("dead-lettered after 8 attempt(s): status 503", logs.output[0])
+        self.assertEqual(len(functions.forward_queue.dead_letters()), 1)
+
+    def test_dead_letters_are_purged(self):
+        with patch("functions.forward_dead_letter_size", 2):
+            for number in range(3):
+                functions.forward_queue.dead_letter(
+                    functions.forward_queue.put(self.url, {"id": number})
+                )
+        self.assertEqual(
+            [payload["id"] for _, _, payload, _ in functions.forward_queue.dead_letters()],
+            [1, 2],
+        )
+        with patch("functions.time.time", return_value=time.time() + functions.forward_dead_letter_ttl + 1):
+            functions.forward_queue.dead_letter(
+                functions.forward_queue.put(self.url, {"id": 3})
+            )
+        self.assertEqual(
+            [payload["id"] for _, _, payload, _ in functions.forward_queue.dead_letters()],
+            [3],
+        )
+
+    def test_handler_returning_nothing_is_retried(self):
+        functions.register_handler("refunds", Mock(return_value=None))
+        functions.forward_queue.put("handler:refunds", {"id": 1})
+        self.assertEqual(functions.drain_forward_queue(), 0)
+        self.assertEqual(functions.forward_queue.size(), 1)
+        self.assertEqual(functions.forward_queue.dead_letters(), [])
+
+    def test_queue_backend_is_configurable(self):
+        with patch("functions.forward_queue_path", tempfile.mktemp(suffix=".sqlite3")):
+            queue = functions.build_forward_queue("functions:SQLiteForwardQueue")
+        self.assertIsInstance(queue, functions.SQLiteForwardQueue)
+        with self.assertRaises(ValueError):
+            functions.build_forward_queue("redis")
+
+    def test_claimed_forward_isnt_claimed_twice(self):
+        functions.forward_queue.put(self.url, {"id": 1})
+        self.assertEqual(len(functions.forward_queue.claim(10)), 1)
+        self.assertEqual(functions.forward_queue.claim(10), [])
+
+    @patch("functions.verify_webhook", return_value=True)
+    @patch("functions.get_session")
+    def test_ack_doesnt_wait_for_forward(self, get_session, verify_webhook):
+        functions.webhook_dedup.clear()
+        functions.shopify_store_url = "https://amirtds.myshopify.com"
+        sent = threading.Event()
+
+        def slow_post(*args, **kwargs):
+            time.sleep(1)
+            sent.set()
+            return Mock(ok=True)
+
+        get_session.return_value.post.side_effect = slow_post
+        request = Mock()
+        request.get_json.return_value = {"id": 1, "variants": [{"sku": "a"}]}
+        request.get_data.return_value = b"{}"
+        request.headers = {
+            "X-Shopify-Topic": "products/create",
+            "X-Shopify-Shop-Domain": "amirtds.myshopify.com",
+            "X-Shopify-Hmac-SHA256": "",
+        }
+        started = time.monotonic()
+        response = functions.call_validator(request)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(sent.wait(5))
+
+
+class WebhookDedupTests(unittest.TestCase):
+    def setUp(self):
+        functions.shopify_store_url = "https://amirtds.myshopify.com"
+        functions.webhook_dedup = functions.WebhookDedup(3600, 100)
+        self.request = Mock()
+        self.request.get_json.return_value = {
+            "id": 1, "updated_at": "2020-03-27", "variants": [{"sku": "a"}]
+        }
+        self.request.get_data.return_value = b"{}"
+        self.request.headers = {
+            "X-Shopify-Topic": "products/update",
+            "X-Shopify-Shop-Domain": "amirtds.myshopify.com",
+            "X-Shopify-Hmac-SHA256": "",
+            "X-Shopify-Webhook-Id": "b54557e4-bdd9-4b37-8a5f-bf7d70bcd043",
+        }
+
+    @patch("functions.verify_webhook", return_value=True)
+    @patch("functions.enqueue_forward")
+    def test_retried_webhook_is_forwarded_once(self, enqueue_forward, verify):
+        functions.call_validator(self.request)
+        response = functions.call_validator(self.request)
+        self.assertEqual(
+            response.response[0].decode(), "Duplicate webhook ignored"
+        )
+        self.assertEqual(enqueue_forward.call_count, 1)
+
+    @patch("functions.verify_webhook", return_value=True)
+    @patch("functions.enqueue_forward")
+    def test_new_update_without_webhook_id(self, enqueue_forward, verify):
+        del self.request.headers["X-Shopify-Webhook-Id"]
+        functions.call_validator(self.request)
+        self.request.get_json()["updated_at"] = "2020-03-28"
+        functions.call_validator(self.request)
+        self.assertEqual(enqueue_forward.call_count, 2)
+
+    @patch("functions.verify_webhook", return_value=True)
+    @patch("functions.enqueue_forward")
+    def test_retry_is_accepted_after_failed_enqueue(self, enqueue_forward, verify):
+        enqueue_forward.side_effect = [sqlite3.OperationalError("database is locked"), None]
+        functions.call_validator(self.request)
+        response = functions.call_validator(self.request)
+        self.assertNotEqual(
+            response.response[0].decode(), "Duplicate webhook ignored"
+        )
+        self.assertEqual(enqueue_forward.call_count, 2)
+
+    def test_persistent_key_is_discarded(self):
+        path = tempfile.mktemp(suffix=".sqlite3")
+        dedup = functions.WebhookDedup(3600, 100, path)
+        self.assertTrue(dedup.add("key"))
+        dedup.discard("key")
+        self.assertTrue(functions.WebhookDedup(3600, 100, path).add("key"))
+
+    def test_expired_keys_are_forgotten(self):
+        dedup = functions.WebhookDedup(0, 100)
+        self.assertTrue(dedup.add("key"))
+        time.sleep(0.01)
+        self.assertTrue(dedup.add("key"))
+
+    def test_persistent_backend(self):
+        path = tempfile.mktemp(suffix=".sqlite3")
+        self.assertTrue(functions.WebhookDedup(3600, 100, path).add("key"))
+        self.assertFalse(functions.WebhookDedup(3600, 100, path).add("key"))
+
+
+def sign(secret, data):
+    digest = hmac.new(secret.encode("utf-8"), data, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+class WebhookVerifierTests(unittest.TestCase):
+    def setUp(self):
+        functions.shopify_secret = "new-secret"
+        functions.shopify_previous_secrets = ""
+        self.data = b'{"id": 1}'
+
+    def test_valid_signature(self):
+        self.assertTrue(
+            functions.verify_webhook(self.data, sign("new-secret", self.data))
+        )
+
+    def test_tampered_body(self):
+        signature = sign("new-secret", self.data)
+        self.assertFalse(functions.verify_webhook(b'{"id": 2}', signature))
+
+    def test_malformed_header(self):
+        self.assertFalse(functions.verify_webhook(self.data, ""))
+        self.assertFalse(functions.verify_webhook(self.data, "not base64!"))
+        self.assertFalse(functions.verify_webhook(self.data, "c2hvcnQ="))
+
+    def test_previous_secret_during_rotation(self):
+        signature = sign("old-secret", self.data)
+        self.assertFalse(functions.verify_webhook(self.data, signature))
+        functions.shopify_previous_secrets = "old-secret"
+        self.assertTrue(functions.verify_webhook(self.data, signature))
+
+    def test_verifier_is_reused(self):
+        verifier = functions.get_webhook_verifier()
+        self.assertIs(functions.get_webhook_verifier(), verifier)
+        functions.shopify_secret = "newer-secret"
+        self.assertIsNot(functions.get_webhook_verifier(), verifier)
+
+    def test_verifier_benchmark(self):
+        verifier = functions.WebhookVerifier(["new-secret", "old-secret"])
+        for size in (1024, 64 * 1024, 1024 * 1024):
+            data = b"x" * size
+            signature = sign("old-secret", data)
+            rounds = max(10, 2 ** 20 // size * 4)
+            started = time.monotonic()
+            for _ in range(rounds):
+                self.assertTrue(verifier.verify(data, signature))
+            elapsed = time.monotonic() - started
+            print("{} KB: {:.0f} verifications/s, {:.0f} MB/s".format(
+                size // 1024, rounds / elapsed,
+                size * rounds / elapsed / 2 ** 20
+            ))
+
+
+STARTUP_SCRIPT = """
+import sys, time
+started = time.perf_counter()
+import functions
+from unittest.mock import Mock
+imported = time.perf_counter()
+request = Mock()
+request.get_json.return_value = {"id": 1}
+request.get_data.return_value = b"{}"
+request.headers = {"X-Shopify-Hmac-SHA256": ""}
+functions.call_validator(request)
+responded = time.perf_counter()
+lazy = ("requests", "google.cloud.error_reporting", "concurrent.futures.thread")
+print(imported - started, responded - started)
+print(",".join(module for module in lazy if module in sys.modules))
+"""
+
+
+class StartupTests(unittest.TestCase):
+    def test_startup_benchmark(self):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            cwd=path.dirname(path.abspath(functions.__file__)),
+            stdout=subprocess.PIPE, check=True, universal_newlines=True,
+        ).stdout.splitlines()
+        imported, responded = map(float, output[0].split())
+        print("import {:.1f} ms, first response {:.1f} ms".format(
+            imported * 1000, responded * 1000
+        ))
+        self.assertEqual(output[1:], [""])
+
+
+def paid_order_body(line_items):
+    return json.dumps({
+        "id": 1,
+        "email": "jon@doe.ca",
+        "financial_status": "paid",
+        "billing_address": {"name": "Jon Doe"},
+        "line_items": [
+            {"sku": "course-v1:a+{}+2020".format(number), "title": "x" * 200}
+            for number in range(line_items)
+        ],
+    }).encode("utf-8")
+
+
+class WebhookParsingTests(unittest.TestCase):
+    def setUp(self):
+        functions.shopify_secret = "secret"
+        functions.shopify_previous_secrets = ""
+        functions.shopify_store_url = "https://amirtds.myshopify.com"
+        functions.webhook_dedup = functions.WebhookDedup(3600, 100)
+        self.app = flask.Flask(__name__)
+
+    def request_context(self, body, webhook_id=""):
+        return self.app.test_request_context(
+            method="POST", data=body, content_type="application/json",
+            headers={
+                "X-Shopify-Topic": "orders/paid",
+                "X-Shopify-Shop-Domain": "amirtds.myshopify.com",
+                "X-Shopify-Hmac-SHA256": sign("secret", body),
+                "X-Shopify-Webhook-Id": webhook_id,
+            },
+        )
+
+    def test_unverified_payload_isnt_parsed(self):
+        request = Mock()
+        request.get_data.return_value = b"{}"
+        request.headers = {"X-Shopify-Hmac-SHA256": "invalid"}
+        functions.call_validator(request)
+        request.get_json.assert_not_called()
+
+    @patch("functions.enqueue_forward")
+    def test_raw_body_is_forwarded(self, enqueue_forward):
+        body = paid_order_body(2)
+        with self.request_context(body):
+            response = functions.call_validator(flask.request)
+        self.assertIn("Call is valid", response.response[0].decode())
+        enqueue_forward.assert_called_once_with(
+            functions.shopify_topics_handler["orders/paid"], body
+        )
+
+    @patch("functions.enqueue_forward")
+    def test_logs_are_capped_and_skip_customer_data(self, enqueue_forward):
+        with self.request_context(paid_order_body(50)):
+            with self.assertLogs(level="INFO") as logs:
+                functions.call_validator(flask.request)
+        self.assertEqual(len(logs.records), 1)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["event"], "queued")
+        self.assertEqual(len(record["skus"]), functions.log_field_size + 3)
+        self.assertNotIn("jon@doe.ca", logs.output[0])
+
+    @patch("functions.enqueue_forward")
+    def test_request_cpu_benchmark(self, enqueue_forward):
+        for line_items in (1, 50, 500):
+            body = paid_order_body(line_items)
+            rounds = 200
+            contexts = [
+                self.request_context(body, "{}-{}".format(line_items, number))
+                for number in range(rounds)
+            ]
+            started = time.process_time()
+            for context in contexts:
+                with context:
+                    functions.call_validator(flask.request)
+            elapsed = time.process_time() - started
+            print("{} KB order: {:.0f} us CPU per request".format(
+                len(body) // 1024, elapsed / rounds * 1000000
+            ))
+            self.assertEqual(enqueue_forward.call_count, rounds)
+            enqueue_forward.reset_mock()
+
+
+class RoutingTests(unittest.TestCase):
+    def setUp(self):
+        functions.webhook_dedup = functions.WebhookDedup(3600, 100)
+        functions.forward_queue = functions.SQLiteForwardQueue(":memory:")
+        self.default_routes = functions.routes
+        self.webhook = Mock(topic="refunds/create", payload={
+            "id": 1, "financial_status": "refunded",
+            "order": {"source_name": "web"},
+        })
+        self.webhook.get = self.webhook.payload.get
+
+    def tearDown(self):
+        functions.routes = self.default_routes
+        functions.route_handlers.clear()
+
+    def test_filters(self):
+        matches = functions.compile_filter(
+            "financial_status in refunded,voided and order.source_name == web"
+        )
+        self.assertTrue(matches(self.webhook))
+        self.webhook.payload["order"]["source_name"] = "pos"
+        self.assertFalse(matches(self.webhook))
+        with self.assertRaises(ValueError):
+            functions.compile_filter("financial_status is paid")
+
+    def test_invalid_routes_fail_at_load(self):
+        with self.assertRaises(ValueError):
+            functions.load_routes([{"topic": "orders/paid"}])
+        with self.assertRaises(ValueError):
+            functions.load_routes([
+                {"topic": "orders/paid", "url": "https://x", "validate": "nope"}
+            ])
+        for route in (
+            {"topic": "orders/paid", "url": "https://x", "filter": 1},
+            {"topic": "orders/paid", "url": "https://x", "filter": "a. == b"},
+            {"topic": "orders/paid", "url": "https://x", "filters": "a == b"},
+        ):
+            with self.assertRaises(ValueError):
+                functions.load_routes([route])
+
+    def test_unregistered_handler_fails_at_load(self):
+        route = {"topic": "refunds/create", "handler": "missing"}
+        with self.assertRaises(ValueError) as error:
+            functions.load_routes([{"topic": "orders/paid", "url": "https://x"}, route])
+        self.assertEqual(
+            str(error.exception),
+            "Route 2 is invalid: Route handler 'missing' isn't registered",
+        )
+        # a host can declare the handlers it registers after loading routes
+        routes = functions.load_routes([route], handlers={"missing"})
+        self.assertEqual(routes["refunds/create"][0].target, "handler:missing")
+
+    def test_default_routes(self):
+        self.assertEqual(
+            [route.target for route in functions.routes["orders/paid"]],
+            [functions.shopify_topics_handler["orders/paid"]],
+        )
+
+    @patch("functions.enqueue_forward")
+    def test_configured_topic(self, enqueue_forward):
+        functions.routes = functions.load_routes([{
+            "topic": "refunds/create", "filter": "order.source_name == web",
+            "url": "https://functions.example.com/refunds",
+            "unmatched": "Only web refunds",
+        }])
+        response = functions.route_webhook(self.webhook)
+        self.assertIn("Call is valid", response.response[0].decode())
+        self.webhook.payload["order"]["source_name"] = "pos"
+        response = functions.route_webhook(self.webhook)
+        self.assertEqual(response.response[0].decode(), "Only web refunds")
+        self.assertEqual(enqueue_forward.call_count, 1)
+
+    @patch("functions.get_session")
+    def test_in_process_handler(self, get_session):
+        handler = Mock(return_value=flask.Response("200 OK", status=200))
+        functions.register_handler("refunds", handler)
+        functions.routes = functions.load_routes(
+            [{"topic": "refunds/create", "handler": "refunds"}]
+        )
+        functions.forward_queue.put("handler:refunds", b'{"id": 1}')
+        self.assertEqual(functions.drain_forward_queue(), 1)
+        get_session.assert_not_called()
+        self.assertEqual(handler.call_args[0][0].get_json(), {"id": 1})
+
+    def test_failing_handler_is_retried(self):
+        functions.register_handler("refunds", Mock(side_effect=RuntimeError))
+        functions.forward_queue.put("handler:refunds", {"id": 1})
+        self.assertEqual(functions.drain_forward_queue(), 0)
+        self.assertEqual(functions.forward_queue.size(), 1)
+
+
+class MemorySink:
+    def __init__(self):
+        self.spans = []
+        self.exports = 0
+
+    def span(self, name, started, seconds, labels, error):
+        self.spans.append((name, labels, error))
+
+    def export(self, metrics):
+        self.exports += 1
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.default_metrics = functions.metrics
+
+    def tearDown(self):
+        functions.metrics = self.default_metrics
+
+    def test_disabled_metrics_record_nothing(self):
+        metrics = functions.Metrics()
+        self.assertIs(metrics.span("verify_webhook"), functions.null_span)
+        with metrics.span("verify_webhook"):
+            pass
+        metrics.increment("webhooks")
+        self.assertEqual(metrics.snapshot(), {"counters": [], "histograms": []})
+
+    def test_spans_and_errors(self):
+        sink = MemorySink()
+        metrics = functions.Metrics(sink)
+        with metrics.span("forward", target="http"):
+            pass
+        with self.assertRaises(RuntimeError):
+            with metrics.span("forward", target="http"):
+                raise RuntimeError
+        histogram = metrics.snapshot()["histograms"][0]
+        self.assertEqual(histogram["count"], 2)
+        self.assertEqual(sum(histogram["buckets"]), 2)
+        self.assertEqual(metrics.snapshot()["counters"], [
+            {"name": "forward_errors", "labels": {"target": "http"}, "value": 1}
+        ])
+        self.assertEqual([error for _, _, error in sink.spans], [False, True])
+
+    def test_prometheus_text(self):
+        metrics = functions.Metrics(MemorySink())
+        metrics.record("verify_webhook", 0.002, {})
+        metrics.increment("webhooks", event="queued")
+        text = functions.render_prometheus(metrics)
+        self.assertIn('call_validator_webhooks_total{event="queued"} 1', text)
+        self.assertIn('call_validator_verify_webhook_seconds_bucket{le="0.0025"} 1', text)
+        self.assertIn('call_validator_verify_webhook_seconds_bucket{le="+Inf"} 1', text)
+        self.assertIn("call_validator_verify_webhook_seconds_count 1", text)
+
+    def test_json_sink(self):
+        stream = io.StringIO()
+        metrics = functions.Metrics(functions.JsonSink(stream))
+        with metrics.span("verify_webhook"):
+            pass
+        metrics.export()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([record["type"] for record in records], ["span", "metrics"])
+        self.assertEqual(records[0]["name"], "verify_webhook")
+
+    def test_unknown_sink_fails_at_startup(self):
+        with self.assertRaises(ValueError):
+            functions.build_metrics_sink("statsd")
+
+    @patch("functions.enqueue_forward")
+    def test_webhook_stages_are_traced(self, enqueue_forward):
+        sink = MemorySink()
+        functions.metrics = functions.Metrics(sink)
+        request = Mock()
+        request.get_data.return_value = b"{}"
+        request.headers = {"X-Shopify-Hmac-SHA256": "invalid"}
+        functions.call_validator(request)
+        self.assertEqual(
+            [name for name, _, _ in sink.spans],
+            ["verify_webhook", "call_validator"],
+        )
+
+    def test_disabled_overhead_benchmark(self):
+        rounds = 100000
+        for metrics in (functions.Metrics(), functions.Metrics(MemorySink())):
+            started = time.perf_counter()
+            for _ in range(rounds):
+                with metrics.span("verify_webhook"):
+                    pass
+            elapsed = time.perf_counter() - started
+            print("metrics {}: {:.2f} us per span".format(
+                "enabled" if metrics.sink else "disabled",
+                elapsed / rounds * 1000000,
+            ))
+
+
 if __name__ == "__main__":
     unittest.main()
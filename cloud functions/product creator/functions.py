@@ -1,14 +1,27 @@
+import atexit
 import base64
 import requests
+import hashlib
+import json
 import logging
+import threading
+import time
 import csv
+import gzip
+import io
+import functools
+import sys
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import date
-from os import environ
-from tempfile import NamedTemporaryFile
+from os import environ, replace
+from urllib.parse import urlsplit
 from flask import Response
 
 import shopify
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.cloud import error_reporting
 import mandrill
 
@@ -20,6 +33,39 @@ tahoe_sites = environ.get("tahoe_sites", "").split(",")
 tahoe_courses_api = environ.get("tahoe_courses_api", "")
 mandrill_password = environ.get("mandrill_password", "")
 environment = environ.get("env", "")
+tahoe_fetch_concurrency = int(environ.get("tahoe_fetch_concurrency", "8"))
+tahoe_parallel_pages = environ.get("tahoe_parallel_pages", "true") == "true"
+shopify_page_size = int(environ.get("shopify_page_size", "250"))
+shopify_create_backend = environ.get("shopify_create_backend", "rest")
+# Admin API version of the GraphQL endpoint, productSet needs 2024-04 or newer
+shopify_graphql_version = environ.get("shopify_graphql_version", "2025-10")
+shopify_graphql_batch_size = int(
+    environ.get("shopify_graphql_batch_size", "10")
+)
+sync_mode = environ.get("sync_mode", "full")
+# file, or module:factory of another store called with sync_state_file, it
+# needs load() and save(state) methods
+sync_state_backend = environ.get("sync_state_backend", "file")
+# the sync state must outlive instances, /tmp is wiped on every cold start
+sync_state_file = environ.get("sync_state_file", "")
+http_timeout = int(environ.get("http_timeout", "60"))
+http_pool_size = int(environ.get("http_pool_size", "10"))
+http_retries = int(environ.get("http_retries", "3"))
+http_backoff = float(environ.get("http_backoff", "0.5"))
+shopify_bucket_size = int(environ.get("shopify_bucket_size", "40"))
+shopify_leak_rate = float(environ.get("shopify_leak_rate", "2"))
+shopify_bucket_margin = int(environ.get("shopify_bucket_margin", "2"))
+shopify_max_retries = int(environ.get("shopify_max_retries", "5"))
+store_admin_ttl = int(environ.get("store_admin_ttl", "3600"))
+report_gzip = environ.get("report_gzip", "false") == "true"
+# size of the base64 content of one report attachment, bigger reports are
+# sent in several parts
+report_part_size = int(environ.get("report_part_size", str(5 * 1024 * 1024)))
+metrics_service = "product_creator"
+# json, prometheus or opentelemetry, metrics are off without a sink
+metrics_sink = environ.get("metrics_sink", "")
+metrics_path = environ.get("metrics_path", "")
+metrics_export_interval = float(environ.get("metrics_export_interval", "60"))
 
 try:
     if environment == "prod":
@@ -29,187 +75,978 @@ except Exception as e:
     logging.error(str(e))
 
 
+class NullSpan:
+    """Span used while metrics are disabled, it records nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+
+null_span = NullSpan()
+
+
+class Span:
+    """Times a block of code and records it into `metrics` when it exits"""
+
+    __slots__ = ("metrics", "name", "labels", "started", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.metrics.record(
+            self.name, time.perf_counter() - self.start, self.labels,
+            error_type is not None, self.started,
+        )
+        return False
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the function's stages, exported to
+    `sink` at most every `export_interval` seconds. Without a sink nothing
+    is recorded and span() returns a shared no-op span, so instrumentation
+    only costs a check.
+    """
+
+    buckets = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+    )
+
+    def __init__(self, sink=None, export_interval=60):
+        self.sink = sink
+        self.export_interval = export_interval
+        self.exported_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def span(self, name, **labels):
+        if self.sink is None:
+            return null_span
+        return Span(self, name, labels)
+
+    def increment(self, name, value=1, **labels):
+        if self.sink is None:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def record(self, name, seconds, labels, error=False, started=None):
+        """Record a finished span of `seconds`"""
+        if self.sink is None:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": [0] * (len(self.buckets) + 1),
+                    "count": 0,
+                    "sum": 0.0,
+                }
+            histogram["buckets"][bisect_left(self.buckets, seconds)] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            if error:
+                errors_key = (name + "_errors", key[1])
+                self.counters[errors_key] = self.counters.get(errors_key, 0) + 1
+        self.sink.span(
+            name, started or time.time() - seconds, seconds, labels, error
+        )
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    dict(histogram, name=name, labels=dict(labels),
+                         buckets=list(histogram["buckets"]))
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            }
+
+    def export(self, force=True):
+        """Export to the sink, unless `export_interval` didn't pass yet"""
+        if self.sink is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.exported_at < self.export_interval:
+            return
+        self.exported_at = now
+        try:
+            self.sink.export(self)
+        except Exception as e:
+            logging.error("Metrics export failed: {}".format(e))
+
+
+class JsonSink:
+    """Writes spans and metrics as JSON lines, Cloud Logging parses them"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+    def span(self, name, started, seconds, labels, error):
+        self.write({
+            "type": "span", "service": metrics_service, "name": name,
+            "start": started, "duration_ms": round(seconds * 1000, 3),
+            "labels": labels, "error": error,
+        })
+
+    def export(self, metrics):
+        self.write(dict(metrics.snapshot(), type="metrics", service=metrics_service))
+
+
+def render_prometheus(metrics):
+    """Return the metrics in Prometheus text exposition format"""
+    def series(name, labels, extra=()):
+        pairs = sorted(labels.items()) + list(extra)
+        if not pairs:
+            return name
+        return "{}{{{}}}".format(name, ",".join(
+            '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for key, value in pairs
+        ))
+
+    snapshot = metrics.snapshot()
+    lines = []
+    for counter in snapshot["counters"]:
+        name = "{}_{}_total".format(metrics_service, counter["name"])
+        lines.append("# TYPE {} counter".format(name))
+        lines.append("{} {}".format(series(name, counter["labels"]), counter["value"]))
+    for histogram in snapshot["histograms"]:
+        name = "{}_{}_seconds".format(metrics_service, histogram["name"])
+        lines.append("# TYPE {} histogram".format(name))
+        cumulative = 0
+        bounds = [str(bound) for bound in metrics.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, histogram["buckets"]):
+            cumulative += count
+            lines.append("{} {}".format(
+                series(name + "_bucket", histogram["labels"], [("le", bound)]),
+                cumulative,
+            ))
+        lines.append("{} {}".format(
+            series(name + "_sum", histogram["labels"]), histogram["sum"]
+        ))
+        lines.append("{} {}".format(
+            series(name + "_count", histogram["labels"]), histogram["count"]
+        ))
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusSink:
+    """Writes the metrics in Prometheus text format to `path` on export"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def span(self, name, started, seconds, labels, error):
+        pass
+
+    def export(self, metrics):
+        with open(self.path + ".tmp", "w") as metrics_file:
+            metrics_file.write(render_prometheus(metrics))
+        replace(self.path + ".tmp", self.path)
+
+
+class OpenTelemetrySink:
+    """
+    Sends spans and their durations to the OpenTelemetry API. It needs the
+    opentelemetry-api package, and an SDK configured in the process to
+    export them.
+    """
+
+    def __init__(self):
+        from opentelemetry import metrics as otel_metrics, trace
+        self.trace = trace
+        self.tracer = trace.get_tracer(metrics_service)
+        self.meter = otel_metrics.get_meter(metrics_service)
+        self.histograms = {}
+
+    def span(self, name, started, seconds, labels, error):
+        start_time = int(started * 1e9)
+        attributes = {key: str(value) for key, value in labels.items()}
+        span = self.tracer.start_span(
+            name, start_time=start_time, attributes=attributes
+        )
+        if error:
+            span.set_status(self.trace.Status(self.trace.StatusCode.ERROR))
+        span.end(end_time=start_time + int(seconds * 1e9))
+        if name not in self.histograms:
+            self.histograms[name] = self.meter.create_histogram(
+                name + "_seconds", unit="s"
+            )
+        self.histograms[name].record(seconds, attributes=attributes)
+
+    def export(self, metrics):
+        pass
+
+
+def build_metrics_sink(name):
+    if not name:
+        return None
+    if name == "json":
+        return JsonSink()
+    if name == "prometheus":
+        return PrometheusSink(
+            metrics_path or "/tmp/{}.prom".format(metrics_service)
+        )
+    if name == "opentelemetry":
+        return OpenTelemetrySink()
+    raise ValueError("Unknown metrics sink {!r}".format(name))
+
+
+metrics = Metrics(build_metrics_sink(metrics_sink), metrics_export_interval)
+atexit.register(metrics.export)
+
+
+def record_http_response(response, *args, **kwargs):
+    """requests response hook, records every HTTP call as a span"""
+    if metrics.sink is None:
+        return
+    metrics.record(
+        "http_request",
+        response.elapsed.total_seconds(),
+        {
+            "host": urlsplit(response.url).netloc,
+            "method": response.request.method,
+            "status": str(response.status_code),
+        },
+        error=response.status_code >= 500,
+    )
+
+
+def timed(name):
+    """Decorator recording every call of the function as a span"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+http_session = None
+http_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Return the shared requests Session. It is created on first use and kept
+    between warm invocations so calls to the same host reuse a pooled
+    keep-alive connection. Idempotent requests are retried with backoff on
+    connection errors, 429 and 5xx responses.
+    """
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            retry = Retry(
+                total=http_retries,
+                backoff_factor=http_backoff,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=http_pool_size,
+                pool_maxsize=http_pool_size,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.hooks["response"].append(record_http_response)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            http_session = session
+    return http_session
+
+
+class ShopifyScheduler:
+    """
+    Leaky bucket pacing Shopify Admin API calls just under the limit.
+    The bucket level leaks at `leak_rate` calls per second and is corrected
+    from the X-Shopify-Shop-Api-Call-Limit header after every call. A call
+    waits until the bucket has room below `size - margin`, a 429 response is
+    retried after its Retry-After header. GraphQL queries are paced apart,
+    on the query cost points reported by the cost extension of responses.
+    Waits are counted in `stats`.
+    """
+
+    def __init__(self, size, leak_rate, margin):
+        self.size = size
+        self.leak_rate = leak_rate
+        self.margin = margin
+        self.level = 0.0
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "waits": 0, "wait_seconds": 0.0, "throttled": 0}
+        # GraphQL points, unknown until the first response
+        self.points = None
+        self.points_size = None
+        self.restore_rate = None
+        self.points_updated_at = time.monotonic()
+
+    def leak(self):
+        now = time.monotonic()
+        self.level = max(0.0, self.level - (now - self.updated_at) * self.leak_rate)
+        self.updated_at = now
+
+    def acquire(self):
+        with self.lock:
+            self.leak()
+            wait_time = (self.level + 1 - (self.size - self.margin)) / self.leak_rate
+            wait_time = max(0.0, wait_time)
+            self.level += 1
+            self.stats["calls"] += 1
+            if wait_time:
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += wait_time
+        if wait_time:
+            time.sleep(wait_time)
+
+    def update(self, headers):
+        # headers of pyactiveresource responses and urllib errors
+        try:
+            call_limit = get_header(headers, "X-Shopify-Shop-Api-Call-Limit")
+            if not call_limit:
+                return
+            used, size = call_limit.split("/")
+            with self.lock:
+                self.level = float(used)
+                self.size = int(size)
+                self.updated_at = time.monotonic()
+        except (AttributeError, TypeError, ValueError):
+            return
+
+    def update_points(self, cost):
+        """Correct the GraphQL points from the cost extension of a response"""
+        try:
+            throttle_status = cost["throttleStatus"]
+            available = float(throttle_status["currentlyAvailable"])
+            size = float(throttle_status["maximumAvailable"])
+            restore_rate = float(throttle_status["restoreRate"])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            self.points = available
+            self.points_size = size
+            self.restore_rate = restore_rate
+            self.points_updated_at = time.monotonic()
+
+    def acquire_points(self, cost):
+        """Wait until the store has `cost` GraphQL points"""
+        with self.lock:
+            if self.points is None or not self.restore_rate:
+                return
+            now = time.monotonic()
+            self.points = min(
+                self.points_size,
+                self.points + (now - self.points_updated_at) * self.restore_rate,
+            )
+            self.points_updated_at = now
+            wait_time = max(0.0, (cost - self.points) / self.restore_rate)
+            self.points -= cost
+            if wait_time:
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += wait_time
+        if wait_time:
+            time.sleep(wait_time)
+
+    def call_graphql(self, execute, query, variables=None, cost=0):
+        """
+        Run a GraphQL query with `execute` once the store has `cost` points
+        for it and return the parsed response. A throttled query is retried
+        when the points it requested are restored.
+        """
+        attempt = 0
+        while True:
+            self.acquire_points(cost)
+            with metrics.span(
+                "shopify_call",
+                call=getattr(execute, "__qualname__", str(execute)),
+            ):
+                response = execute(query, variables)
+            query_cost = (response.get("extensions") or {}).get("cost") or {}
+            self.update_points(query_cost)
+            throttled = any(
+                isinstance(error, dict)
+                and (error.get("extensions") or {}).get("code") == "THROTTLED"
+                for error in response.get("errors") or []
+            )
+            if not throttled or attempt >= shopify_max_retries:
+                return response
+            attempt += 1
+            cost = query_cost.get("requestedQueryCost", cost)
+            with self.lock:
+                self.stats["throttled"] += 1
+            logging.warning(
+                "Shopify throttled the GraphQL query, retry with {} points".format(cost)
+            )
+
+    def call(self, function, *args, **kwargs):
+        """Call a Shopify API function when the bucket has room for it"""
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                with metrics.span(
+                    "shopify_call",
+                    call=getattr(function, "__qualname__", str(function)),
+                ):
+                    result = function(*args, **kwargs)
+            except Exception as e:
+                # pyactiveresource errors keep the HTTPError in `response`
+                response = getattr(e, "response", None)
+                if response is None:
+                    response = e
+                if getattr(response, "code", None) != 429:
+                    raise
+                if attempt >= shopify_max_retries:
+                    raise
+                attempt += 1
+                headers = getattr(response, "headers", None)
+                retry_after = float(get_header(headers, "Retry-After") or 2.0)
+                with self.lock:
+                    self.level = float(self.size)
+                    self.updated_at = time.monotonic()
+                    self.stats["throttled"] += 1
+                    self.stats["waits"] += 1
+                    self.stats["wait_seconds"] += retry_after
+                logging.warning("Shopify throttled the call, retry in {}s".format(
+                    retry_after
+                ))
+                time.sleep(retry_after)
+                continue
+            response = getattr(shopify.ShopifyResource.connection, "response", None)
+            self.update(getattr(response, "headers", None))
+            return result
+
+
+def get_header(headers, name):
+    if not headers:
+        return None
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+shopify_scheduler = ShopifyScheduler(
+    shopify_bucket_size, shopify_leak_rate, shopify_bucket_margin
+)
+
+
+store_admin = None
+store_admin_lock = threading.Lock()
+
+
+def get_store_admin():
+    """
+    Return (name, email) of the store admin. Shop.current() is only called
+    when the cached value is missing or older than `store_admin_ttl` seconds.
+    """
+    global store_admin
+    with store_admin_lock:
+        if store_admin is None or time.time() - store_admin[0] > store_admin_ttl:
+            store = shopify_scheduler.call(shopify.Shop.current)
+            store_admin = (time.time(), store.name, store.customer_email)
+        return store_admin[1], store_admin[2]
+
+
+def invalidate_store_admin():
+    global store_admin
+    with store_admin_lock:
+        store_admin = None
+
+
+def get_courses_page(url):
+    response_courses = get_session().get(url, timeout=http_timeout)
+    # Make sure Tahoe courses API is up
+    if not response_courses.ok:
+        msg = "Tahoe Courses API is inaccessible"
+        logging.error(msg)
+        if environment == "prod":
+            stackdriver_client.report_exception()
+        raise RuntimeError(msg)
+    return response_courses.json()
+
+
+def get_page_url(url, page):
+    separator = "&" if "?" in url else "?"
+    return "{}{}page={}".format(url, separator, page)
+
+
+def course_to_product(site, result):
+    return {
+        "product_title": result["name"],
+        "product_description": result["short_description"],
+        "product_sku": result["course_id"],
+        "product_image": result["media"]["image"].get("large", ""),
+        "product_tag": site,
+    }
+
+
+def iter_courses_pages(url):
+    """
+    Yield every page of Tahoe Courses API starting from `url` and follow
+    `pagination.next` until it is null. Each response is used both for its
+    courses and for the next page url, so every page is requested once.
+    """
+    while url:
+        response_json = get_courses_page(url)
+        yield response_json
+        url = response_json["pagination"].get("next")
+
+
+def fetch_tahoe_courses(sites, concurrency=None):
+    """
+    Fetch all pages of Tahoe Courses API of all sites concurrently and yield a
+    product dict for each course as soon as its page arrives.
+    Every site is walked with iter_courses_pages. If its first page reports
+    `num_pages` and `tahoe_parallel_pages` is on, the rest of the pages get
+    requested in parallel with `page` parameter instead.
+    """
+    concurrency = concurrency or tahoe_fetch_concurrency
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # future -> (site, pages iterator, is first page)
+        # pages iterator is None for pages requested in parallel
+        pending = {}
+        for site in sites:
+            pages = iter_courses_pages(site + tahoe_courses_api)
+            pending[executor.submit(next, pages, None)] = (site, pages, True)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                site, pages, first_page = pending.pop(future)
+                response_json = future.result()
+                if response_json is None:
+                    continue
+                number_pages = response_json["pagination"].get("num_pages")
+                if first_page and number_pages and tahoe_parallel_pages:
+                    courses_api_full_url = site + tahoe_courses_api
+                    for page in range(2, number_pages + 1):
+                        page_future = executor.submit(
+                            get_courses_page,
+                            get_page_url(courses_api_full_url, page)
+                        )
+                        pending[page_future] = (site, None, False)
+                elif pages is not None:
+                    pending[executor.submit(next, pages, None)] = (
+                        site, pages, False
+                    )
+                for result in response_json["results"]:
+                    yield course_to_product(site, result)
+
+
+@timed("tahoe_crawl")
 def get_tahoe_courses():
     """
     Get a list of all courses from Tahoe Courses API from one or more sites \\
     and create a list of shopify products based on existing courses and their
     metadata in Tahoe
     """
-
     shopify_products = []
-    # 1. Pull courses from Tahoe site(s)
-    # 1.1 Loop over Tahoe sites
-    for site in tahoe_sites:
-        response_courses = requests.get(site + tahoe_courses_api, timeout=60)
-        # 1.2 Make sure Tahoe courses API is up
-        if response_courses.ok:
-            number_pages = response_courses.json()["pagination"]["num_pages"]
-        else:
-            msg = "Tahoe Courses API is inaccessible"
-            logging.error(msg)
-            stackdriver_client.report_exception()
-            raise RuntimeError(msg)
-        # 1.3 Get url of courses api for next pages
-        courses_api_full_url = site + tahoe_courses_api
-        # 1.4 loop over all paginated reposnes
-        try:
-            while number_pages >= 1:
-                response_courses_paginated = requests.get(courses_api_full_url)
-                response_json = response_courses_paginated.json()
-                # 1.5 Loop over all courses on each page
-                for result in response_json["results"]:
-                    # 1.6 add item to products list based on courses metadata
-                    product_title = result["name"]
-                    product_description = result["short_description"]
-                    product_sku = result["course_id"]
-                    product_image = result["media"]["image"].get("large", "")
-                    product = {
-                        "product_title": product_title,
-                        "product_description": product_description,
-                        "product_sku": product_sku,
-                        "product_image": product_image,
-                        "product_tag": site,
-                    }
-                    shopify_products.append(product)
-                # 1.7 create next page url based on pagination next value
-                courses_api_full_url = response_json["pagination"]["next"]
-                number_pages -= 1
-        except Exception as e:
-            logging.error(e)
+    try:
+        for product in fetch_tahoe_courses(tahoe_sites):
+            shopify_products.append(product)
+    except RuntimeError:
+        raise
+    except Exception as e:
+        logging.error(e)
+        if environment == "prod":
             stackdriver_client.report_exception()
     return shopify_products
 
 
-def create_shopify_products(shopify_products):
+@timed("sku_index")
+def build_sku_index():
     """
-    Connect to shopify store, create products based on shopify_products dict
-    coming from get_tahoe_courses() function and notify admins about product
-    creation
+    Return a dict of every SKU in the store to its (product id, variant id).
+    Variants are read page by page with the biggest page size Shopify allows
+    so the number of requests only grows with store size / page size.
+    Iterating a page of the pinned ShopifyAPI doesn't fetch the next one,
+    every page is fetched once, by next_page() through the scheduler.
     """
-    try:
-        # connect to shopify store
-        shopify.ShopifyResource.set_site(shopify_store_admin_api)
-        store = shopify.Shop.current()
-        store_admin_name = store.name
-        store_admin_email = store.customer_email
-        # 1 Create products in store
-        # 1.1 find existing SKUs from shopify to checkproduct doesn't exist
-        variants = shopify.Variant.find()
-        # SKU in shopify is Course ID in OpenEDX
-        skus = []
-        number_created_products = 0
-        created_products_list = []
+    sku_index = {}
+    variants = shopify_scheduler.call(
+        shopify.Variant.find, limit=shopify_page_size
+    )
+    while True:
         for variant in variants:
-            # Fill SKUs list with all courses id that exist in shopify
-            skus.append(variant.sku)
-        # 1.2 loop over shopify_products and create store products
-        # shopify_products contains course metadata coming from OpenEDX
-        for product in shopify_products:
-            # 1.3 Check if the course already exist in store
-            # Remember product_sku = result["course_id"]
-            if not product["product_sku"] in skus:
-                # 1.4 create products in store
-                new_product = shopify.Product()
-                new_image = shopify.Image()
-                new_product.title = product["product_title"]
-                new_product.body_html = product["product_description"]
-                new_product.published = "false"
-                new_product.published_at = ""
-                # tag is site full URL
-                new_product.tags = product["product_tag"]
-                new_variant = shopify.Variant(
-                    {
-                        "sku": product["product_sku"],
-                        "requires_shipping": False,
-                        "inventory_policy": "deny",
-                    }
-                )
-                new_product.variants = [new_variant]
-                product_saved = new_product.save()
-                if product_saved:
-                    logging.info(
-                        "{}: {} created successfully".format(
-                            product["product_title"], product["product_sku"]
-                        )
-                    )
-                else:
-                    logging.error(
-                        "unexpected error happened for {}: {} creation".format(
-                            product["product_title"], product["product_sku"]
-                        )
-                    )
-                new_image.src = product["product_image"]
-                new_product.images = new_image
-                new_image.product_id = new_product.id
-                image_saved = new_image.save()
-                if not image_saved and not product["product_image"]:
-                    logging.error("{}: {} image didn't get saved")
-                number_created_products += 1
-                created_products_list.append(
-                    [
-                        product["product_title"],
-                        product["product_sku"],
-                        product["product_tag"],
-                        date.today().strftime("%m-%d-%Y"),
-                    ]
-                )
-            else:
-                continue
-        logging.info("{} product(s) created usccessfully".format(
-            number_created_products
+            if variant.sku:
+                sku_index[variant.sku] = (variant.product_id, variant.id)
+        if not variants.has_next_page():
+            break
+        variants = shopify_scheduler.call(variants.next_page)
+    return sku_index
+
+
+def create_product_rest(product, sku_index):
+    """
+    Create one product and its image with the REST API, return True if the
+    product got saved
+    """
+    new_product = shopify.Product()
+    new_image = shopify.Image()
+    new_product.title = product["product_title"]
+    new_product.body_html = product["product_description"]
+    new_product.published = "false"
+    new_product.published_at = ""
+    # tag is site full URL
+    new_product.tags = product["product_tag"]
+    new_variant = shopify.Variant(
+        {
+            "sku": product["product_sku"],
+            "requires_shipping": False,
+            "inventory_policy": "deny",
+        }
+    )
+    new_product.variants = [new_variant]
+    product_saved = shopify_scheduler.call(new_product.save)
+    if product_saved:
+        sku_index[product["product_sku"]] = (new_product.id, None)
+        logging.info(
+            "{}: {} created successfully".format(
+                product["product_title"], product["product_sku"]
             )
         )
-        # 2 Notify admins via email with created courses report
-        # 2.1 Create CSV file from created products
-        if number_created_products:
-            text = "Number of created products in shopify: {} ".format(
-                number_created_products
+    else:
+        logging.error(
+            "unexpected error happened for {}: {} creation".format(
+                product["product_title"], product["product_sku"]
             )
-            header = ["Product Name", "Product SKU", "Tahoe URL", "Created AT"]
-            fp = NamedTemporaryFile(
-                delete=False,
-                prefix="created_product_",
-                suffix=".csv",
-                mode="w",
-                dir="/tmp/",
+        )
+        return False
+    if product["product_image"]:
+        new_image.src = product["product_image"]
+        new_image.product_id = new_product.id
+        if not shopify_scheduler.call(new_image.save):
+            logging.error("{}: {} image didn't get saved".format(
+                product["product_title"], product["product_sku"]
+            ))
+    return True
+
+
+def execute_graphql(query, variables=None):
+    """
+    Run a GraphQL query against the store's Admin API and return the parsed
+    response. The private app password of `shopify_store_admin_api` is sent
+    as the access token, GraphQL doesn't accept it in the URL.
+    """
+    site = urlsplit(shopify_store_admin_api)
+    host = site.hostname if site.port is None else "{}:{}".format(
+        site.hostname, site.port
+    )
+    response = get_session().post(
+        "{}://{}/admin/api/{}/graphql.json".format(
+            site.scheme, host, shopify_graphql_version
+        ),
+        json={"query": query, "variables": variables},
+        headers={"X-Shopify-Access-Token": site.password or ""},
+        timeout=http_timeout,
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def get_graphql_id(gid):
+    # gid://shopify/Product/123 -> 123
+    return int(gid.rsplit("/", 1)[-1])
+
+
+@timed("create_products_graphql")
+def create_products_graphql(products, sku_index):
+    """
+    Create products with their variant and image in batches of
+    `shopify_graphql_batch_size` productSet mutations, one GraphQL request
+    per batch. If a batch fails as a whole its products are created with the
+    REST API instead. A batch waits for the query cost points the previous
+    batch needed per product. Return the created products.
+    """
+    created_products = []
+    product_cost = 0
+    for start in range(0, len(products), shopify_graphql_batch_size):
+        batch = products[start:start + shopify_graphql_batch_size]
+        arguments = []
+        mutations = []
+        variables = {}
+        for index, product in enumerate(batch):
+            arguments.append("$input{}: ProductSetInput!".format(index))
+            mutations.append(
+                "p{0}: productSet(input: $input{0}, synchronous: true) "
+                "{{ product {{ id variants(first: 1) {{ edges {{ node {{ id }} }} }} }} "
+                "userErrors {{ field message }} }}".format(index)
             )
-            writer = csv.writer(fp, quotechar='"', quoting=csv.QUOTE_ALL)
-            writer.writerow(header)
-            for created_product in created_products_list:
-                writer.writerow(created_product)
-            fp.flush()
-            fp.close()
-            data = open(fp.name, "rb").read()
-            message = {
-                "attachments": [
+            variables["input{}".format(index)] = {
+                "title": product["product_title"],
+                "descriptionHtml": product["product_description"],
+                # tag is site full URL
+                "tags": [product["product_tag"]],
+                "productOptions": [
+                    {"name": "Title", "values": [{"name": "Default Title"}]}
+                ],
+                "variants": [
                     {
-                        "content": base64.b64encode(data).decode("utf-8"),
-                        "name": fp.name.split("/")[2],
-                        "type": "text/csv",
+                        "optionValues": [
+                            {"optionName": "Title", "name": "Default Title"}
+                        ],
+                        "inventoryPolicy": "DENY",
+                        "inventoryItem": {
+                            "sku": product["product_sku"],
+                            "requiresShipping": False,
+                        },
                     }
                 ],
-                "from_email": "technical@appsembler.com",
-                "from_name": "Appsembler Technical Support",
-                "important": True,
-                "subject": "You'r Shopify product creation report",
-                "text": text,
-                "to": [
+                "files": [
                     {
-                        "email": store_admin_email,
-                        "name": store_admin_name,
-                        "type": "to",
-                    },
-                    {
-                        "email": "amir@appsembler.com",
-                        "name": "Amir Tadrisi",
-                        "type": "to",
-                    },
-                ],
+                        "originalSource": product["product_image"],
+                        "contentType": "IMAGE",
+                    }
+                ] if product["product_image"] else [],
             }
-            if environment == "prod":
+        query = "mutation CreateProducts({}) {{ {} }}".format(
+            ", ".join(arguments), " ".join(mutations)
+        )
+        try:
+            response = shopify_scheduler.call_graphql(
+                execute_graphql, query, variables, product_cost * len(batch)
+            )
+            query_cost = (response.get("extensions") or {}).get("cost") or {}
+            if query_cost.get("requestedQueryCost"):
+                product_cost = query_cost["requestedQueryCost"] / len(batch)
+            if response.get("errors"):
+                raise RuntimeError(response["errors"])
+            data = response["data"]
+        except Exception as e:
+            logging.error("GraphQL batch failed, using REST API: {}".format(e))
+            created_products.extend(
+                product for product in batch
+                if create_product_rest(product, sku_index)
+            )
+            continue
+        for index, product in enumerate(batch):
+            result = data.get("p{}".format(index)) or {}
+            if result.get("userErrors") or not result.get("product"):
+                logging.error("{}: {} creation failed: {}".format(
+                    product["product_title"],
+                    product["product_sku"],
+                    result.get("userErrors"),
+                ))
+                continue
+            variant_edges = result["product"]["variants"]["edges"]
+            sku_index[product["product_sku"]] = (
+                get_graphql_id(result["product"]["id"]),
+                get_graphql_id(variant_edges[0]["node"]["id"])
+                if variant_edges else None,
+            )
+            logging.info("{}: {} created successfully".format(
+                product["product_title"], product["product_sku"]
+            ))
+            created_products.append(product)
+    return created_products
+
+
+class Base64Writer(io.RawIOBase):
+    """
+    Writable stream which base64-encodes what's written to it into `output`
+    as it goes, so a report is never held both raw and encoded
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.pending = b""
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = len(data)
+        data = self.pending + bytes(data)
+        # base64 encodes 3 bytes at a time, the rest waits for the next write
+        cut = len(data) - len(data) % 3
+        self.output.write(base64.b64encode(data[:cut]))
+        self.pending = data[cut:]
+        return size
+
+    def close(self):
+        if not self.closed and self.pending:
+            self.output.write(base64.b64encode(self.pending))
+            self.pending = b""
+        super().close()
+
+
+def iter_report_attachments(rows, header, name, compress=False, part_size=None):
+    """
+    Stream CSV rows into base64 attachments built in memory, gzipped when
+    `compress` is set. A new part, with the header again, is started once
+    the encoded content of the current one reaches `part_size`.
+    """
+    part_size = part_size or report_part_size
+    rows = iter(rows)
+    part_number = 0
+    row = next(rows, None)
+    while row is not None or part_number == 0:
+        part_number += 1
+        output = io.BytesIO()
+        encoder = Base64Writer(output)
+        stream = gzip.GzipFile(fileobj=encoder, mode="wb") if compress else encoder
+        text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        writer = csv.writer(text, quotechar='"', quoting=csv.QUOTE_ALL)
+        writer.writerow(header)
+        written = 0
+        while row is not None:
+            writer.writerow(row)
+            row = next(rows, None)
+            written += 1
+            # the part size is checked every 100 rows to keep buffering
+            if written % 100 == 0:
+                text.flush()
+                if output.tell() >= part_size:
+                    break
+        text.close()
+        encoder.close()
+        yield {
+            "content": output.getvalue().decode("ascii"),
+            "name": "{}{}.csv{}".format(
+                name,
+                "" if row is None and part_number == 1
+                else "_part{}".format(part_number),
+                ".gz" if compress else "",
+            ),
+            "type": "application/gzip" if compress else "text/csv",
+        }
+
+
+@timed("creation_report")
+def send_creation_report(created_products, store_admin_name, store_admin_email):
+    """
+    Email the created products report to admins, one message per part of
+    the report
+    """
+    header = ["Product Name", "Product SKU", "Tahoe URL", "Created AT"]
+    created_at = date.today().strftime("%m-%d-%Y")
+    rows = (
+        [
+            product["product_title"],
+            product["product_sku"],
+            product["product_tag"],
+            created_at,
+        ]
+        for product in created_products
+    )
+    text = "Number of created products in shopify: {} ".format(
+        len(created_products)
+    )
+    attachments = iter_report_attachments(
+        rows, header, "created_products_" + created_at, report_gzip
+    )
+    for part_number, attachment in enumerate(attachments, 1):
+        subject = "You'r Shopify product creation report"
+        if "_part" in attachment["name"]:
+            subject += " (part {})".format(part_number)
+        message = {
+            "attachments": [attachment],
+            "from_email": "technical@appsembler.com",
+            "from_name": "Appsembler Technical Support",
+            "important": True,
+            "subject": subject,
+            "text": text,
+            "to": [
+                {
+                    "email": store_admin_email,
+                    "name": store_admin_name,
+                    "type": "to",
+                },
+                {
+                    "email": "amir@appsembler.com",
+                    "name": "Amir Tadrisi",
+                    "type": "to",
+                },
+            ],
+        }
+        if environment == "prod":
+            with metrics.span("email_send"):
                 mandrill_client.messages.send(message=message)
+
+
+@timed("create_shopify_products")
+def create_new_products(shopify_products, sku_index=None):
+    """
+    Create the products whose SKU isn't in the store yet and mail the
+    creation report to the store admin. Return the created products and the
+    ones which failed to get created.
+    """
+    # connect to shopify store
+    shopify.ShopifyResource.set_site(shopify_store_admin_api)
+    store_admin_name, store_admin_email = get_store_admin()
+    # 1 Create products in store
+    # 1.1 find existing SKUs from shopify to checkproduct doesn't exist
+    # SKU in shopify is Course ID in OpenEDX
+    if sku_index is None:
+        sku_index = build_sku_index()
+    # 1.2 loop over shopify_products and find the ones to create
+    # shopify_products contains course metadata coming from OpenEDX
+    new_products = []
+    for product in shopify_products:
+        # 1.3 Check if the course already exist in store
+        # Remember product_sku = result["course_id"]
+        if product["product_sku"] not in sku_index:
+            sku_index[product["product_sku"]] = (None, None)
+            new_products.append(product)
+    # 1.4 create products in store
+    if shopify_create_backend == "graphql":
+        created_products = create_products_graphql(new_products, sku_index)
+    else:
+        created_products = [
+            product for product in new_products
+            if create_product_rest(product, sku_index)
+        ]
+    created_ids = {id(product) for product in created_products}
+    failed_products = [
+        product for product in new_products if id(product) not in created_ids
+    ]
+    logging.info("{} product(s) created usccessfully, {} failed".format(
+        len(created_products), len(failed_products)
+        )
+    )
+    # 2 Notify admins via email with created courses report
+    if created_products:
+        send_creation_report(
+            created_products, store_admin_name, store_admin_email
+        )
+    return created_products, failed_products
+
+
+def create_shopify_products(shopify_products, sku_index=None):
+    """
+    Connect to shopify store, create products based on shopify_products dict
+    coming from get_tahoe_courses() function and notify admins about product
+    creation. sku_index can be passed if it's already built for this run.
+    """
+    try:
+        created_products, _ = create_new_products(shopify_products, sku_index)
         return Response(
-            "{} Product(s) got created".format(number_created_products),
+            "{} Product(s) got created".format(len(created_products)),
             status=201
         )
     except Exception as e:
@@ -218,6 +1055,191 @@ def create_shopify_products(shopify_products):
             stackdriver_client.report_exception()
 
 
+def product_hash(product):
+    content = "\n".join([
+        product["product_title"] or "",
+        product["product_description"] or "",
+        product["product_image"] or "",
+    ])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class FileSyncState:
+    """
+    Sync state kept in a JSON file. The file has to be on persistent
+    storage, like a mounted bucket, an instance which starts without it sees
+    every course as added and doesn't detect changed ones.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, state):
+        with open(self.path + ".tmp", "w") as state_file:
+            json.dump(state, state_file)
+        replace(self.path + ".tmp", self.path)
+
+
+def build_sync_state(backend):
+    if backend == "file":
+        if not sync_state_file:
+            raise ValueError(
+                "sync_mode=incremental needs sync_state_file on persistent "
+                "storage or another sync_state_backend"
+            )
+        if sync_state_file.startswith("/tmp/"):
+            logging.warning(
+                "{} is wiped on cold starts, the sync can't detect changed "
+                "courses".format(sync_state_file)
+            )
+        return FileSyncState(sync_state_file)
+    module_name, _, factory = backend.partition(":")
+    if not factory:
+        raise ValueError("Unknown sync state backend {!r}".format(backend))
+    import importlib
+    module = importlib.import_module(module_name)
+    return getattr(module, factory)(sync_state_file)
+
+
+def load_sync_state():
+    """
+    Return the watermark of the last sync, a dict of Tahoe site to a dict of
+    its course ids to their product_hash
+    """
+    return build_sync_state(sync_state_backend).load()
+
+
+def save_sync_state(state):
+    build_sync_state(sync_state_backend).save(state)
+
+
+def diff_catalog(shopify_products, state):
+    """
+    Compare crawled products with the last sync state and return added and
+    changed products, removed (site, sku) pairs and the new state
+    """
+    new_state = {site: {} for site in tahoe_sites}
+    added = []
+    changed = []
+    for product in shopify_products:
+        site = product["product_tag"]
+        sku = product["product_sku"]
+        new_hash = product_hash(product)
+        new_state.setdefault(site, {})[sku] = new_hash
+        old_hash = state.get(site, {}).get(sku)
+        if old_hash is None:
+            added.append(product)
+        elif old_hash != new_hash:
+            changed.append(product)
+    removed = [
+        (site, sku)
+        for site, skus in state.items() if site in new_state
+        for sku in skus if sku not in new_state[site]
+    ]
+    return added, changed, removed, new_state
+
+
+def update_shopify_products(changed, sku_index):
+    """
+    Update title, description and image of products whose course changed
+    """
+    for product in changed:
+        if product["product_sku"] not in sku_index:
+            continue
+        product_id = sku_index[product["product_sku"]][0]
+        shopify_product = shopify_scheduler.call(
+            shopify.Product.find, product_id
+        )
+        shopify_product.title = product["product_title"]
+        shopify_product.body_html = product["product_description"]
+        if product["product_image"]:
+            shopify_product.images = [shopify.Image({"src": product["product_image"]})]
+        for variant in shopify_product.variants:
+            variant.attributes.pop("inventory_quantity", None)
+            variant.attributes.pop("old_inventory_quantity", None)
+        shopify_scheduler.call(shopify_product.save)
+        logging.info("{}: {} updated successfully".format(
+            product["product_title"], product["product_sku"]
+        ))
+
+
+def unpublish_shopify_products(removed, sku_index):
+    """
+    Unpublish products whose course doesn't exist in Tahoe anymore
+    """
+    for site, sku in removed:
+        if sku not in sku_index:
+            continue
+        shopify_product = shopify_scheduler.call(
+            shopify.Product.find, sku_index[sku][0]
+        )
+        shopify_product.published = "false"
+        shopify_product.published_at = ""
+        for variant in shopify_product.variants:
+            variant.attributes.pop("inventory_quantity", None)
+            variant.attributes.pop("old_inventory_quantity", None)
+        shopify_scheduler.call(shopify_product.save)
+        logging.info("{} is removed from {} and got unpublished".format(
+            sku, site
+        ))
+
+
+@timed("sync_shopify_products")
+def sync_shopify_products():
+    """
+    Incremental sync, only courses which were added, changed or removed since
+    the last sync cause Shopify writes. The sync state is saved only if the
+    whole crawl and all updates went through, and courses which failed to
+    get created are left out of it, so a failed run is retried. The state
+    has to be kept on persistent storage, see build_sync_state.
+    """
+    state = load_sync_state()
+    shopify_products = list(fetch_tahoe_courses(tahoe_sites))
+    added, changed, removed, new_state = diff_catalog(shopify_products, state)
+    logging.info("{} added, {} changed, {} removed course(s)".format(
+        len(added), len(changed), len(removed)
+    ))
+    sku_index = None
+    if changed or removed:
+        shopify.ShopifyResource.set_site(shopify_store_admin_api)
+        sku_index = build_sku_index()
+        update_shopify_products(changed, sku_index)
+        unpublish_shopify_products(removed, sku_index)
+    failed = added
+    if added:
+        try:
+            _, failed = create_new_products(added, sku_index)
+        except Exception as e:
+            logging.error(e)
+            if environment == "prod":
+                stackdriver_client.report_exception()
+    # courses which didn't get created stay out of the state to be retried
+    for product in failed:
+        new_state[product["product_tag"]].pop(product["product_sku"], None)
+    save_sync_state(new_state)
+    return Response(
+        "{} added, {} changed, {} removed".format(
+            len(added), len(changed), len(removed)
+        ),
+        status=200
+    )
+
+
 def main(request):
-    tahoe_courses = get_tahoe_courses()
-    create_shopify_products(tahoe_courses)
+    try:
+        if sync_mode == "incremental":
+            return sync_shopify_products()
+        tahoe_courses = get_tahoe_courses()
+        response = create_shopify_products(tahoe_courses)
+        if response is None:
+            return Response("Product creation failed", status=500)
+        return response
+    finally:
+        metrics.export()
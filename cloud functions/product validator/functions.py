@@ -1,10 +1,23 @@
+import atexit
 import requests
 import logging
-from os import environ
+import signal
+import json
+import threading
+import time
+import functools
+import sys
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from os import environ, getpid, kill, replace
+from urllib.parse import urlsplit
 from flask import Response
 
 import shopify
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.cloud import error_reporting
 import mandrill
 
@@ -15,94 +28,1025 @@ tahoe_sites = environ.get("tahoe_sites", "").split(",")
 tahoe_courses_api = environ.get("tahoe_courses_api", "")
 mandrill_password = environ.get("mandrill_password", "")
 environment = environ.get("env", "")
+courses_cache_ttl = int(environ.get("courses_cache_ttl", "900"))
+courses_cache_max_sites = int(environ.get("courses_cache_max_sites", "50"))
+courses_cache_min_refresh = int(environ.get("courses_cache_min_refresh", "60"))
+courses_cache_file = environ.get("courses_cache_file", "")
+tahoe_fetch_concurrency = int(environ.get("tahoe_fetch_concurrency", "8"))
+tahoe_parallel_pages = environ.get("tahoe_parallel_pages", "true") == "true"
+http_timeout = int(environ.get("http_timeout", "60"))
+http_pool_size = int(environ.get("http_pool_size", "10"))
+http_retries = int(environ.get("http_retries", "3"))
+http_backoff = float(environ.get("http_backoff", "0.5"))
+shopify_bucket_size = int(environ.get("shopify_bucket_size", "40"))
+shopify_leak_rate = float(environ.get("shopify_leak_rate", "2"))
+shopify_bucket_margin = int(environ.get("shopify_bucket_margin", "2"))
+shopify_max_retries = int(environ.get("shopify_max_retries", "5"))
+store_admin_ttl = int(environ.get("store_admin_ttl", "3600"))
+notification_flush_interval = float(environ.get("notification_flush_interval", "5"))
+notification_digest_interval = float(environ.get("notification_digest_interval", "300"))
+# a function sends the notifications of a call before it answers, its
+# instance may get no CPU afterwards, the service sends them in the background
+notification_flush_on_return = environ.get("notification_flush_on_return", "true") == "true"
+metrics_service = "product_validator"
+# json, prometheus or opentelemetry, metrics are off without a sink
+metrics_sink = environ.get("metrics_sink", "")
+metrics_path = environ.get("metrics_path", "")
+metrics_export_interval = float(environ.get("metrics_export_interval", "60"))
 
 try:
     if environment == "prod":
-        mandrill_client = mandrill.Mandrill(mandrill_password)
         stackdriver_client = error_reporting.Client()
 except Exception as e:
     logging.error(str(e))
 
 
-# 1. Email notifier function
-def email_notifier(msg, subject, store_admin_email="", store_admin_name=""):
+class NullSpan:
+    """Span used while metrics are disabled, it records nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+
+null_span = NullSpan()
+
+
+class Span:
+    """Times a block of code and records it into `metrics` when it exits"""
+
+    __slots__ = ("metrics", "name", "labels", "started", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.metrics.record(
+            self.name, time.perf_counter() - self.start, self.labels,
+            error_type is not None, self.started,
+        )
+        return False
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the function's stages, exported to
+    `sink` at most every `export_interval` seconds. Without a sink nothing
+    is recorded and span() returns a shared no-op span, so instrumentation
+    only costs a check.
+    """
+
+    buckets = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+    )
+
+    def __init__(self, sink=None, export_interval=60):
+        self.sink = sink
+        self.export_interval = export_interval
+        self.exported_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def span(self, name, **labels):
+        if self.sink is None:
+            return null_span
+        return Span(self, name, labels)
+
+    def increment(self, name, value=1, **labels):
+        if self.sink is None:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def record(self, name, seconds, labels, error=False, started=None):
+        """Record a finished span of `seconds`"""
+        if self.sink is None:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": [0] * (len(self.buckets) + 1),
+                    "count": 0,
+                    "sum": 0.0,
+                }
+            histogram["buckets"][bisect_left(self.buckets, seconds)] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            if error:
+                errors_key = (name + "_errors", key[1])
+                self.counters[errors_key] = self.counters.get(errors_key, 0) + 1
+        self.sink.span(
+            name, started or time.time() - seconds, seconds, labels, error
+        )
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    dict(histogram, name=name, labels=dict(labels),
+                         buckets=list(histogram["buckets"]))
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            }
+
+    def export(self, force=True):
+        """Export to the sink, unless `export_interval` didn't pass yet"""
+        if self.sink is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.exported_at < self.export_interval:
+            return
+        self.exported_at = now
+        try:
+            self.sink.export(self)
+        except Exception as e:
+            logging.error("Metrics export failed: {}".format(e))
+
+
+class JsonSink:
+    """Writes spans and metrics as JSON lines, Cloud Logging parses them"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+    def span(self, name, started, seconds, labels, error):
+        self.write({
+            "type": "span", "service": metrics_service, "name": name,
+            "start": started, "duration_ms": round(seconds * 1000, 3),
+            "labels": labels, "error": error,
+        })
+
+    def export(self, metrics):
+        self.write(dict(metrics.snapshot(), type="metrics", service=metrics_service))
+
+
+def render_prometheus(metrics):
+    """Return the metrics in Prometheus text exposition format"""
+    def series(name, labels, extra=()):
+        pairs = sorted(labels.items()) + list(extra)
+        if not pairs:
+            return name
+        return "{}{{{}}}".format(name, ",".join(
+            '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for key, value in pairs
+        ))
+
+    snapshot = metrics.snapshot()
+    lines = []
+    for counter in snapshot["counters"]:
+        name = "{}_{}_total".format(metrics_service, counter["name"])
+        lines.append("# TYPE {} counter".format(name))
+        lines.append("{} {}".format(series(name, counter["labels"]), counter["value"]))
+    for histogram in snapshot["histograms"]:
+        name = "{}_{}_seconds".format(metrics_service, histogram["name"])
+        lines.append("# TYPE {} histogram".format(name))
+        cumulative = 0
+        bounds = [str(bound) for bound in metrics.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, histogram["buckets"]):
+            cumulative += count
+            lines.append("{} {}".format(
+                series(name + "_bucket", histogram["labels"], [("le", bound)]),
+                cumulative,
+            ))
+        lines.append("{} {}".format(
+            series(name + "_sum", histogram["labels"]), histogram["sum"]
+        ))
+        lines.append("{} {}".format(
+            series(name + "_count", histogram["labels"]), histogram["count"]
+        ))
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusSink:
+    """Writes the metrics in Prometheus text format to `path` on export"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def span(self, name, started, seconds, labels, error):
+        pass
+
+    def export(self, metrics):
+        with open(self.path + ".tmp", "w") as metrics_file:
+            metrics_file.write(render_prometheus(metrics))
+        replace(self.path + ".tmp", self.path)
+
+
+class OpenTelemetrySink:
+    """
+    Sends spans and their durations to the OpenTelemetry API. It needs the
+    opentelemetry-api package, and an SDK configured in the process to
+    export them.
+    """
+
+    def __init__(self):
+        from opentelemetry import metrics as otel_metrics, trace
+        self.trace = trace
+        self.tracer = trace.get_tracer(metrics_service)
+        self.meter = otel_metrics.get_meter(metrics_service)
+        self.histograms = {}
+
+    def span(self, name, started, seconds, labels, error):
+        start_time = int(started * 1e9)
+        attributes = {key: str(value) for key, value in labels.items()}
+        span = self.tracer.start_span(
+            name, start_time=start_time, attributes=attributes
+        )
+        if error:
+            span.set_status(self.trace.Status(self.trace.StatusCode.ERROR))
+        span.end(end_time=start_time + int(seconds * 1e9))
+        if name not in self.histograms:
+            self.histograms[name] = self.meter.create_histogram(
+                name + "_seconds", unit="s"
+            )
+        self.histograms[name].record(seconds, attributes=attributes)
+
+    def export(self, metrics):
+        pass
+
+
+def build_metrics_sink(name):
+    if not name:
+        return None
+    if name == "json":
+        return JsonSink()
+    if name == "prometheus":
+        return PrometheusSink(
+            metrics_path or "/tmp/{}.prom".format(metrics_service)
+        )
+    if name == "opentelemetry":
+        return OpenTelemetrySink()
+    raise ValueError("Unknown metrics sink {!r}".format(name))
+
+
+metrics = Metrics(build_metrics_sink(metrics_sink), metrics_export_interval)
+atexit.register(metrics.export)
+
+
+def record_http_response(response, *args, **kwargs):
+    """requests response hook, records every HTTP call as a span"""
+    if metrics.sink is None:
+        return
+    metrics.record(
+        "http_request",
+        response.elapsed.total_seconds(),
+        {
+            "host": urlsplit(response.url).netloc,
+            "method": response.request.method,
+            "status": str(response.status_code),
+        },
+        error=response.status_code >= 500,
+    )
+
+
+def timed(name):
+    """Decorator recording every call of the function as a span"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+http_session = None
+http_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Return the shared requests Session. It is created on first use and kept
+    between warm invocations so calls to the same host reuse a pooled
+    keep-alive connection. Idempotent requests are retried with backoff on
+    connection errors, 429 and 5xx responses.
+    """
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            retry = Retry(
+                total=http_retries,
+                backoff_factor=http_backoff,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=http_pool_size,
+                pool_maxsize=http_pool_size,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.hooks["response"].append(record_http_response)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            http_session = session
+    return http_session
+
+
+class ShopifyScheduler:
+    """
+    Leaky bucket pacing Shopify Admin API calls just under the limit.
+    The bucket level leaks at `leak_rate` calls per second and is corrected
+    from the X-Shopify-Shop-Api-Call-Limit header after every call. A call
+    waits until the bucket has room below `size - margin`, a 429 response is
+    retried after its Retry-After header. GraphQL queries are paced apart,
+    on the query cost points reported by the cost extension of responses.
+    Waits are counted in `stats`.
+    """
+
+    def __init__(self, size, leak_rate, margin):
+        self.size = size
+        self.leak_rate = leak_rate
+        self.margin = margin
+        self.level = 0.0
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "waits": 0, "wait_seconds": 0.0, "throttled": 0}
+        # GraphQL points, unknown until the first response
+        self.points = None
+        self.points_size = None
+        self.restore_rate = None
+        self.points_updated_at = time.monotonic()
+
+    def leak(self):
+        now = time.monotonic()
+        self.level = max(0.0, self.level - (now - self.updated_at) * self.leak_rate)
+        self.updated_at = now
+
+    def acquire(self):
+        with self.lock:
+            self.leak()
+            wait_time = (self.level + 1 - (self.size - self.margin)) / self.leak_rate
+            wait_time = max(0.0, wait_time)
+            self.level += 1
+            self.stats["calls"] += 1
+            if wait_time:
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += wait_time
+        if wait_time:
+            time.sleep(wait_time)
+
+    def update(self, headers):
+        # headers of pyactiveresource responses and urllib errors
+        try:
+            call_limit = get_header(headers, "X-Shopify-Shop-Api-Call-Limit")
+            if not call_limit:
+                return
+            used, size = call_limit.split("/")
+            with self.lock:
+                self.level = float(used)
+                self.size = int(size)
+                self.updated_at = time.monotonic()
+        except (AttributeError, TypeError, ValueError):
+            return
+
+    def update_points(self, cost):
+        """Correct the GraphQL points from the cost extension of a response"""
+        try:
+            throttle_status = cost["throttleStatus"]
+            available = float(throttle_status["currentlyAvailable"])
+            size = float(throttle_status["maximumAvailable"])
+            restore_rate = float(throttle_status["restoreRate"])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            self.points = available
+            self.points_size = size
+            self.restore_rate = restore_rate
+            self.points_updated_at = time.monotonic()
+
+    def acquire_points(self, cost):
+        """Wait until the store has `cost` GraphQL points"""
+        with self.lock:
+            if self.points is None or not self.restore_rate:
+                return
+            now = time.monotonic()
+            self.points = min(
+                self.points_size,
+                self.points + (now - self.points_updated_at) * self.restore_rate,
+            )
+            self.points_updated_at = now
+            wait_time = max(0.0, (cost - self.points) / self.restore_rate)
+            self.points -= cost
+            if wait_time:
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += wait_time
+        if wait_time:
+            time.sleep(wait_time)
+
+    def call_graphql(self, execute, query, variables=None, cost=0):
+        """
+        Run a GraphQL query with `execute` once the store has `cost` points
+        for it and return the parsed response. A throttled query is retried
+        when the points it requested are restored.
+        """
+        attempt = 0
+        while True:
+            self.acquire_points(cost)
+            with metrics.span(
+                "shopify_call",
+                call=getattr(execute, "__qualname__", str(execute)),
+            ):
+                response = execute(query, variables)
+            query_cost = (response.get("extensions") or {}).get("cost") or {}
+            self.update_points(query_cost)
+            throttled = any(
+                isinstance(error, dict)
+                and (error.get("extensions") or {}).get("code") == "THROTTLED"
+                for error in response.get("errors") or []
+            )
+            if not throttled or attempt >= shopify_max_retries:
+                return response
+            attempt += 1
+            cost = query_cost.get("requestedQueryCost", cost)
+            with self.lock:
+                self.stats["throttled"] += 1
+            logging.warning(
+                "Shopify throttled the GraphQL query, retry with {} points".format(cost)
+            )
+
+    def call(self, function, *args, **kwargs):
+        """Call a Shopify API function when the bucket has room for it"""
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                with metrics.span(
+                    "shopify_call",
+                    call=getattr(function, "__qualname__", str(function)),
+                ):
+                    result = function(*args, **kwargs)
+            except Exception as e:
+                # pyactiveresource errors keep the HTTPError in `response`
+                response = getattr(e, "response", None)
+                if response is None:
+                    response = e
+                if getattr(response, "code", None) != 429:
+                    raise
+                if attempt >= shopify_max_retries:
+                    raise
+                attempt += 1
+                headers = getattr(response, "headers", None)
+                retry_after = float(get_header(headers, "Retry-After") or 2.0)
+                with self.lock:
+                    self.level = float(self.size)
+                    self.updated_at = time.monotonic()
+                    self.stats["throttled"] += 1
+                    self.stats["waits"] += 1
+                    self.stats["wait_seconds"] += retry_after
+                logging.warning("Shopify throttled the call, retry in {}s".format(
+                    retry_after
+                ))
+                time.sleep(retry_after)
+                continue
+            response = getattr(shopify.ShopifyResource.connection, "response", None)
+            self.update(getattr(response, "headers", None))
+            return result
+
+
+def get_header(headers, name):
+    if not headers:
+        return None
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+shopify_scheduler = ShopifyScheduler(
+    shopify_bucket_size, shopify_leak_rate, shopify_bucket_margin
+)
+
+
+store_admin = None
+store_admin_lock = threading.Lock()
+
+
+def get_store_admin():
+    """
+    Return (name, email) of the store admin. Shop.current() is only called
+    when the cached value is missing or older than `store_admin_ttl` seconds.
+    """
+    global store_admin
+    with store_admin_lock:
+        if store_admin is None or time.time() - store_admin[0] > store_admin_ttl:
+            store = shopify_scheduler.call(shopify.Shop.current)
+            store_admin = (time.time(), store.name, store.customer_email)
+        return store_admin[1], store_admin[2]
+
+
+def invalidate_store_admin():
+    global store_admin
+    with store_admin_lock:
+        store_admin = None
+
+
+class CoursesCache:
+    """
+        Course ids of every Tahoe site, kept in memory between warm
+        invocations. Entries expire after `ttl` seconds and the least recently
+        used site is dropped when there are more than `max_sites` sites.
+        If `path` is given the cache is saved to that file after each refresh
+        and loaded back on a cold start.
+    """
+
+    def __init__(self, ttl, max_sites, path=""):
+        self.ttl = ttl
+        self.max_sites = max_sites
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0}
+        if path:
+            self.load()
+
+    def age(self, site):
+        entry = self.entries.get(site)
+        if entry is None:
+            return float("inf")
+        return time.time() - entry[0]
+
+    def get(self, site):
+        """Return the course ids of a site or None if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(site)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return None
+            self.entries.move_to_end(site)
+            return entry[1]
+
+    def entry(self, site):
+        """Return (fetched_at, course ids) of a site, even if expired"""
+        with self.lock:
+            return self.entries.get(site)
+
+    def put(self, site, courses_ids, fetched_at=None):
+        with self.lock:
+            self.entries[site] = (fetched_at or time.time(), frozenset(courses_ids))
+            self.entries.move_to_end(site)
+            while len(self.entries) > self.max_sites:
+                self.entries.popitem(last=False)
+            self.stats["refreshes"] += 1
+        if self.path:
+            self.save()
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        for site, (fetched_at, courses_ids) in data.items():
+            self.entries[site] = (fetched_at, frozenset(courses_ids))
+
+    def save(self):
+        with self.lock:
+            data = {
+                site: [fetched_at, sorted(courses_ids)]
+                for site, (fetched_at, courses_ids) in self.entries.items()
+            }
+        try:
+            with open(self.path + ".tmp", "w") as cache_file:
+                json.dump(data, cache_file)
+            replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logging.error(str(e))
+
+
+courses_cache = CoursesCache(
+    courses_cache_ttl, courses_cache_max_sites, courses_cache_file
+)
+# site -> Future of the course ids of its crawl in progress
+courses_refreshes = {}
+courses_refreshes_lock = threading.Lock()
+
+
+support_recipient = {
+    "email": "amir@appsembler.com", "name": "Amir Tadrisi", "type": "to"
+}
+
+
+class MandrillTransport:
+    """Sends messages with Mandrill, the client is created on first send"""
+
+    def __init__(self, password):
+        self.password = password
+        self.client = None
+
+    def send(self, message):
+        if self.client is None:
+            self.client = mandrill.Mandrill(self.password)
+        self.client.messages.send(message=message)
+
+
+class MemoryTransport:
+    """Keeps messages in `sent` instead of sending them, for tests and dev"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+class NotificationOutbox:
+    """
+    Queues email notifications and sends them from a background worker, so
+    webhooks never wait for the mail provider. Notifications of one group,
+    like an order, are coalesced into a single message which is sent when
+    the group is closed or `flush_interval` seconds after its first
+    notification. Digest notifications are rolled into one message per
+    subject every `digest_interval` seconds. Without `background` messages
+    are only sent by flush.
+    """
+
+    def __init__(self, transport, flush_interval=5, digest_interval=300,
+                 background=True):
+        self.transport = transport
+        self.background = background
+        self.flush_interval = flush_interval
+        self.digest_interval = digest_interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.groups = OrderedDict()
+        self.digests = OrderedDict()
+        self.digest_started = time.monotonic()
+        self.worker = None
+        self.sent = 0
+
+    def notify(self, msg, subject, store_admin_email="", store_admin_name="",
+               group=None, digest=False):
+        with self.lock:
+            if digest:
+                self.digests.setdefault(subject, []).append(msg)
+            else:
+                key = (group if group is not None else object(), store_admin_email)
+                if key not in self.groups:
+                    self.groups[key] = {
+                        "created": time.monotonic(),
+                        "subjects": [],
+                        "lines": [],
+                        "store_admin": (store_admin_email, store_admin_name),
+                        "closed": group is None,
+                    }
+                pending = self.groups[key]
+                if subject not in pending["subjects"]:
+                    pending["subjects"].append(subject)
+                pending["lines"].append(msg)
+            self.start_worker()
+        if group is None and not digest:
+            self.wakeup.set()
+
+    def close(self, group):
+        """Send the messages of a group without waiting for its interval"""
+        with self.lock:
+            for key, pending in self.groups.items():
+                if key[0] == group:
+                    pending["closed"] = True
+        self.wakeup.set()
+
+    def start_worker(self):
+        if not self.background:
+            return
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(timeout=min(self.flush_interval, self.digest_interval))
+            self.wakeup.clear()
+            self.flush(force=False)
+
+    def take_due(self, force):
+        now = time.monotonic()
+        with self.lock:
+            due = [
+                key for key, pending in self.groups.items()
+                if force or pending["closed"]
+                or now - pending["created"] >= self.flush_interval
+            ]
+            groups = [self.groups.pop(key) for key in due]
+            digests = []
+            if self.digests and (
+                force or now - self.digest_started >= self.digest_interval
+            ):
+                digests = list(self.digests.items())
+                self.digests.clear()
+                self.digest_started = now
+        return groups, digests
+
+    def flush(self, force=True):
+        """Send due messages, or all of them with `force`, return the count"""
+        groups, digests = self.take_due(force)
+        messages = [
+            build_message(
+                " / ".join(pending["subjects"]),
+                "\n\n".join(pending["lines"]),
+                *pending["store_admin"]
+            )
+            for pending in groups
+        ]
+        messages += [
+            build_message(
+                "{} digest ({} events)".format(subject, len(lines)),
+                "\n".join(lines),
+            )
+            for subject, lines in digests
+        ]
+        for message in messages:
+            try:
+                with metrics.span("email_send"):
+                    self.transport.send(message)
+                with self.lock:
+                    self.sent += 1
+            except Exception as e:
+                logging.error("Notification {} wasn't sent: {}".format(
+                    message["subject"], e
+                ))
+        return len(messages)
+
+
+def build_message(subject, text, store_admin_email="", store_admin_name=""):
     message = {
         "from_email": "technical@appsembler.com",
         "from_name": "Appsembler Technical Support",
         "important": True,
         "subject": subject,
-        "text": msg,
-        "to": [
-            {
-                "email": "amir@appsembler.com",
-                "name": "Amir Tadrisi",
-                "type": "to"
-            }
-        ]
+        "text": text,
+        "to": [dict(support_recipient)],
     }
     if store_admin_email:
         message["to"].append(
             {"email": store_admin_email, "name": store_admin_name, "type": "to"}
         )
-    mandrill_client.messages.send(message=message)
+    return message
+
+
+notification_outbox = NotificationOutbox(
+    MandrillTransport(mandrill_password) if environment == "prod"
+    else MemoryTransport(),
+    notification_flush_interval,
+    notification_digest_interval,
+)
+atexit.register(notification_outbox.flush)
+
+
+def flush_notifications_on_sigterm(signum, frame):
+    """
+    Send the queued notifications before the instance is shut down, atexit
+    handlers don't run on SIGTERM. The previous handler runs afterwards.
+    """
+    notification_outbox.flush()
+    if callable(previous_sigterm_handler):
+        previous_sigterm_handler(signum, frame)
+    elif previous_sigterm_handler != signal.SIG_IGN:
+        signal.signal(signum, signal.SIG_DFL)
+        kill(getpid(), signum)
 
 
+previous_sigterm_handler = signal.getsignal(signal.SIGTERM)
+try:
+    signal.signal(signal.SIGTERM, flush_notifications_on_sigterm)
+except ValueError:
+    # handlers can only be installed from the main thread
+    logging.warning("Notifications won't be flushed on SIGTERM")
+
+
+# 1. Email notifier function
+def email_notifier(msg, subject, store_admin_email="", store_admin_name="",
+                   group=None, digest=False):
+    """
+    Queue a notification in the outbox. Notifications with the same `group`
+    are sent as one message, `digest` ones are sent in periodic digests.
+    """
+    notification_outbox.notify(
+        msg, subject, store_admin_email, store_admin_name, group, digest
+    )
+
+
+# 2. Get course ids of Tahoe sites
+def get_courses_page(url):
+    response_courses = get_session().get(url, timeout=http_timeout)
+    # Make sure Tahoe courses API is up
+    if not response_courses.ok:
+        msg = "Tahoe Courses API is inaccessible"
+        logging.error(msg)
+        if environment == "prod":
+            stackdriver_client.report_exception()
+        raise RuntimeError(msg)
+    return response_courses.json()
+
+
+def get_page_url(url, page):
+    separator = "&" if "?" in url else "?"
+    return "{}{}page={}".format(url, separator, page)
+
+
+def course_to_product(site, result):
+    return {
+        "product_title": result["name"],
+        "product_description": result["short_description"],
+        "product_sku": result["course_id"],
+        "product_image": result["media"]["image"].get("large", ""),
+        "product_tag": site,
+    }
+
+
+def iter_courses_pages(url):
+    """
+    Yield every page of Tahoe Courses API starting from `url` and follow
+    `pagination.next` until it is null. Each response is used both for its
+    courses and for the next page url, so every page is requested once.
+    """
+    while url:
+        response_json = get_courses_page(url)
+        yield response_json
+        url = response_json["pagination"].get("next")
+
+
+def fetch_tahoe_courses(sites, concurrency=None):
+    """
+    Fetch all pages of Tahoe Courses API of all sites concurrently and yield a
+    product dict for each course as soon as its page arrives.
+    Every site is walked with iter_courses_pages. If its first page reports
+    `num_pages` and `tahoe_parallel_pages` is on, the rest of the pages get
+    requested in parallel with `page` parameter instead.
+    """
+    concurrency = concurrency or tahoe_fetch_concurrency
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # future -> (site, pages iterator, is first page)
+        # pages iterator is None for pages requested in parallel
+        pending = {}
+        for site in sites:
+            pages = iter_courses_pages(site + tahoe_courses_api)
+            pending[executor.submit(next, pages, None)] = (site, pages, True)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                site, pages, first_page = pending.pop(future)
+                response_json = future.result()
+                if response_json is None:
+                    continue
+                number_pages = response_json["pagination"].get("num_pages")
+                if first_page and number_pages and tahoe_parallel_pages:
+                    courses_api_full_url = site + tahoe_courses_api
+                    for page in range(2, number_pages + 1):
+                        page_future = executor.submit(
+                            get_courses_page,
+                            get_page_url(courses_api_full_url, page)
+                        )
+                        pending[page_future] = (site, None, False)
+                elif pages is not None:
+                    pending[executor.submit(next, pages, None)] = (
+                        site, pages, False
+                    )
+                for result in response_json["results"]:
+                    yield course_to_product(site, result)
+
+
+def normalize_site_url(site_url):
+    """
+    Normalize a Tahoe site URL so product tags and configured sites match,
+    https is assumed when the scheme is missing
+    """
+    site_url = site_url.strip()
+    if not site_url:
+        return ""
+    if "://" not in site_url:
+        site_url = "https://" + site_url
+    parts = urlsplit(site_url)
+    return "{}://{}{}".format(
+        parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/")
+    )
+
+
+def refresh_stale_sites(sites):
+    """
+    Crawl again the sites which weren't refreshed in the last
+    `courses_cache_min_refresh` seconds and cache their course ids. A site
+    which is already being crawled isn't crawled twice, concurrent misses
+    wait for the same crawl. Return a dict of site to its new course ids.
+    """
+    crawled = {}
+    shared = {}
+    with courses_refreshes_lock:
+        for site in sites:
+            if site in courses_refreshes:
+                shared[site] = courses_refreshes[site]
+            elif courses_cache.age(site) >= courses_cache_min_refresh:
+                crawled[site] = courses_refreshes[site] = Future()
+    try:
+        sites_courses_ids = {site: [] for site in crawled}
+        for product in fetch_tahoe_courses(list(crawled)):
+            sites_courses_ids[product["product_tag"]].append(product["product_sku"])
+        for site, courses_ids in sites_courses_ids.items():
+            courses_cache.put(site, courses_ids)
+            crawled[site].set_result(frozenset(courses_ids))
+    except Exception as e:
+        for future in crawled.values():
+            if not future.done():
+                future.set_exception(e)
+        raise
+    finally:
+        with courses_refreshes_lock:
+            for site in crawled:
+                del courses_refreshes[site]
+    return {
+        site: future.result()
+        for site, future in list(crawled.items()) + list(shared.items())
+    }
+
+
+@timed("course_exists")
+def course_exists(sku):
+    """
+        Check if the SKU is a course id in any of the Tahoe sites. Cached
+        course ids are checked first, on a miss only the sites which weren't
+        refreshed in the last `courses_cache_min_refresh` seconds are crawled
+        again so a newly created course is still found. Sites are cached
+        under their normalized URL, like the purchase listener does, so both
+        can share the cache.
+    """
+    sites = [normalize_site_url(site) for site in tahoe_sites]
+    for site in sites:
+        courses_ids = courses_cache.get(site)
+        if courses_ids is not None and sku in courses_ids:
+            courses_cache.count("hits")
+            return True
+    courses_cache.count("misses")
+    sites_courses_ids = refresh_stale_sites(sites)
+    return any(sku in courses_ids for courses_ids in sites_courses_ids.values())
+
+
+@timed("shopify_product_validator")
 def shopify_product_validator(request):
     """
         This Function unpublishes a created/updated product in shopify if
         the product SKU is not valid course id or if the course doesn't exist.
-        It recieves a call from shopify webhook, Loops over all specified
-        Tahoe Sites, Gets a list of courses ids and checks if the SKU of 
-        created/Updated Product(it is in request object) is in the list of all
-        courses ids if not that product gets unpublished in shopify.
+        It recieves a call from shopify webhook and checks if the SKU of
+        created/Updated Product(it is in request object) is in the cached
+        courses ids of specified Tahoe Sites, the sites get crawled again only
+        if the SKU isn't found. If not that product gets unpublished in
+        shopify.
     """
-    # 1 Get a list of all existing course ids in specified Tahoe sites
-    # 1.1 Loop over all specified Tahoe sites
     try:
-        courses_ids = []
         shopify.ShopifyResource.set_site(shopify_store_admin_api)
-        store = shopify.Shop.current()
-        store_admin_name = store.name
-        store_admin_email = store.customer_email
-        for site in tahoe_sites:
-            response_courses = requests.get(site + tahoe_courses_api, timeout=120)
-            if response_courses.ok:
-                number_pages = response_courses.json()["pagination"]["num_pages"]
-            else:
-                msg = "Tahoe Courses API is inaccessible"
-                logging.error(msg)
-                if environment == "prod":
-                    stackdriver_client.report_exception()
-                raise RuntimeError(msg)
-            courses_api_full_url = site + tahoe_courses_api
-            while number_pages >= 1:
-                response_courses_paginated = requests.get(courses_api_full_url)
-                response_json = response_courses_paginated.json()
-                # 1.2 Loop over all courses on each page
-                for result in response_json["results"]:
-                    # 1.3 add item to courses id
-                    courses_ids.append(result["course_id"])
-                # 1.4 create next page url based on pagination next value
-                courses_api_full_url = response_json["pagination"]["next"]
-                number_pages -= 1
+        store_admin_name, store_admin_email = get_store_admin()
         # 2 Make sure Shopify SKU is a valid course id
         # 2.1 reterieve sku from request object from shopify webhook request
         request_json = request.get_json()
         sku = request_json["variants"][0]["sku"]
-        if sku not in courses_ids:
+        sku_is_valid = course_exists(sku)
+        logging.info("Courses cache stats: {}".format(courses_cache.stats))
+        if not sku_is_valid:
             logging.error("Course {sku} doesn't exist".format(sku=sku))
             # 2.2 unpublish the product in Shopify
             # 2.2.1 Find the product in our store
             product_id = request_json["id"]
             if environment == "prod":
-                invalid_product = shopify.Product.find(product_id)
+                invalid_product = shopify_scheduler.call(
+                    shopify.Product.find, product_id
+                )
                 title = invalid_product.title
                 invalid_product.published = "false"
                 invalid_product.published_at = ""
                 invalid_variant = invalid_product.variants[0]
                 del invalid_variant.attributes["inventory_quantity"]
                 del invalid_variant.attributes["old_inventory_quantity"]
-                invalid_product.save()
+                shopify_scheduler.call(invalid_product.save)
                 # 2.3 Notify admin by Email
                 msg = "You tried to update or create the '{}' in Shopify".format(
                     title
@@ -114,11 +1058,12 @@ def shopify_product_validator(request):
                 )
                 email_notifier(
                     msg,
+                    "Invalid Course ID - Shopify call validator",
                     store_admin_email,
                     store_admin_name,
-                    "Invalid Course ID - Shopify call validator"
                 )
-            return Response("SKU wasn't valid", status=409)
+            # the product got unpublished, the webhook is handled
+            return Response("SKU wasn't valid", status=200)
         return Response("SKU is valid", status=200)
     except Exception as e:
         logging.error(str(e))
@@ -126,6 +1071,15 @@ def shopify_product_validator(request):
             stackdriver_client.report_exception()
 
 
-# 3. Run main function
+# 4. Run main function
 def main(request):
-    shopify_product_validator(request)
+    try:
+        response = shopify_product_validator(request)
+        if response is None:
+            # it failed before answering, a 500 has the call retried
+            return Response("Product validation failed", status=500)
+        return response
+    finally:
+        if notification_flush_on_return:
+            notification_outbox.flush(force=False)
+        metrics.export(force=False)
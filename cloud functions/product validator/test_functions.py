@@ -1,6 +1,10 @@
 import json
+import os
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 from os import environ
 
 import functions
@@ -237,5 +241,225 @@ class ProductValidatorTests(unittest.TestCase):
         self.assertEqual(result.response[0].decode(), "SKU wasn't valid")
 
 
+class StoreAdminTests(unittest.TestCase):
+    def setUp(self):
+        functions.invalidate_store_admin()
+
+    @patch("functions.shopify")
+    def test_store_is_fetched_once(self, shopify):
+        shopify.Shop.current.return_value = Mock(
+            customer_email="admin@store.com"
+        )
+        shopify.Shop.current.return_value.name = "Admin"
+        self.assertEqual(
+            functions.get_store_admin(), ("Admin", "admin@store.com")
+        )
+        functions.get_store_admin()
+        self.assertEqual(shopify.Shop.current.call_count, 1)
+        functions.invalidate_store_admin()
+        functions.get_store_admin()
+        self.assertEqual(shopify.Shop.current.call_count, 2)
+
+    @patch("functions.shopify")
+    def test_expired_store_is_fetched_again(self, shopify):
+        functions.get_store_admin()
+        functions.store_admin = (0, "Admin", "admin@store.com")
+        functions.get_store_admin()
+        self.assertEqual(shopify.Shop.current.call_count, 2)
+
+
+def courses_page(courses_ids, next_url=None, num_pages=1):
+    response = Mock()
+    response.ok = True
+    response.json.return_value = {
+        "results": [
+            {
+                "course_id": course_id,
+                "name": course_id,
+                "short_description": "",
+                "media": {"image": {}},
+            }
+            for course_id in courses_ids
+        ],
+        "pagination": {"next": next_url, "num_pages": num_pages},
+    }
+    return response
+
+
+class CoursesCacheTests(unittest.TestCase):
+    def setUp(self):
+        functions.environment = "test"
+        functions.tahoe_sites = ["https://site-a.tahoe.com"]
+        functions.tahoe_courses_api = "/api/courses/v1/courses/"
+        functions.courses_cache = functions.CoursesCache(900, 50)
+        functions.courses_cache_min_refresh = 60
+
+    @patch("functions.get_session")
+    def test_cached_sku_doesnt_crawl_again(self, get_session):
+        get = get_session.return_value.get
+        get.return_value = courses_page(["course-v1:a+b+c"])
+        self.assertTrue(functions.course_exists("course-v1:a+b+c"))
+        calls = get.call_count
+        self.assertTrue(functions.course_exists("course-v1:a+b+c"))
+        self.assertEqual(get.call_count, calls)
+        self.assertEqual(functions.courses_cache.stats["hits"], 1)
+        self.assertEqual(functions.courses_cache.stats["misses"], 1)
+        self.assertEqual(functions.courses_cache.stats["refreshes"], 1)
+
+    @patch("functions.get_session")
+    def test_unknown_sku_doesnt_refresh_recent_site(self, get_session):
+        get = get_session.return_value.get
+        get.return_value = courses_page(["course-v1:a+b+c"])
+        self.assertFalse(functions.course_exists("invalid course id"))
+        calls = get.call_count
+        self.assertFalse(functions.course_exists("invalid course id"))
+        self.assertEqual(get.call_count, calls)
+
+    @patch("functions.get_session")
+    def test_concurrent_misses_share_one_crawl(self, get_session):
+        functions.courses_cache_min_refresh = 0
+        started = threading.Event()
+
+        def slow_get(*args, **kwargs):
+            started.set()
+            time.sleep(0.2)
+            return courses_page(["course-v1:a+b+c"])
+
+        get_session.return_value.get.side_effect = slow_get
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(
+                functions.course_exists("course-v1:a+b+c")
+            ))
+            for _ in range(20)
+        ]
+        threads[0].start()
+        started.wait(1)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 20)
+        self.assertEqual(get_session.return_value.get.call_count, 1)
+        self.assertEqual(functions.courses_refreshes, {})
+
+    @patch("functions.get_session")
+    def test_failed_crawl_fails_waiting_misses(self, get_session):
+        get_session.return_value.get.side_effect = ConnectionError("down")
+        with self.assertRaises(ConnectionError):
+            functions.course_exists("course-v1:a+b+c")
+        self.assertEqual(functions.courses_refreshes, {})
+
+    def test_expired_site_is_not_returned(self):
+        functions.courses_cache.put("https://site-a.tahoe.com", ["x"], 1)
+        self.assertIsNone(functions.courses_cache.get("https://site-a.tahoe.com"))
+
+    def test_least_recently_used_site_is_evicted(self):
+        cache = functions.CoursesCache(900, 2)
+        cache.put("https://site-a.tahoe.com", ["a"])
+        cache.put("https://site-b.tahoe.com", ["b"])
+        cache.get("https://site-a.tahoe.com")
+        cache.put("https://site-c.tahoe.com", ["c"])
+        self.assertIsNone(cache.get("https://site-b.tahoe.com"))
+        self.assertEqual(cache.get("https://site-a.tahoe.com"), {"a"})
+
+    def test_file_backend_survives_cold_start(self):
+        path = os.path.join(tempfile.mkdtemp(), "courses.json")
+        functions.CoursesCache(900, 50, path).put("https://site-a.tahoe.com", ["a"])
+        cache = functions.CoursesCache(900, 50, path)
+        self.assertEqual(cache.get("https://site-a.tahoe.com"), {"a"})
+
+    @patch("functions.shopify")
+    @patch("functions.get_session")
+    def test_validator_uses_cache(self, get_session, shopify):
+        functions.courses_cache.put("https://site-a.tahoe.com", ["course-v1:a+b+c"])
+        request = Mock()
+        request.get_json.return_value = {
+            "id": 1, "variants": [{"sku": "course-v1:a+b+c"}]
+        }
+        result = functions.shopify_product_validator(request)
+        self.assertEqual(result.response[0].decode(), "SKU is valid")
+        get_session.assert_not_called()
+
+    @patch("functions.get_session")
+    def test_cache_is_keyed_by_normalized_site(self, get_session):
+        # the purchase listener caches sites under their normalized URL
+        functions.courses_cache.put("https://site-a.tahoe.com", ["course-v1:a+b+c"])
+        with patch("functions.tahoe_sites", ["Site-A.tahoe.com/"]):
+            self.assertTrue(functions.course_exists("course-v1:a+b+c"))
+        get_session.assert_not_called()
+
+    @patch("functions.shopify")
+    def test_main_returns_the_validator_answer(self, shopify):
+        functions.courses_cache.put("https://site-a.tahoe.com", ["course-v1:a+b+c"])
+        request = Mock()
+        request.get_json.return_value = {
+            "id": 1, "variants": [{"sku": "course-v1:a+b+c"}]
+        }
+        self.assertEqual(functions.main(request).status_code, 200)
+        request.get_json.return_value = {"id": 1, "variants": []}
+        self.assertEqual(functions.main(request).status_code, 500)
+
+    @patch("functions.shopify")
+    @patch("functions.get_session")
+    def test_invalid_sku_is_handled(self, get_session, shopify):
+        # the product gets unpublished, the forward mustn't be dead-lettered
+        get_session.return_value.get.return_value = Mock(ok=False, status_code=404)
+        functions.courses_cache.put("https://site-a.tahoe.com", ["course-v1:a+b+c"])
+        request = Mock()
+        request.get_json.return_value = {
+            "id": 1, "variants": [{"sku": "course-v1:a+b+missing"}]
+        }
+        response = functions.main(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.response[0].decode(), "SKU wasn't valid")
+
+
+class MetricsTests(unittest.TestCase):
+    @patch("functions.shopify")
+    def test_validation_stages_are_traced(self, shopify):
+        default_metrics = functions.metrics
+        sink = Mock()
+        metrics = functions.metrics = functions.Metrics(sink)
+        functions.environment = "test"
+        functions.tahoe_sites = ["https://site-a.tahoe.com"]
+        functions.courses_cache = functions.CoursesCache(900, 50)
+        functions.courses_cache.put("https://site-a.tahoe.com", ["course-v1:a+b+c"])
+        functions.invalidate_store_admin()
+        request = Mock()
+        request.get_json.return_value = {
+            "id": 1, "variants": [{"sku": "course-v1:a+b+c"}]
+        }
+        try:
+            functions.main(request)
+        finally:
+            functions.metrics = default_metrics
+        spans = {call[0][0] for call in sink.span.call_args_list}
+        self.assertTrue(
+            {"shopify_product_validator", "course_exists", "shopify_call"} <= spans
+        )
+        self.assertEqual(sink.export.call_count, 0)
+        validations = [
+            histogram for histogram in metrics.snapshot()["histograms"]
+            if histogram["name"] == "shopify_product_validator"
+        ]
+        self.assertEqual(validations[0]["count"], 1)
+
+
+class NotificationOutboxTests(unittest.TestCase):
+    def test_notification_is_sent_from_outbox(self):
+        transport = functions.MemoryTransport()
+        functions.notification_outbox = functions.NotificationOutbox(
+            transport, 60, 60, background=False
+        )
+        functions.email_notifier(
+            "SKU isn't valid", "Invalid Course ID", "admin@shop.com", "Admin"
+        )
+        self.assertEqual(transport.sent, [])
+        self.assertEqual(functions.notification_outbox.flush(force=False), 1)
+        self.assertEqual(transport.sent[0]["subject"], "Invalid Course ID")
+        self.assertEqual(transport.sent[0]["to"][1]["email"], "admin@shop.com")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,161 @@
+"""
+All four functions in one long-running WSGI app, for deployments on a
+single node instead of Cloud Functions:
+
+    gunicorn --workers 4 --bind :8080 service:app
+    uvicorn --interface wsgi --workers 4 --port 8080 service:app
+
+call_validator hands webhooks to the purchase listener and the product
+validator in-process, through its durable forward queue, instead of over
+HTTPS. The functions share one HTTP connection pool, one Shopify call
+bucket, the store admin and one Tahoe course index, so every worker stays
+warm for all of them, and concurrent orders are enrolled in batches. Each function keeps
+reading its own environment variables.
+"""
+import importlib.util
+import logging
+from os import environ, path
+
+from flask import Flask, Response, request
+
+functions_dir = path.dirname(path.dirname(path.abspath(__file__)))
+functions_modules = {
+    "call_validator": "call validator and redirector",
+    "purchase_listener": "successful purchase listener",
+    "product_validator": "product validator",
+    "product_creator": "product creator",
+}
+# set to false to keep forwarding webhooks to the function URLs
+service_in_process = environ.get("service_in_process", "true") == "true"
+# concurrent orders of a service worker can share enrollment calls
+service_enrollment_batch_window = float(
+    environ.get("service_enrollment_batch_window", "0.2")
+)
+
+
+def load_function(name):
+    """Import the functions.py of a function under its own module name"""
+    spec = importlib.util.spec_from_file_location(
+        name, path.join(functions_dir, functions_modules[name], "functions.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+in_process_handlers = ("purchase_listener", "product_validator")
+# the service stays up after answering, notifications are sent in the background
+environ.setdefault("notification_flush_on_return", "false")
+if service_in_process:
+    # configured routes may target the handlers registered after loading
+    environ.setdefault("shopify_route_handlers", ",".join(in_process_handlers))
+functions = {name: load_function(name) for name in functions_modules}
+
+
+def share_warm_state(functions):
+    """
+    Make the functions use the same HTTP connection pool, the same Shopify
+    bucket, since the store limits calls per app and not per function, the
+    same store admin and the same Tahoe course index. Each function keeps
+    its own session so its HTTP calls are recorded in its own metrics.
+    Handled webhooks are kept in a SQLite file next to the forward queue,
+    so a Shopify retry reaching another worker is dropped too.
+    """
+    validator = functions["call_validator"]
+    if not validator.webhook_dedup_path:
+        validator.webhook_dedup = validator.WebhookDedup(
+            validator.webhook_dedup_ttl,
+            validator.webhook_dedup_size,
+            path.join(
+                path.dirname(validator.forward_queue_path),
+                "call_validator_webhooks.sqlite3",
+            ),
+        )
+    listener = functions["purchase_listener"]
+    adapter = listener.get_session().get_adapter("https://")
+    for module in functions.values():
+        session = module.get_session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if hasattr(module, "shopify_scheduler"):
+            module.shopify_scheduler = listener.shopify_scheduler
+            module.get_store_admin = listener.get_store_admin
+            module.invalidate_store_admin = listener.invalidate_store_admin
+    functions["product_validator"].courses_cache = listener.courses_cache
+    listener.enrollment_batcher = listener.EnrollmentBatcher(
+        service_enrollment_batch_window, listener.enrollment_batch_size
+    )
+
+
+def route_in_process(functions):
+    """
+    Register the webhook functions as call_validator handlers and send the
+    default topics to them, configured routes are loaded again so their
+    handlers are checked
+    """
+    validator = functions["call_validator"]
+    for name in in_process_handlers:
+        # looked up on every call so the function can be replaced
+        validator.register_handler(
+            name, lambda request, name=name: functions[name].main(request)
+        )
+    if validator.shopify_routes or validator.shopify_routes_file:
+        validator.routes = validator.load_routes(validator.read_routes_config())
+        return
+    validator.routes = validator.load_routes([
+        {
+            "topic": "orders/paid",
+            "filter": "financial_status == paid",
+            "handler": "purchase_listener",
+            "validate": "order",
+            "unmatched": "Cant handle unpaid call",
+        },
+        {"topic": "products/create", "handler": "product_validator"},
+        {"topic": "products/update", "handler": "product_validator"},
+    ])
+
+
+def create_app():
+    share_warm_state(functions)
+    if service_in_process:
+        route_in_process(functions)
+    app = Flask(__name__)
+    entry_points = {
+        "call_validator": functions["call_validator"].call_validator,
+        "purchase_listener": functions["purchase_listener"].main,
+        "product_validator": functions["product_validator"].main,
+        "product_creator": functions["product_creator"].main,
+    }
+
+    def dispatch(name):
+        response = entry_points[name](request)
+        if response is None:
+            # like Cloud Functions, a function returning nothing failed, the
+            # 500 makes the caller retry
+            return Response("{} returned nothing".format(name), status=500)
+        return response
+
+    for name in entry_points:
+        app.add_url_rule(
+            "/" + name, name, lambda name=name: dispatch(name),
+            methods=["POST"],
+        )
+
+    @app.route("/healthz")
+    def healthz():
+        queue = functions["call_validator"].get_forward_queue()
+        return {"status": "ok", "queued_forwards": queue.size()}
+
+    @app.route("/metrics")
+    def metrics():
+        text = "".join(
+            module.render_prometheus(module.metrics)
+            for module in functions.values()
+        )
+        return Response(text, mimetype="text/plain; version=0.0.4")
+
+    logging.info("Serving {}".format(", ".join(entry_points)))
+    return app
+
+
+app = create_app()
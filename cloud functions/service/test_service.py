@@ -0,0 +1,107 @@
+import base64
+import hashlib
+import hmac
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+import service
+
+
+class ServiceTests(unittest.TestCase):
+    def setUp(self):
+        self.client = service.app.test_client()
+        self.validator = service.functions["call_validator"]
+        self.validator.forward_queue = self.validator.SQLiteForwardQueue(
+            tempfile.mktemp(suffix=".sqlite3")
+        )
+        self.validator.webhook_dedup.clear()
+
+    def test_functions_share_warm_state(self):
+        functions = service.functions
+        listener = functions["purchase_listener"]
+        adapter = listener.get_session().get_adapter("https://")
+        for name, module in functions.items():
+            session = module.get_session()
+            self.assertIs(session.get_adapter("https://site-a.tahoe.com"), adapter)
+            # the session's metrics hook is the function's own
+            self.assertEqual(
+                session.hooks["response"], [module.record_http_response], name
+            )
+        for name in ("product_validator", "product_creator"):
+            module = functions[name]
+            self.assertIs(module.shopify_scheduler, listener.shopify_scheduler)
+            self.assertIs(module.get_store_admin, listener.get_store_admin)
+        self.assertIs(
+            functions["product_validator"].courses_cache, listener.courses_cache
+        )
+        # workers share the handled webhooks
+        validator = functions["call_validator"]
+        self.assertIsNotNone(validator.webhook_dedup.connection)
+        self.assertEqual(
+            validator.webhook_dedup.connection.execute(
+                "PRAGMA database_list"
+            ).fetchone()[2],
+            service.path.join(
+                service.path.dirname(validator.forward_queue_path),
+                "call_validator_webhooks.sqlite3",
+            ),
+        )
+        # the service sends notifications in the background
+        for name in ("purchase_listener", "product_validator"):
+            self.assertFalse(functions[name].notification_flush_on_return, name)
+        self.assertEqual(
+            listener.enrollment_batcher.window,
+            service.service_enrollment_batch_window,
+        )
+
+    def test_telemetry_copies_are_identical(self):
+        # every function is deployed alone with its own copy of telemetry
+        def telemetry(module):
+            with open(module.__file__) as source_file:
+                source = source_file.read()
+            start = source.index("class NullSpan:")
+            end = source.index("\n\n\n", source.index("def timed(name):"))
+            return source[start:end]
+
+        validator = telemetry(service.functions["call_validator"])
+        for name, module in service.functions.items():
+            self.assertEqual(telemetry(module), validator, name)
+
+    def test_paid_order_is_handled_in_process(self):
+        body = json.dumps({
+            "financial_status": "paid",
+            "email": "learner@example.com",
+            "billing_address": {"name": "Learner"},
+            "line_items": [{"sku": "course-v1:site+course+2020"}],
+        }).encode()
+        digest = hmac.new(b"secret", body, hashlib.sha256).digest()
+        headers = {
+            "X-Shopify-Topic": "orders/paid",
+            "X-Shopify-Shop-Domain": "store.myshopify.com",
+            "X-Shopify-Hmac-SHA256": base64.b64encode(digest).decode(),
+            "X-Shopify-Webhook-Id": "service-test",
+        }
+        listener = service.functions["purchase_listener"]
+        with mock.patch.object(self.validator, "shopify_secret", "secret"), \
+                mock.patch.object(self.validator, "shopify_store_url", "https://store.myshopify.com"), \
+                mock.patch.object(self.validator, "run_forward_worker"), \
+                mock.patch.object(listener, "main", return_value=service.Response("OK")) as main:
+            response = self.client.post(
+                "/call_validator", data=body, headers=headers,
+                content_type="application/json",
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.client.get("/healthz").get_json()["queued_forwards"], 1)
+            self.validator.drain_forward_queue()
+        self.assertEqual(main.call_args[0][0].get_json()["financial_status"], "paid")
+        self.assertEqual(self.validator.get_forward_queue().size(), 0)
+
+    def test_metrics_are_served(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
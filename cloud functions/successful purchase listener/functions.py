@@ -1,10 +1,24 @@
+import atexit
+import json
 import logging
+import signal
+import threading
+import time
+import functools
+import sys
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from random import randint
-from os import environ
+from os import environ, getpid, kill, replace, stat
+from types import MappingProxyType
+from urllib.parse import quote, urlsplit
 from flask import Response
 
 import requests
 import shopify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.cloud import error_reporting
 import mandrill
 
@@ -17,78 +31,1182 @@ tahoe_registration_api = environ.get("tahoe_registration_api", "")
 tahoe_enrollment_api = environ.get("tahoe_enrollment_api", "")
 tahoe_users_api = environ.get("tahoe_users_api", "")
 tahoe_sites_tokens = environ.get("tahoe_sites_tokens", "")
+# mounted secret with one "site;token" per line, merged over the env tokens
+tahoe_sites_tokens_file = environ.get("tahoe_sites_tokens_file", "")
+tahoe_sites_tokens_reload = int(environ.get("tahoe_sites_tokens_reload", "10"))
 mandrill_password = environ.get("mandrill_password", "")
 environment = environ.get("env", "")
+http_timeout = int(environ.get("http_timeout", "60"))
+http_pool_size = int(environ.get("http_pool_size", "10"))
+http_retries = int(environ.get("http_retries", "3"))
+http_backoff = float(environ.get("http_backoff", "0.5"))
+shopify_bucket_size = int(environ.get("shopify_bucket_size", "40"))
+shopify_leak_rate = float(environ.get("shopify_leak_rate", "2"))
+shopify_bucket_margin = int(environ.get("shopify_bucket_margin", "2"))
+shopify_max_retries = int(environ.get("shopify_max_retries", "5"))
+# the most products Shopify returns for one lookup by ids
+shopify_ids_limit = 250
+store_admin_ttl = int(environ.get("store_admin_ttl", "3600"))
+tahoe_users_lookup_param = environ.get("tahoe_users_lookup_param", "email")
+users_cache_size = int(environ.get("users_cache_size", "10000"))
+users_cache_ttl = int(environ.get("users_cache_ttl", "300"))
+courses_cache_ttl = int(environ.get("courses_cache_ttl", "900"))
+courses_cache_max_sites = int(environ.get("courses_cache_max_sites", "50"))
+courses_cache_min_refresh = int(environ.get("courses_cache_min_refresh", "60"))
+courses_cache_file = environ.get("courses_cache_file", "")
+# a function instance handles one order at a time, there is nothing to
+# coalesce, the service mode sets a window
+enrollment_batch_window = float(environ.get("enrollment_batch_window", "0"))
+enrollment_batch_size = int(environ.get("enrollment_batch_size", "50"))
+order_concurrency = int(environ.get("order_concurrency", "4"))
+notification_flush_interval = float(environ.get("notification_flush_interval", "5"))
+notification_digest_interval = float(environ.get("notification_digest_interval", "300"))
+# a function sends the notifications of a call before it answers, its
+# instance may get no CPU afterwards, the service sends them in the background
+notification_flush_on_return = environ.get("notification_flush_on_return", "true") == "true"
+metrics_service = "purchase_listener"
+# json, prometheus or opentelemetry, metrics are off without a sink
+metrics_sink = environ.get("metrics_sink", "")
+metrics_path = environ.get("metrics_path", "")
+metrics_export_interval = float(environ.get("metrics_export_interval", "60"))
 
 try:
     if environment == "prod":
-        mandrill_client = mandrill.Mandrill(mandrill_password)
         stackdriver_client = error_reporting.Client()
 except Exception as e:
     logging.error(str(e))
 
 
+class NullSpan:
+    """Span used while metrics are disabled, it records nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+
+null_span = NullSpan()
+
+
+class Span:
+    """Times a block of code and records it into `metrics` when it exits"""
+
+    __slots__ = ("metrics", "name", "labels", "started", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.metrics.record(
+            self.name, time.perf_counter() - self.start, self.labels,
+            error_type is not None, self.started,
+        )
+        return False
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the function's stages, exported to
+    `sink` at most every `export_interval` seconds. Without a sink nothing
+    is recorded and span() returns a shared no-op span, so instrumentation
+    only costs a check.
+    """
+
+    buckets = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+    )
+
+    def __init__(self, sink=None, export_interval=60):
+        self.sink = sink
+        self.export_interval = export_interval
+        self.exported_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def span(self, name, **labels):
+        if self.sink is None:
+            return null_span
+        return Span(self, name, labels)
+
+    def increment(self, name, value=1, **labels):
+        if self.sink is None:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def record(self, name, seconds, labels, error=False, started=None):
+        """Record a finished span of `seconds`"""
+        if self.sink is None:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": [0] * (len(self.buckets) + 1),
+                    "count": 0,
+                    "sum": 0.0,
+                }
+            histogram["buckets"][bisect_left(self.buckets, seconds)] += 1
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            if error:
+                errors_key = (name + "_errors", key[1])
+                self.counters[errors_key] = self.counters.get(errors_key, 0) + 1
+        self.sink.span(
+            name, started or time.time() - seconds, seconds, labels, error
+        )
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    dict(histogram, name=name, labels=dict(labels),
+                         buckets=list(histogram["buckets"]))
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            }
+
+    def export(self, force=True):
+        """Export to the sink, unless `export_interval` didn't pass yet"""
+        if self.sink is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.exported_at < self.export_interval:
+            return
+        self.exported_at = now
+        try:
+            self.sink.export(self)
+        except Exception as e:
+            logging.error("Metrics export failed: {}".format(e))
+
+
+class JsonSink:
+    """Writes spans and metrics as JSON lines, Cloud Logging parses them"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+    def span(self, name, started, seconds, labels, error):
+        self.write({
+            "type": "span", "service": metrics_service, "name": name,
+            "start": started, "duration_ms": round(seconds * 1000, 3),
+            "labels": labels, "error": error,
+        })
+
+    def export(self, metrics):
+        self.write(dict(metrics.snapshot(), type="metrics", service=metrics_service))
+
+
+def render_prometheus(metrics):
+    """Return the metrics in Prometheus text exposition format"""
+    def series(name, labels, extra=()):
+        pairs = sorted(labels.items()) + list(extra)
+        if not pairs:
+            return name
+        return "{}{{{}}}".format(name, ",".join(
+            '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+            for key, value in pairs
+        ))
+
+    snapshot = metrics.snapshot()
+    lines = []
+    for counter in snapshot["counters"]:
+        name = "{}_{}_total".format(metrics_service, counter["name"])
+        lines.append("# TYPE {} counter".format(name))
+        lines.append("{} {}".format(series(name, counter["labels"]), counter["value"]))
+    for histogram in snapshot["histograms"]:
+        name = "{}_{}_seconds".format(metrics_service, histogram["name"])
+        lines.append("# TYPE {} histogram".format(name))
+        cumulative = 0
+        bounds = [str(bound) for bound in metrics.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, histogram["buckets"]):
+            cumulative += count
+            lines.append("{} {}".format(
+                series(name + "_bucket", histogram["labels"], [("le", bound)]),
+                cumulative,
+            ))
+        lines.append("{} {}".format(
+            series(name + "_sum", histogram["labels"]), histogram["sum"]
+        ))
+        lines.append("{} {}".format(
+            series(name + "_count", histogram["labels"]), histogram["count"]
+        ))
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusSink:
+    """Writes the metrics in Prometheus text format to `path` on export"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def span(self, name, started, seconds, labels, error):
+        pass
+
+    def export(self, metrics):
+        with open(self.path + ".tmp", "w") as metrics_file:
+            metrics_file.write(render_prometheus(metrics))
+        replace(self.path + ".tmp", self.path)
+
+
+class OpenTelemetrySink:
+    """
+    Sends spans and their durations to the OpenTelemetry API. It needs the
+    opentelemetry-api package, and an SDK configured in the process to
+    export them.
+    """
+
+    def __init__(self):
+        from opentelemetry import metrics as otel_metrics, trace
+        self.trace = trace
+        self.tracer = trace.get_tracer(metrics_service)
+        self.meter = otel_metrics.get_meter(metrics_service)
+        self.histograms = {}
+
+    def span(self, name, started, seconds, labels, error):
+        start_time = int(started * 1e9)
+        attributes = {key: str(value) for key, value in labels.items()}
+        span = self.tracer.start_span(
+            name, start_time=start_time, attributes=attributes
+        )
+        if error:
+            span.set_status(self.trace.Status(self.trace.StatusCode.ERROR))
+        span.end(end_time=start_time + int(seconds * 1e9))
+        if name not in self.histograms:
+            self.histograms[name] = self.meter.create_histogram(
+                name + "_seconds", unit="s"
+            )
+        self.histograms[name].record(seconds, attributes=attributes)
+
+    def export(self, metrics):
+        pass
+
+
+def build_metrics_sink(name):
+    if not name:
+        return None
+    if name == "json":
+        return JsonSink()
+    if name == "prometheus":
+        return PrometheusSink(
+            metrics_path or "/tmp/{}.prom".format(metrics_service)
+        )
+    if name == "opentelemetry":
+        return OpenTelemetrySink()
+    raise ValueError("Unknown metrics sink {!r}".format(name))
+
+
+metrics = Metrics(build_metrics_sink(metrics_sink), metrics_export_interval)
+atexit.register(metrics.export)
+
+
+def record_http_response(response, *args, **kwargs):
+    """requests response hook, records every HTTP call as a span"""
+    if metrics.sink is None:
+        return
+    metrics.record(
+        "http_request",
+        response.elapsed.total_seconds(),
+        {
+            "host": urlsplit(response.url).netloc,
+            "method": response.request.method,
+            "status": str(response.status_code),
+        },
+        error=response.status_code >= 500,
+    )
+
+
+def timed(name):
+    """Decorator recording every call of the function as a span"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+http_session = None
+http_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Return the shared requests Session. It is created on first use and kept
+    between warm invocations so calls to the same host reuse a pooled
+    keep-alive connection. Idempotent requests are retried with backoff on
+    connection errors, 429 and 5xx responses.
+    """
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            retry = Retry(
+                total=http_retries,
+                backoff_factor=http_backoff,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=http_pool_size,
+                pool_maxsize=http_pool_size,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.hooks["response"].append(record_http_response)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            http_session = session
+    return http_session
+
+
+class ShopifyScheduler:
+    """
+    Leaky bucket pacing Shopify Admin API calls just under the limit.
+    The bucket level leaks at `leak_rate` calls per second and is corrected
+    from the X-Shopify-Shop-Api-Call-Limit header after every call. A call
+    waits until the bucket has room below `size - margin`, a 429 response is
+    retried after its Retry-After header. GraphQL queries are paced apart,
+    on the query cost points reported by the cost extension of responses.
+    Waits are counted in `stats`.
+    """
+
+    def __init__(self, size, leak_rate, margin):
+        self.size = size
+        self.leak_rate = leak_rate
+        self.margin = margin
+        self.level = 0.0
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "waits": 0, "wait_seconds": 0.0, "throttled": 0}
+        # GraphQL points, unknown until the first response
+        self.points = None
+        self.points_size = None
+        self.restore_rate = None
+        self.points_updated_at = time.monotonic()
+
+    def leak(self):
+        now = time.monotonic()
+        self.level = max(0.0, self.level - (now - self.updated_at) * self.leak_rate)
+        self.updated_at = now
+
+    def acquire(self):
+        with self.lock:
+            self.leak()
+            wait_time = (self.level + 1 - (self.size - self.margin)) / self.leak_rate
+            wait_time = max(0.0, wait_time)
+            self.level += 1
+            self.stats["calls"] += 1
+            if wait_time:
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += wait_time
+        if wait_time:
+            time.sleep(wait_time)
+
+    def update(self, headers):
+        # headers of pyactiveresource responses and urllib errors
+        try:
+            call_limit = get_header(headers, "X-Shopify-Shop-Api-Call-Limit")
+            if not call_limit:
+                return
+            used, size = call_limit.split("/")
+            with self.lock:
+                self.level = float(used)
+                self.size = int(size)
+                self.updated_at = time.monotonic()
+        except (AttributeError, TypeError, ValueError):
+            return
+
+    def update_points(self, cost):
+        """Correct the GraphQL points from the cost extension of a response"""
+        try:
+            throttle_status = cost["throttleStatus"]
+            available = float(throttle_status["currentlyAvailable"])
+            size = float(throttle_status["maximumAvailable"])
+            restore_rate = float(throttle_status["restoreRate"])
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            self.points = available
+            self.points_size = size
+            self.restore_rate = restore_rate
+            self.points_updated_at = time.monotonic()
+
+    def acquire_points(self, cost):
+        """Wait until the store has `cost` GraphQL points"""
+        with self.lock:
+            if self.points is None or not self.restore_rate:
+                return
+            now = time.monotonic()
+            self.points = min(
+                self.points_size,
+                self.points + (now - self.points_updated_at) * self.restore_rate,
+            )
+            self.points_updated_at = now
+            wait_time = max(0.0, (cost - self.points) / self.restore_rate)
+            self.points -= cost
+            if wait_time:
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += wait_time
+        if wait_time:
+            time.sleep(wait_time)
+
+    def call_graphql(self, execute, query, variables=None, cost=0):
+        """
+        Run a GraphQL query with `execute` once the store has `cost` points
+        for it and return the parsed response. A throttled query is retried
+        when the points it requested are restored.
+        """
+        attempt = 0
+        while True:
+            self.acquire_points(cost)
+            with metrics.span(
+                "shopify_call",
+                call=getattr(execute, "__qualname__", str(execute)),
+            ):
+                response = execute(query, variables)
+            query_cost = (response.get("extensions") or {}).get("cost") or {}
+            self.update_points(query_cost)
+            throttled = any(
+                isinstance(error, dict)
+                and (error.get("extensions") or {}).get("code") == "THROTTLED"
+                for error in response.get("errors") or []
+            )
+            if not throttled or attempt >= shopify_max_retries:
+                return response
+            attempt += 1
+            cost = query_cost.get("requestedQueryCost", cost)
+            with self.lock:
+                self.stats["throttled"] += 1
+            logging.warning(
+                "Shopify throttled the GraphQL query, retry with {} points".format(cost)
+            )
+
+    def call(self, function, *args, **kwargs):
+        """Call a Shopify API function when the bucket has room for it"""
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                with metrics.span(
+                    "shopify_call",
+                    call=getattr(function, "__qualname__", str(function)),
+                ):
+                    result = function(*args, **kwargs)
+            except Exception as e:
+                # pyactiveresource errors keep the HTTPError in `response`
+                response = getattr(e, "response", None)
+                if response is None:
+                    response = e
+                if getattr(response, "code", None) != 429:
+                    raise
+                if attempt >= shopify_max_retries:
+                    raise
+                attempt += 1
+                headers = getattr(response, "headers", None)
+                retry_after = float(get_header(headers, "Retry-After") or 2.0)
+                with self.lock:
+                    self.level = float(self.size)
+                    self.updated_at = time.monotonic()
+                    self.stats["throttled"] += 1
+                    self.stats["waits"] += 1
+                    self.stats["wait_seconds"] += retry_after
+                logging.warning("Shopify throttled the call, retry in {}s".format(
+                    retry_after
+                ))
+                time.sleep(retry_after)
+                continue
+            response = getattr(shopify.ShopifyResource.connection, "response", None)
+            self.update(getattr(response, "headers", None))
+            return result
+
+
+def get_header(headers, name):
+    if not headers:
+        return None
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+shopify_scheduler = ShopifyScheduler(
+    shopify_bucket_size, shopify_leak_rate, shopify_bucket_margin
+)
+
+
+store_admin = None
+store_admin_lock = threading.Lock()
+
+
+def get_store_admin():
+    """
+    Return (name, email) of the store admin. Shop.current() is only called
+    when the cached value is missing or older than `store_admin_ttl` seconds.
+    """
+    global store_admin
+    with store_admin_lock:
+        if store_admin is None or time.time() - store_admin[0] > store_admin_ttl:
+            store = shopify_scheduler.call(shopify.Shop.current)
+            store_admin = (time.time(), store.name, store.customer_email)
+        return store_admin[1], store_admin[2]
+
+
+def invalidate_store_admin():
+    global store_admin
+    with store_admin_lock:
+        store_admin = None
+
+
+def normalize_site_url(site_url):
+    """
+    Normalize a Tahoe site URL so product tags and configured sites match,
+    https is assumed when the scheme is missing
+    """
+    site_url = site_url.strip()
+    if not site_url:
+        return ""
+    if "://" not in site_url:
+        site_url = "https://" + site_url
+    parts = urlsplit(site_url)
+    return "{}://{}{}".format(
+        parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/")
+    )
+
+
+def parse_sites_tokens(text):
+    """
+    Parse "site;token" entries separated by commas or new lines into an
+    immutable mapping of normalized site URL to token. Raise ValueError on
+    a malformed entry.
+    """
+    sites_tokens = {}
+    for entry in text.replace("\n", ",").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        site_url, separator, token = entry.partition(";")
+        site_url = normalize_site_url(site_url)
+        token = token.strip()
+        if not separator or not site_url or not token or ";" in token:
+            raise ValueError(
+                "Malformed Tahoe site token entry for {}".format(
+                    site_url or "an empty site"
+                )
+            )
+        sites_tokens[site_url] = token
+    return MappingProxyType(sites_tokens)
+
+
+class SiteTokenRegistry:
+    """
+    Tokens of Tahoe sites, parsed once from `tokens` and the optional
+    secrets file at `path`. The file is checked for changes at most every
+    `reload_interval` seconds, a malformed update is logged and the
+    current tokens are kept.
+    """
+
+    def __init__(self, tokens="", path="", reload_interval=10):
+        self.tokens = tokens
+        self.path = path
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.file_mtime = None
+        self.checked_at = time.monotonic()
+        self.sites = self.load()
+
+    def load(self):
+        text = self.tokens
+        if self.path:
+            self.file_mtime = stat(self.path).st_mtime
+            with open(self.path) as tokens_file:
+                text += "\n" + tokens_file.read()
+        return parse_sites_tokens(text)
+
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if not self.path or now - self.checked_at < self.reload_interval:
+            return
+        with self.lock:
+            if now - self.checked_at < self.reload_interval:
+                return
+            self.checked_at = now
+            try:
+                if stat(self.path).st_mtime != self.file_mtime:
+                    self.sites = self.load()
+                    logging.info("Reloaded Tahoe site tokens")
+            except (OSError, ValueError) as e:
+                logging.error("Keeping Tahoe site tokens: {}".format(e))
+
+    def get(self, tahoe_site_url):
+        self.reload_if_changed()
+        return self.sites.get(normalize_site_url(tahoe_site_url), "")
+
+
+# built at import so a malformed token fails the deploy, not a purchase
+site_tokens = SiteTokenRegistry(
+    tahoe_sites_tokens, tahoe_sites_tokens_file, tahoe_sites_tokens_reload
+)
+
+
+def get_site_tokens():
+    """Return the registry, rebuilt if the configured tokens were changed"""
+    global site_tokens
+    if (
+        site_tokens.tokens != tahoe_sites_tokens
+        or site_tokens.path != tahoe_sites_tokens_file
+    ):
+        site_tokens = SiteTokenRegistry(
+            tahoe_sites_tokens, tahoe_sites_tokens_file,
+            tahoe_sites_tokens_reload
+        )
+    return site_tokens
+
+
 def give_me_token(tahoe_site_url):
-    sites_tokens_dict = {}
-    sites_tokens_list = tahoe_sites_tokens.split(",")
-    for item in sites_tokens_list:
-        sites_tokens_dict[item.split(";")[0]] = item.split(";")[1]
-    return sites_tokens_dict.get(tahoe_site_url, "")
+    return get_site_tokens().get(tahoe_site_url)
+
+
+users_cache = OrderedDict()
+users_cache_lock = threading.Lock()
+
+
+def remember_user(tahoe_site_url, email, exists):
+    with users_cache_lock:
+        users_cache[(tahoe_site_url, email.lower())] = (time.time(), exists)
+        users_cache.move_to_end((tahoe_site_url, email.lower()))
+        while len(users_cache) > users_cache_size:
+            users_cache.popitem(last=False)
+
+
+@timed("user_lookup")
+def user_exists(tahoe_site_url, email, tahoe_token):
+    """
+        Check if a user with the email exists in a Tahoe site. Users API gets
+        queried with the email as filter, if the API ignores the filter users
+        are scanned page by page until the email shows up. Answers are kept in
+        a bounded LRU cache, existing users for good and missing ones for
+        `users_cache_ttl` seconds.
+    """
+    key = (tahoe_site_url, email.lower())
+    with users_cache_lock:
+        cached = users_cache.get(key)
+        if cached is not None:
+            checked_at, exists = cached
+            if exists or time.time() - checked_at < users_cache_ttl:
+                users_cache.move_to_end(key)
+                return exists
+    headers = {"Authorization": "Token {}".format(tahoe_token)}
+    response_users = get_session().get(
+        tahoe_site_url + tahoe_users_api,
+        params={tahoe_users_lookup_param: email},
+        headers=headers,
+        timeout=http_timeout,
+    )
+    while True:
+        response_json = response_users.json()
+        emails = [result["email"].lower() for result in response_json["results"]]
+        exists = email.lower() in emails
+        # an empty or matching page means the API applied the filter
+        if exists or not emails:
+            break
+        next_url = response_json.get("next") or response_json.get(
+            "pagination", {}
+        ).get("next")
+        if not next_url:
+            break
+        response_users = get_session().get(
+            next_url, headers=headers, timeout=http_timeout
+        )
+    remember_user(tahoe_site_url, email, exists)
+    return exists
+
+
+class CoursesCache:
+    """
+        Course ids of every Tahoe site, kept in memory between warm
+        invocations. Entries expire after `ttl` seconds and the least recently
+        used site is dropped when there are more than `max_sites` sites.
+        If `path` is given the cache is saved to that file after each refresh
+        and loaded back on a cold start.
+    """
+
+    def __init__(self, ttl, max_sites, path=""):
+        self.ttl = ttl
+        self.max_sites = max_sites
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "refreshes": 0}
+        if path:
+            self.load()
+
+    def age(self, site):
+        entry = self.entries.get(site)
+        if entry is None:
+            return float("inf")
+        return time.time() - entry[0]
+
+    def get(self, site):
+        """Return the course ids of a site or None if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(site)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return None
+            self.entries.move_to_end(site)
+            return entry[1]
+
+    def entry(self, site):
+        """Return (fetched_at, course ids) of a site, even if expired"""
+        with self.lock:
+            return self.entries.get(site)
+
+    def put(self, site, courses_ids, fetched_at=None):
+        with self.lock:
+            self.entries[site] = (fetched_at or time.time(), frozenset(courses_ids))
+            self.entries.move_to_end(site)
+            while len(self.entries) > self.max_sites:
+                self.entries.popitem(last=False)
+            self.stats["refreshes"] += 1
+        if self.path:
+            self.save()
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+        for site, (fetched_at, courses_ids) in data.items():
+            self.entries[site] = (fetched_at, frozenset(courses_ids))
+
+    def save(self):
+        with self.lock:
+            data = {
+                site: [fetched_at, sorted(courses_ids)]
+                for site, (fetched_at, courses_ids) in self.entries.items()
+            }
+        try:
+            with open(self.path + ".tmp", "w") as cache_file:
+                json.dump(data, cache_file)
+            replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            logging.error(str(e))
+
+
+courses_cache = CoursesCache(
+    courses_cache_ttl, courses_cache_max_sites, courses_cache_file
+)
+# site -> Future of the course ids of its crawl in progress
+courses_refreshes = {}
+courses_refreshes_lock = threading.Lock()
+
+
+def get_courses_page(url):
+    response_courses = get_session().get(url, timeout=http_timeout)
+    # Make sure Tahoe courses API is up
+    if not response_courses.ok:
+        msg = "Tahoe Courses API is inaccessible"
+        logging.error(msg)
+        if environment == "prod":
+            stackdriver_client.report_exception()
+        raise RuntimeError(msg)
+    return response_courses.json()
+
+
+def iter_courses_pages(url):
+    """
+    Yield every page of Tahoe Courses API starting from `url` and follow
+    `pagination.next` until it is null. Each response is used both for its
+    courses and for the next page url, so every page is requested once.
+    """
+    while url:
+        response_json = get_courses_page(url)
+        yield response_json
+        url = response_json["pagination"].get("next")
+
+
+def refresh_site_courses(tahoe_site_url):
+    """
+    Crawl the site's course ids into the index and return them. Concurrent
+    refreshes of a site wait for the same crawl, a failed crawl raises.
+    """
+    with courses_refreshes_lock:
+        refresh = courses_refreshes.get(tahoe_site_url)
+        crawling = refresh is None
+        if crawling:
+            refresh = courses_refreshes[tahoe_site_url] = Future()
+    if not crawling:
+        return refresh.result()
+    try:
+        courses_ids = []
+        for response_json in iter_courses_pages(tahoe_site_url + tahoe_courses_api):
+            courses_ids.extend(result["course_id"] for result in response_json["results"])
+        courses_ids = frozenset(courses_ids)
+        courses_cache.put(tahoe_site_url, courses_ids)
+        refresh.set_result(courses_ids)
+        return courses_ids
+    except Exception as e:
+        refresh.set_exception(e)
+        raise
+    finally:
+        with courses_refreshes_lock:
+            del courses_refreshes[tahoe_site_url]
+
+
+def refresh_site_courses_in_background(tahoe_site_url):
+    with courses_refreshes_lock:
+        if tahoe_site_url in courses_refreshes:
+            return
+
+    def refresh():
+        try:
+            refresh_site_courses(tahoe_site_url)
+        except Exception as e:
+            logging.error(str(e))
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+@timed("course_exists")
+def course_exists(tahoe_site_url, course_id):
+    """
+        Check if the course exists in the Tahoe site. The site course ids
+        index answers if it has the course, otherwise the course is looked up
+        directly with Courses API detail endpoint, it may be newer than the
+        index. A missing or stale index is built in the background, the index
+        is only waited for when the API doesn't give a clear answer. The index
+        uses the same cache file format as the product validator so both can
+        share `courses_cache_file`.
+    """
+    entry = courses_cache.entry(tahoe_site_url)
+    if entry is None:
+        # the first order of a site doesn't wait for its whole catalog
+        refresh_site_courses_in_background(tahoe_site_url)
+        courses_ids = frozenset()
+    else:
+        courses_ids = entry[1]
+        if courses_cache.get(tahoe_site_url) is None:
+            # a stale index still answers while it's refreshed in the background
+            refresh_site_courses_in_background(tahoe_site_url)
+    if course_id in courses_ids:
+        courses_cache.count("hits")
+        return True
+    courses_cache.count("misses")
+    response_course = get_session().get(
+        tahoe_site_url + tahoe_courses_api + quote(course_id, safe=":+") + "/",
+        timeout=http_timeout,
+    )
+    if response_course.status_code == 200:
+        return True
+    if response_course.status_code == 404:
+        return False
+    if courses_cache.age(tahoe_site_url) < courses_cache_min_refresh:
+        return False
+    return course_id in refresh_site_courses(tahoe_site_url)
 
 
 # 1 Get Shopify Product and Customer information
-def get_info(request):
+OrderItem = namedtuple("OrderItem", ["course_id", "tahoe_site_url", "product_id"])
+OrderContext = namedtuple(
+    "OrderContext",
+    [
+        "order_id",
+        "items",
+        "customer_email",
+        "customer_fullname",
+        "payment_confirmed",
+        "store_admin_name",
+        "store_admin_email",
+    ],
+)
+
+
+@timed("order_context")
+def get_order_context(request):
     """
-        Get product and customer information from shopify webhook request
+        Get products and customer information from shopify webhook request.
+        It's built once per order and passed to registration, enrollment and
+        notifications. Every line item with a SKU becomes an OrderItem, the
+        Tahoe site of all of them is found with one product lookup per
+        `shopify_ids_limit` products. Items whose product isn't found get an
+        empty tahoe_site_url.
     """
     shopify.ShopifyResource.set_site(shopify_store_admin_api)
-    store = shopify.Shop.current()
-    store_admin_name = store.name
-    store_admin_email = store.customer_email
+    store_admin_name, store_admin_email = get_store_admin()
     request_json = request.get_json()
-    product_id = request_json["line_items"][0]["product_id"]
-    product = shopify.Product.find(product_id)
-    # course_id = product.variants[0].sku
-    course_id = request_json['line_items'][0]['sku']
-    tahoe_site_url = product.tags
-    email = request_json["email"]
-    fullname = request_json["billing_address"]["name"]
-    payment_confirmed = request_json['confirmed']
-    info = {
-        "course_id": course_id,
-        "tahoe_site_url": tahoe_site_url,
-        "customer_email": email,
-        "customer_fullname": fullname,
-        "payment_confirmed": payment_confirmed,
-        "store_admin_name": store_admin_name,
-        "store_admin_email": store_admin_email
+    line_items = [item for item in request_json["line_items"] if item.get("sku")]
+    product_ids = sorted({item["product_id"] for item in line_items})
+    products = []
+    for start in range(0, len(product_ids), shopify_ids_limit):
+        # without a limit Shopify returns the first 50 products only
+        page_ids = product_ids[start:start + shopify_ids_limit]
+        products.extend(shopify_scheduler.call(
+            shopify.Product.find,
+            ids=",".join(str(product_id) for product_id in page_ids),
+            limit=len(page_ids),
+        ))
+    # product tag is the Tahoe site full URL
+    products_sites = {product.id: product.tags for product in products}
+    items = tuple(
+        OrderItem(
+            course_id=item["sku"],
+            tahoe_site_url=normalize_site_url(
+                products_sites.get(item["product_id"], "")
+            ),
+            product_id=item["product_id"],
+        )
+        for item in line_items
+    )
+    return OrderContext(
+        order_id=request_json.get("id"),
+        items=items,
+        customer_email=request_json["email"],
+        customer_fullname=request_json["billing_address"]["name"],
+        payment_confirmed=request_json["confirmed"],
+        store_admin_name=store_admin_name,
+        store_admin_email=store_admin_email,
+    )
 
-    }
-    return info
 
+support_recipient = {
+    "email": "amir@appsembler.com", "name": "Amir Tadrisi", "type": "to"
+}
 
-# 2. Email notifier function
-def email_notifier(msg, subject, store_admin_email="", store_admin_name=""):
+
+class MandrillTransport:
+    """Sends messages with Mandrill, the client is created on first send"""
+
+    def __init__(self, password):
+        self.password = password
+        self.client = None
+
+    def send(self, message):
+        if self.client is None:
+            self.client = mandrill.Mandrill(self.password)
+        self.client.messages.send(message=message)
+
+
+class MemoryTransport:
+    """Keeps messages in `sent` instead of sending them, for tests and dev"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+class NotificationOutbox:
+    """
+    Queues email notifications and sends them from a background worker, so
+    webhooks never wait for the mail provider. Notifications of one group,
+    like an order, are coalesced into a single message which is sent when
+    the group is closed or `flush_interval` seconds after its first
+    notification. Digest notifications are rolled into one message per
+    subject every `digest_interval` seconds. Without `background` messages
+    are only sent by flush.
+    """
+
+    def __init__(self, transport, flush_interval=5, digest_interval=300,
+                 background=True):
+        self.transport = transport
+        self.background = background
+        self.flush_interval = flush_interval
+        self.digest_interval = digest_interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.groups = OrderedDict()
+        self.digests = OrderedDict()
+        self.digest_started = time.monotonic()
+        self.worker = None
+        self.sent = 0
+
+    def notify(self, msg, subject, store_admin_email="", store_admin_name="",
+               group=None, digest=False):
+        with self.lock:
+            if digest:
+                self.digests.setdefault(subject, []).append(msg)
+            else:
+                key = (group if group is not None else object(), store_admin_email)
+                if key not in self.groups:
+                    self.groups[key] = {
+                        "created": time.monotonic(),
+                        "subjects": [],
+                        "lines": [],
+                        "store_admin": (store_admin_email, store_admin_name),
+                        "closed": group is None,
+                    }
+                pending = self.groups[key]
+                if subject not in pending["subjects"]:
+                    pending["subjects"].append(subject)
+                pending["lines"].append(msg)
+            self.start_worker()
+        if group is None and not digest:
+            self.wakeup.set()
+
+    def close(self, group):
+        """Send the messages of a group without waiting for its interval"""
+        with self.lock:
+            for key, pending in self.groups.items():
+                if key[0] == group:
+                    pending["closed"] = True
+        self.wakeup.set()
+
+    def start_worker(self):
+        if not self.background:
+            return
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(timeout=min(self.flush_interval, self.digest_interval))
+            self.wakeup.clear()
+            self.flush(force=False)
+
+    def take_due(self, force):
+        now = time.monotonic()
+        with self.lock:
+            due = [
+                key for key, pending in self.groups.items()
+                if force or pending["closed"]
+                or now - pending["created"] >= self.flush_interval
+            ]
+            groups = [self.groups.pop(key) for key in due]
+            digests = []
+            if self.digests and (
+                force or now - self.digest_started >= self.digest_interval
+            ):
+                digests = list(self.digests.items())
+                self.digests.clear()
+                self.digest_started = now
+        return groups, digests
+
+    def flush(self, force=True):
+        """Send due messages, or all of them with `force`, return the count"""
+        groups, digests = self.take_due(force)
+        messages = [
+            build_message(
+                " / ".join(pending["subjects"]),
+                "\n\n".join(pending["lines"]),
+                *pending["store_admin"]
+            )
+            for pending in groups
+        ]
+        messages += [
+            build_message(
+                "{} digest ({} events)".format(subject, len(lines)),
+                "\n".join(lines),
+            )
+            for subject, lines in digests
+        ]
+        for message in messages:
+            try:
+                with metrics.span("email_send"):
+                    self.transport.send(message)
+                with self.lock:
+                    self.sent += 1
+            except Exception as e:
+                logging.error("Notification {} wasn't sent: {}".format(
+                    message["subject"], e
+                ))
+        return len(messages)
+
+
+def build_message(subject, text, store_admin_email="", store_admin_name=""):
     message = {
         "from_email": "technical@appsembler.com",
         "from_name": "Appsembler Technical Support",
         "important": True,
         "subject": subject,
-        "text": msg,
-        "to": [
-            {"email": "amir@appsembler.com", "name": "Amir Tadrisi", "type": "to",},
-        ],
+        "text": text,
+        "to": [dict(support_recipient)],
     }
     if store_admin_email:
         message["to"].append(
-            {"email": store_admin_email, "name": store_admin_name, "type": "to",},
+            {"email": store_admin_email, "name": store_admin_name, "type": "to"}
         )
-    if environment == "prod":
-        mandrill_client.messages.send(message=message)
+    return message
+
+
+notification_outbox = NotificationOutbox(
+    MandrillTransport(mandrill_password) if environment == "prod"
+    else MemoryTransport(),
+    notification_flush_interval,
+    notification_digest_interval,
+)
+atexit.register(notification_outbox.flush)
+
+
+def flush_notifications_on_sigterm(signum, frame):
+    """
+    Send the queued notifications before the instance is shut down, atexit
+    handlers don't run on SIGTERM. The previous handler runs afterwards.
+    """
+    notification_outbox.flush()
+    if callable(previous_sigterm_handler):
+        previous_sigterm_handler(signum, frame)
+    elif previous_sigterm_handler != signal.SIG_IGN:
+        signal.signal(signum, signal.SIG_DFL)
+        kill(getpid(), signum)
+
+
+previous_sigterm_handler = signal.getsignal(signal.SIGTERM)
+try:
+    signal.signal(signal.SIGTERM, flush_notifications_on_sigterm)
+except ValueError:
+    # handlers can only be installed from the main thread
+    logging.warning("Notifications won't be flushed on SIGTERM")
+
+
+# 2. Email notifier function
+def email_notifier(msg, subject, store_admin_email="", store_admin_name="",
+                   group=None, digest=False):
+    """
+    Queue a notification in the outbox. Notifications with the same `group`
+    are sent as one message, `digest` ones are sent in periodic digests.
+    """
+    notification_outbox.notify(
+        msg, subject, store_admin_email, store_admin_name, group, digest
+    )
 
 
 # 3. Register the user in Tahoe
-def register_in_tahoe(request):
+@timed("register")
+def register_in_tahoe(request, context=None, tahoe_site_url=None):
     """
         This function gets customer's info from Shopify request,
         Product info from Shopify. Makes a request to users api
@@ -99,20 +1217,16 @@ def register_in_tahoe(request):
     logging.info("Start registering user")
     logging.info(request)
     # 3.1 Get the product info from request
-    info = get_info(request)
-    tahoe_site_url = info.get("tahoe_site_url", "")
-    # 3.2 Get a list of all users in Tahoe site
+    if context is None:
+        context = get_order_context(request)
+    if tahoe_site_url is None:
+        tahoe_site_url = context.items[0].tahoe_site_url
+    # 3.2 Look the customer email up in Tahoe site users
     tahoe_token = give_me_token(tahoe_site_url)
-    reponse_users = requests.get(
-        tahoe_site_url + tahoe_users_api,
-        headers={"Authorization": "Token {}".format(tahoe_token)},
-    )
-    email = info.get("customer_email", "")
-    fullname = info.get("customer_fullname", "")
-    # 3.3 make a list of existing emails in Tahoe site
-    emails = [result["email"] for result in reponse_users.json()["results"]]
-    # 3.4 Make sure the user dowsn't exist
-    if email in emails:
+    email = context.customer_email
+    fullname = context.customer_fullname
+    # 3.3 Make sure the user dowsn't exist
+    if user_exists(tahoe_site_url, email, tahoe_token):
         msg = "We couldn't register {} ".format(tahoe_site_url)
         msg += "because a user with email {} already exist".format(email)
         logging.error(msg)
@@ -121,35 +1235,40 @@ def register_in_tahoe(request):
         email_notifier(
             msg,
             "Tahoe User Registration",
-            info["store_admin_name"],
-            info["store_admin_name"]
+            context.store_admin_email,
+            context.store_admin_name,
+            group=context.order_id,
         )
         return Response(
             "User {} already exist".format(email),
             status=409
         )
-    # 3.5 Create user info in case user doesn't exist
+    # 3.4 Create user info in case user doesn't exist
     username = email.split("@")[0] + str(randint(1000, 9999))
     username = username.replace("+", "")
     user_info = {"name": fullname, "username": username, "email": email}
-    # 3.6 Send Email, Fullname and username by POST to Registration API
-    tahoe_token = give_me_token(tahoe_site_url)
-    response = requests.post(
+    # 3.5 Send Email, Fullname and username by POST to Registration API
+    response = get_session().post(
         tahoe_site_url + tahoe_registration_api,
         headers={"Authorization": "Token {}".format(tahoe_token)},
         data=user_info,
+        timeout=http_timeout,
     )
-    # 3.7 Process response code
+    # 3.6 Process response code
+    if response.ok or response.status_code == 409:
+        remember_user(tahoe_site_url, email, True)
     if response.ok:
         msg = "User {} successfully registered in {}".format(
             username, tahoe_site_url
         )
         logging.info(msg)
-        email_notifier(msg, "Tahoe User Registration")
+        email_notifier(msg, "Tahoe User Registration", digest=True)
     elif response.status_code == 409:
         msg = "user {} already exist in {}".format(username, tahoe_site_url)
         logging.warn(msg)
-        email_notifier(msg, "Tahoe User Registration")
+        email_notifier(
+            msg, "Tahoe User Registration", group=context.order_id
+        )
         return False
     else:
         msg = "Something went wrong during registring {} in {}".format(
@@ -157,7 +1276,9 @@ def register_in_tahoe(request):
             tahoe_site_url
         )
         logging.error(msg)
-        email_notifier(msg, "Tahoe User Registration")
+        email_notifier(
+            msg, "Tahoe User Registration", group=context.order_id
+        )
         return False
     logging.info(response.json())
     logging.info("End of registering user")
@@ -166,42 +1287,137 @@ def register_in_tahoe(request):
     )
 
 
-# 4. Enroll the user in the course
-def enroll_in_course(request):
-    logging.info("Start Enrolling")
-    # 4.1 Make sure the course exist
-    info = get_info(request)
-    email = info.get("customer_email", "")
-    sku = info.get("course_id", "")
-    tahoe_site_url = info.get("tahoe_site_url", "")
-    response_courses = requests.get(tahoe_site_url + tahoe_courses_api)
-    courses_on_site = [
-        course["course_id"] for course in response_courses.json()["results"]
-    ]
-    if sku not in courses_on_site:
-        msg = "Course {sku} doesn't exist".format(sku=sku)
-        logging.error(msg)
-        if environment == "prod":
-            stackdriver_client.report_exception()
-        email_notifier(msg, "Tahoe User Enrollment")
-        return Response("Course doesn't exist", status=404)
-
-    # 4.2 Make a call to enrollment API with email, course-id and enroll
+@timed("enrollment_request")
+def send_enrollments(tahoe_site_url, course_id, emails):
+    """
+    Enroll all emails into the course with one call to Tahoe enrollment API.
+    Return a dict of email to (enrolled, result of that learner).
+    """
     enrollment_info = {
         "action": "enroll",
         "email_learners": "true",
-        "courses": [sku],
-        "identifiers": [email],
+        "courses": [course_id],
+        "identifiers": emails,
         "auto_enroll": "true",
     }
     tahoe_token = give_me_token(tahoe_site_url)
-    response = requests.post(
+    response = get_session().post(
         tahoe_site_url + tahoe_enrollment_api,
         headers={"Authorization": "Token {}".format(tahoe_token)},
         data=enrollment_info,
+        timeout=http_timeout,
+    )
+    if not response.ok:
+        return {
+            email: (False, {"status_code": response.status_code})
+            for email in emails
+        }
+    # edx bulk enrollment response has a result for every identifier
+    response_json = response.json()
+    course_results = response_json.get("courses", {}).get(course_id, {})
+    results = course_results.get("results", response_json.get("results", []))
+    learners_results = {
+        result.get("identifier", "").lower(): result for result in results
+    }
+    enrollments = {}
+    for email in emails:
+        result = learners_results.get(email.lower(), {})
+        failed = result.get("error") or result.get("invalidIdentifier")
+        enrollments[email] = (not failed, result)
+    return enrollments
+
+
+class EnrollmentBatcher:
+    """
+    Coalesces enrollments into the same course of the same Tahoe site.
+    The first enrollment of a group waits up to `window` seconds for others
+    and the group is sent earlier once it has `max_size` learners. Each
+    submitted enrollment gets a Future of its own (enrolled, result).
+    A window of 0 sends every enrollment right away.
+    """
+
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stats = {"enrollments": 0, "calls": 0}
+
+    def submit(self, tahoe_site_url, course_id, email):
+        key = (tahoe_site_url, course_id)
+        future = Future()
+        full_batch = None
+        with self.lock:
+            self.stats["enrollments"] += 1
+            batch = self.pending.get(key)
+            if batch is None:
+                batch = self.pending[key] = []
+                if self.window > 0:
+                    timer = threading.Timer(self.window, self.flush, [key, batch])
+                    timer.daemon = True
+                    timer.start()
+            batch.append((email, future))
+            if self.window <= 0 or len(batch) >= self.max_size:
+                full_batch = self.pending.pop(key)
+        if full_batch is not None:
+            self.send(key, full_batch)
+        return future
+
+    def flush(self, key, batch):
+        with self.lock:
+            if self.pending.get(key) is not batch:
+                return
+            del self.pending[key]
+        self.send(key, batch)
+
+    def send(self, key, batch):
+        tahoe_site_url, course_id = key
+        with self.lock:
+            self.stats["calls"] += 1
+        try:
+            enrollments = send_enrollments(
+                tahoe_site_url, course_id, [email for email, _ in batch]
+            )
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for email, future in batch:
+            future.set_result(enrollments[email])
+
+
+enrollment_batcher = EnrollmentBatcher(
+    enrollment_batch_window, enrollment_batch_size
+)
+
+
+# 4. Enroll the user in the course
+@timed("enroll")
+def enroll_in_course(request, context=None, item=None):
+    logging.info("Start Enrolling")
+    # 4.1 Make sure the course exist
+    if context is None:
+        context = get_order_context(request)
+    if item is None:
+        item = context.items[0]
+    email = context.customer_email
+    sku = item.course_id
+    tahoe_site_url = item.tahoe_site_url
+    if not course_exists(tahoe_site_url, sku):
+        msg = "Course {sku} doesn't exist".format(sku=sku)
+        logging.error(msg)
+        if environment == "prod":
+            stackdriver_client.report_exception()
+        email_notifier(msg, "Tahoe User Enrollment", group=context.order_id)
+        return Response("Course doesn't exist", status=404)
+
+    # 4.2 Enroll with email and course-id, in a batch with other orders
+    enrollment = enrollment_batcher.submit(tahoe_site_url, sku, email)
+    enrolled, result = enrollment.result(
+        timeout=http_timeout + enrollment_batcher.window
     )
     # 4.3 Process response code from Tahoe
-    if response.ok:
+    if enrolled:
         msg = "{email} successfully enrolled into {course}".format(
             email=email, course=sku
         )
@@ -209,28 +1425,113 @@ def enroll_in_course(request):
         email_notifier(
             msg,
             "Tahoe User Enrollment",
-            info["store_admin_name"],
-            info["store_admin_name"]
+            context.store_admin_email,
+            context.store_admin_name,
+            group=context.order_id,
         )
     else:
         msg = "Error occured with enrollment of {email} to {course}".format(
             email=email, course=sku
         )
         logging.error(msg)
-        email_notifier(msg, "Tahoe User Enrollment")
+        email_notifier(msg, "Tahoe User Enrollment", group=context.order_id)
         return False
-    logging.info(response.json())
+    logging.info(result)
     logging.info("End of enrollemnt")
     return Response("User successfully enrolled in the course", status=200)
 
 
+def report_order_failure(context, msg, subject):
+    logging.error(msg)
+    if environment == "prod":
+        stackdriver_client.report_exception()
+    email_notifier(msg, subject, group=context.order_id)
+
+
+def register_site(request, context, tahoe_site_url):
+    """Register the customer in a site, return False if it raised"""
+    try:
+        register_in_tahoe(request, context, tahoe_site_url)
+        return True
+    except Exception as e:
+        report_order_failure(
+            context,
+            "Registration of {} in {} failed: {}".format(
+                context.customer_email, tahoe_site_url, e
+            ),
+            "Tahoe User Registration",
+        )
+        return False
+
+
+def enroll_item(request, context, item):
+    try:
+        return enroll_in_course(request, context, item)
+    except Exception as e:
+        report_order_failure(
+            context,
+            "Enrollment of {} into {} failed: {}".format(
+                context.customer_email, item.course_id, e
+            ),
+            "Tahoe User Enrollment",
+        )
+        return False
+
+
 # 4. Run all the defined functions
+@timed("process_order")
+def process_order(request, context):
+    """
+        Register the customer once in every Tahoe site of the order, then
+        enroll them into all courses of the order concurrently, with at most
+        `order_concurrency` calls in flight. Notifications of the order are
+        sent afterwards in one message.
+        A failing item or site is reported and doesn't stop the rest of the
+        order, so the order isn't retried and nobody is enrolled twice.
+    """
+    items = []
+    for item in context.items:
+        if item.tahoe_site_url:
+            items.append(item)
+        else:
+            report_order_failure(
+                context,
+                "Product {} of {} wasn't found, {} isn't enrolled".format(
+                    item.product_id, item.course_id, context.customer_email
+                ),
+                "Tahoe User Enrollment",
+            )
+    tahoe_sites_urls = list(OrderedDict.fromkeys(
+        item.tahoe_site_url for item in items
+    ))
+    try:
+        with ThreadPoolExecutor(max_workers=order_concurrency) as executor:
+            # 4.1 Run user's registration
+            registered = dict(zip(tahoe_sites_urls, executor.map(
+                lambda tahoe_site_url: register_site(
+                    request, context, tahoe_site_url
+                ),
+                tahoe_sites_urls,
+            )))
+            # 4.2 Run user's enrollment
+            return list(executor.map(
+                lambda item: enroll_item(request, context, item),
+                [item for item in items if registered[item.tahoe_site_url]],
+            ))
+    finally:
+        # 4.3 Send the order's notifications as one message
+        notification_outbox.close(context.order_id)
+
+
 def main(request):
-    if request.get_json()['financial_status'] == "paid":
-        # 4.1 Run user's registration
-        register_in_tahoe(request)
-        # 4.2 Run user's enrollment
-        enroll_in_course(request)
-        return Response("200 OK", status=200)
-    else:
-        return Response("Can't handle unpaid calls", status=200)
+    try:
+        if request.get_json()['financial_status'] == "paid":
+            context = get_order_context(request)
+            process_order(request, context)
+            return Response("200 OK", status=200)
+        else:
+            return Response("Can't handle unpaid calls", status=200)
+    finally:
+        if notification_flush_on_return:
+            notification_outbox.flush(force=False)
+        metrics.export(force=False)
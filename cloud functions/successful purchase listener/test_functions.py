@@ -1,6 +1,11 @@
 import json
+import os
+import signal
+import tempfile
+import time
 import unittest
-from unittest.mock import Mock
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
 from random import randint
 from os import environ
 
@@ -358,5 +363,505 @@ class SuccessfullPurchaseTests(unittest.TestCase):
         )
 
 
+def paid_order(skus=("course-v1:a+1",)):
+    request = Mock()
+    request.get_json.return_value = {
+        "id": 1001,
+        "email": "learner@example.com",
+        "financial_status": "paid",
+        "confirmed": True,
+        "billing_address": {"name": "Learner"},
+        "line_items": [
+            {"product_id": index, "sku": sku} for index, sku in enumerate(skus)
+        ],
+    }
+    return request
+
+
+def tahoe_session(courses_ids=("course-v1:a+1",)):
+    session = Mock()
+    session.get.return_value.json.return_value = {
+        "results": [
+            {"course_id": course_id, "email": "someone@example.com"}
+            for course_id in courses_ids
+        ],
+        "pagination": {"next": None},
+    }
+    session.post.return_value.ok = True
+    session.post.return_value.json.return_value = {}
+    return session
+
+
+class OrderPipelineTests(unittest.TestCase):
+    def setUp(self):
+        functions.environment = "test"
+        functions.tahoe_sites_tokens = "https://site-a.tahoe.com;token,https://site-b.tahoe.com;token"
+        functions.tahoe_courses_api = "/api/courses/v1/courses/"
+        functions.tahoe_registration_api = "/tahoe/api/v1/registrations/"
+        functions.tahoe_enrollment_api = "/tahoe/api/v1/enrollments/"
+        functions.tahoe_users_api = "/tahoe/api/v1/users/"
+        functions.invalidate_store_admin()
+
+    @patch("functions.get_session")
+    @patch("functions.shopify")
+    def test_one_product_lookup_per_order(self, shopify, get_session):
+        shopify.Product.find.return_value = [
+            Mock(id=0, tags="https://site-a.tahoe.com")
+        ]
+        get_session.return_value = tahoe_session()
+        functions.courses_cache.put("https://site-a.tahoe.com", ["course-v1:a+1"])
+        result = functions.main(paid_order())
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(shopify.Product.find.call_count, 1)
+        self.assertEqual(shopify.Shop.current.call_count, 1)
+
+    @patch("functions.get_session")
+    @patch("functions.shopify")
+    def test_every_line_item_is_enrolled(self, shopify, get_session):
+        functions.enrollment_batcher = functions.EnrollmentBatcher(0, 1)
+        functions.users_cache.clear()
+        shopify.Product.find.return_value = [
+            Mock(id=0, tags="https://site-a.tahoe.com"),
+            Mock(id=1, tags="https://site-a.tahoe.com"),
+            Mock(id=2, tags="https://site-b.tahoe.com"),
+        ]
+        skus = ("course-v1:a+1", "course-v1:a+2", "course-v1:b+1")
+        functions.courses_cache.put("https://site-a.tahoe.com", skus)
+        functions.courses_cache.put("https://site-b.tahoe.com", skus)
+        get_session.return_value = tahoe_session(skus)
+        functions.main(paid_order(skus))
+        self.assertEqual(shopify.Product.find.call_count, 1)
+        posted_urls = [
+            call[0][0] for call in get_session.return_value.post.call_args_list
+        ]
+        self.assertEqual(
+            sorted(url for url in posted_urls if "registration" in url),
+            [
+                "https://site-a.tahoe.com/tahoe/api/v1/registrations/",
+                "https://site-b.tahoe.com/tahoe/api/v1/registrations/",
+            ],
+        )
+        self.assertEqual(
+            len([url for url in posted_urls if "enrollment" in url]), 3
+        )
+
+    def posted_urls(self, session):
+        return [call[0][0] for call in session.post.call_args_list]
+
+    @patch("functions.get_session")
+    @patch("functions.shopify")
+    def test_unresolved_item_doesnt_block_the_order(self, shopify, get_session):
+        functions.enrollment_batcher = functions.EnrollmentBatcher(0, 1)
+        functions.users_cache.clear()
+        shopify.Product.find.return_value = [
+            Mock(id=1, tags="https://site-b.tahoe.com")
+        ]
+        skus = ("course-v1:a+1", "course-v1:b+1")
+        functions.courses_cache.put("https://site-b.tahoe.com", skus)
+        get_session.return_value = tahoe_session(skus)
+        with self.assertLogs(level="ERROR") as logs:
+            result = functions.main(paid_order(skus))
+        self.assertEqual(result.status_code, 200)
+        self.assertIn("Product 0 of course-v1:a+1 wasn't found", "".join(logs.output))
+        self.assertEqual(shopify.Product.find.call_args[1]["limit"], 2)
+        self.assertEqual(self.posted_urls(get_session.return_value), [
+            "https://site-b.tahoe.com/tahoe/api/v1/registrations/",
+            "https://site-b.tahoe.com/tahoe/api/v1/enrollments/",
+        ])
+
+    @patch("functions.get_session")
+    @patch("functions.shopify")
+    def test_failing_site_doesnt_block_other_sites(self, shopify, get_session):
+        functions.enrollment_batcher = functions.EnrollmentBatcher(0, 1)
+        functions.users_cache.clear()
+        shopify.Product.find.return_value = [
+            Mock(id=0, tags="https://site-a.tahoe.com"),
+            Mock(id=1, tags="https://site-b.tahoe.com"),
+        ]
+        skus = ("course-v1:a+1", "course-v1:b+1")
+        functions.courses_cache.put("https://site-a.tahoe.com", skus)
+        functions.courses_cache.put("https://site-b.tahoe.com", skus)
+        get_session.return_value = tahoe_session(skus)
+        register_in_tahoe = functions.register_in_tahoe
+
+        def register(request, context, tahoe_site_url):
+            if "site-a" in tahoe_site_url:
+                raise ConnectionError("site-a is down")
+            return register_in_tahoe(request, context, tahoe_site_url)
+
+        with patch("functions.register_in_tahoe", side_effect=register), \
+                self.assertLogs(level="ERROR"):
+            result = functions.main(paid_order(skus))
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(self.posted_urls(get_session.return_value), [
+            "https://site-b.tahoe.com/tahoe/api/v1/registrations/",
+            "https://site-b.tahoe.com/tahoe/api/v1/enrollments/",
+        ])
+
+    def test_order_context_is_immutable(self):
+        context = functions.OrderContext(*range(7))
+        with self.assertRaises(AttributeError):
+            context.course_id = "another course"
+
+
+def users_page(emails, next_url=None):
+    response = Mock()
+    response.json.return_value = {
+        "results": [{"email": email} for email in emails],
+        "next": next_url,
+    }
+    return response
+
+
+class UserLookupTests(unittest.TestCase):
+    def setUp(self):
+        functions.tahoe_users_api = "/tahoe/api/v1/users/"
+        functions.users_cache.clear()
+        self.site = "https://site-a.tahoe.com"
+
+    @patch("functions.get_session")
+    def test_filtered_lookup_is_one_request(self, get_session):
+        get_session.return_value.get.return_value = users_page([])
+        self.assertFalse(
+            functions.user_exists(self.site, "new@example.com", "token")
+        )
+        self.assertEqual(get_session.return_value.get.call_count, 1)
+        self.assertEqual(
+            get_session.return_value.get.call_args[1]["params"],
+            {"email": "new@example.com"},
+        )
+
+    @patch("functions.get_session")
+    def test_unfiltered_scan_stops_at_the_match(self, get_session):
+        get_session.return_value.get.side_effect = [
+            users_page(["a@example.com"], "page-2"),
+            users_page(["Learner@example.com"], "page-3"),
+            users_page(["c@example.com"]),
+        ]
+        self.assertTrue(
+            functions.user_exists(self.site, "learner@example.com", "token")
+        )
+        self.assertEqual(get_session.return_value.get.call_count, 2)
+
+    @patch("functions.get_session")
+    def test_existing_user_is_cached(self, get_session):
+        get_session.return_value.get.return_value = users_page(
+            ["learner@example.com"]
+        )
+        functions.user_exists(self.site, "learner@example.com", "token")
+        functions.user_exists(self.site, "learner@example.com", "token")
+        self.assertEqual(get_session.return_value.get.call_count, 1)
+
+    def test_cache_is_bounded(self):
+        functions.users_cache_size = 2
+        try:
+            for number in range(3):
+                functions.remember_user(
+                    self.site, "{}@example.com".format(number), True
+                )
+            self.assertEqual(len(functions.users_cache), 2)
+            self.assertNotIn((self.site, "0@example.com"), functions.users_cache)
+        finally:
+            functions.users_cache_size = 10000
+
+
+class CourseLookupTests(unittest.TestCase):
+    def setUp(self):
+        functions.tahoe_courses_api = "/api/courses/v1/courses/"
+        functions.courses_cache = functions.CoursesCache(900, 50)
+        self.site = "https://site-a.tahoe.com"
+
+    @patch("functions.get_session")
+    def test_indexed_course_needs_no_request(self, get_session):
+        functions.courses_cache.put(self.site, ["course-v1:a+1"])
+        self.assertTrue(functions.course_exists(self.site, "course-v1:a+1"))
+        get_session.assert_not_called()
+
+    @patch("functions.refresh_site_courses_in_background")
+    @patch("functions.get_session")
+    def test_first_lookup_doesnt_wait_for_the_index(self, get_session, refresh):
+        get_session.return_value.get.return_value = Mock(status_code=200)
+        self.assertTrue(functions.course_exists(self.site, "course-v1:a+1"))
+        get_session.return_value.get.assert_called_once_with(
+            self.site + "/api/courses/v1/courses/course-v1:a+1/",
+            timeout=functions.http_timeout,
+        )
+        refresh.assert_called_once_with(self.site)
+
+    @patch("functions.get_session")
+    def test_index_answers_once_built(self, get_session):
+        get_session.return_value = tahoe_session(["course-v1:a+1"])
+        functions.refresh_site_courses(self.site)
+        self.assertTrue(functions.course_exists(self.site, "course-v1:a+1"))
+        self.assertTrue(functions.course_exists(self.site, "course-v1:a+1"))
+        self.assertEqual(get_session.return_value.get.call_count, 1)
+        self.assertEqual(functions.courses_cache.stats["hits"], 2)
+
+    @patch("functions.get_session")
+    def test_direct_lookup(self, get_session):
+        functions.courses_cache.put(self.site, ["course-v1:a+1"])
+        get_session.return_value.get.return_value = Mock(status_code=404)
+        self.assertFalse(functions.course_exists(self.site, "course-v1:a+2"))
+        get_session.return_value.get.assert_called_once_with(
+            self.site + "/api/courses/v1/courses/course-v1:a+2/",
+            timeout=functions.http_timeout,
+        )
+
+    @patch("functions.refresh_site_courses_in_background")
+    @patch("functions.get_session")
+    def test_index_is_built_without_detail_endpoint(self, get_session, refresh):
+        get_session.return_value = tahoe_session(["course-v1:a+3"])
+        get_session.return_value.get.return_value.status_code = 405
+        self.assertTrue(functions.course_exists(self.site, "course-v1:a+3"))
+        self.assertEqual(
+            functions.courses_cache.get(self.site), {"course-v1:a+3"}
+        )
+
+    @patch("functions.refresh_site_courses_in_background")
+    @patch("functions.get_session")
+    def test_failed_refresh_raises(self, get_session, refresh):
+        functions.courses_cache.put(self.site, ["course-v1:a+1"], 1)
+        get_session.return_value.get.side_effect = [
+            Mock(status_code=405), Mock(ok=False)
+        ]
+        with self.assertRaises(RuntimeError), self.assertLogs(level="ERROR"):
+            functions.course_exists(self.site, "course-v1:a+2")
+        self.assertEqual(functions.courses_refreshes, {})
+
+    @patch("functions.refresh_site_courses_in_background")
+    @patch("functions.get_session")
+    def test_stale_index_refreshes_in_background(self, get_session, refresh):
+        functions.courses_cache.put(self.site, ["course-v1:a+1"], 1)
+        self.assertTrue(functions.course_exists(self.site, "course-v1:a+1"))
+        refresh.assert_called_once_with(self.site)
+        get_session.assert_not_called()
+
+
+def enrollment_response(data, **kwargs):
+    time.sleep(0.05)
+    response = Mock(ok=True)
+    response.json.return_value = {
+        "courses": {
+            data["courses"][0]: {
+                "results": [
+                    {"identifier": email, "error": email.startswith("bad")}
+                    for email in data["identifiers"]
+                ]
+            }
+        }
+    }
+    return response
+
+
+class EnrollmentBatcherTests(unittest.TestCase):
+    def setUp(self):
+        functions.tahoe_sites_tokens = "https://site-a.tahoe.com;token"
+        self.site = "https://site-a.tahoe.com"
+
+    def enroll(self, batcher, emails):
+        with patch("functions.get_session") as get_session:
+            post = get_session.return_value.post
+            post.side_effect = lambda url, data, **kwargs: enrollment_response(data)
+            with ThreadPoolExecutor(max_workers=len(emails)) as executor:
+                futures = list(executor.map(
+                    lambda email: batcher.submit(self.site, "course-v1:a+1", email),
+                    emails,
+                ))
+                results = [future.result(timeout=5) for future in futures]
+            return post.call_count, results
+
+    def test_results_are_fanned_out(self):
+        batcher = functions.EnrollmentBatcher(0.1, 50)
+        calls, results = self.enroll(batcher, ["a@example.com", "bad@example.com"])
+        self.assertEqual(calls, 1)
+        self.assertTrue(results[0][0])
+        self.assertFalse(results[1][0])
+
+    def test_full_batch_is_sent_before_window(self):
+        batcher = functions.EnrollmentBatcher(60, 2)
+        calls, results = self.enroll(batcher, ["a@example.com", "b@example.com"])
+        self.assertEqual(calls, 1)
+
+    def test_default_batcher_doesnt_wait(self):
+        self.assertEqual(functions.enrollment_batch_window, 0)
+        batcher = functions.EnrollmentBatcher(
+            functions.enrollment_batch_window, functions.enrollment_batch_size
+        )
+        started = time.monotonic()
+        calls, results = self.enroll(batcher, ["a@example.com"])
+        self.assertLess(time.monotonic() - started, 0.1)
+        self.assertEqual(batcher.stats, {"enrollments": 1, "calls": 1})
+
+    def test_enrollment_benchmark(self):
+        emails = ["learner{}@example.com".format(number) for number in range(200)]
+        for window, max_size in ((0, 1), (0.05, 50), (0.2, 200)):
+            batcher = functions.EnrollmentBatcher(window, max_size)
+            started = time.monotonic()
+            calls, results = self.enroll(batcher, emails)
+            elapsed = time.monotonic() - started
+            print("window {}s, batch {}: {} calls, {:.0f} enrollments/s".format(
+                window, max_size, calls, len(emails) / elapsed
+            ))
+            self.assertTrue(all(enrolled for enrolled, _ in results))
+            if window:
+                self.assertLessEqual(calls, len(emails) // max_size + 2)
+
+
+class HttpSessionTests(unittest.TestCase):
+    def test_session_is_reused(self):
+        functions.http_session = None
+        session = functions.get_session()
+        self.assertIs(functions.get_session(), session)
+        adapter = session.get_adapter("https://site-a.tahoe.com")
+        self.assertEqual(adapter._pool_maxsize, functions.http_pool_size)
+        self.assertEqual(adapter.max_retries.total, functions.http_retries)
+
+
+class SiteTokenRegistryTests(unittest.TestCase):
+    def setUp(self):
+        functions.tahoe_sites_tokens = "https://site-a.tahoe.com;token-a"
+        functions.tahoe_sites_tokens_file = ""
+
+    def test_lookup_is_normalized(self):
+        self.assertEqual(functions.give_me_token("https://site-a.tahoe.com/"), "token-a")
+        self.assertEqual(functions.give_me_token("Site-A.tahoe.com"), "token-a")
+        self.assertEqual(functions.give_me_token("https://site-b.tahoe.com"), "")
+
+    def test_tokens_are_parsed_once(self):
+        registry = functions.get_site_tokens()
+        self.assertIs(functions.get_site_tokens(), registry)
+        with self.assertRaises(TypeError):
+            registry.sites["https://site-b.tahoe.com"] = "token-b"
+
+    def test_malformed_entry_fails_early(self):
+        with self.assertRaises(ValueError):
+            functions.SiteTokenRegistry("https://site-a.tahoe.com")
+        with self.assertRaises(ValueError):
+            functions.SiteTokenRegistry("https://site-a.tahoe.com;")
+
+    def test_secrets_file_is_reloaded(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as secrets:
+            secrets.write("https://site-b.tahoe.com;token-b\n")
+            secrets.flush()
+            registry = functions.SiteTokenRegistry("", secrets.name, 0)
+            self.assertEqual(registry.get("https://site-b.tahoe.com"), "token-b")
+            with open(secrets.name, "w") as update:
+                update.write("https://site-b.tahoe.com;token-c\n")
+            os.utime(secrets.name, (time.time() + 5, time.time() + 5))
+            self.assertEqual(registry.get("https://site-b.tahoe.com"), "token-c")
+            with open(secrets.name, "w") as update:
+                update.write("https://site-b.tahoe.com\n")
+            os.utime(secrets.name, (time.time() + 10, time.time() + 10))
+            self.assertEqual(registry.get("https://site-b.tahoe.com"), "token-c")
+
+
+class NotificationOutboxTests(unittest.TestCase):
+    def setUp(self):
+        self.transport = functions.MemoryTransport()
+        self.outbox = functions.NotificationOutbox(
+            self.transport, 60, 60, background=False
+        )
+
+    def test_order_notifications_are_coalesced(self):
+        self.outbox.notify("a enrolled", "Tahoe User Enrollment", "admin@shop.com", "Admin", group=1)
+        self.outbox.notify("b enrolled", "Tahoe User Enrollment", "admin@shop.com", "Admin", group=1)
+        self.outbox.notify("c failed", "Tahoe User Registration", group=1)
+        self.assertEqual(self.outbox.flush(force=False), 0)
+        self.outbox.close(1)
+        self.assertEqual(self.outbox.flush(force=False), 2)
+        admin_message = self.transport.sent[0]
+        self.assertEqual(admin_message["text"], "a enrolled\n\nb enrolled")
+        self.assertEqual(
+            [recipient["email"] for recipient in admin_message["to"]],
+            ["amir@appsembler.com", "admin@shop.com"],
+        )
+
+    def test_digest(self):
+        for number in range(3):
+            self.outbox.notify(
+                "user{} registered".format(number), "Tahoe User Registration",
+                digest=True,
+            )
+        self.assertEqual(self.outbox.flush(force=False), 0)
+        self.outbox.digest_interval = 0
+        self.assertEqual(self.outbox.flush(force=False), 1)
+        self.assertEqual(
+            self.transport.sent[0]["subject"],
+            "Tahoe User Registration digest (3 events)",
+        )
+
+    def test_notify_doesnt_wait_for_transport(self):
+        self.transport.send = lambda message: time.sleep(0.5)
+        self.outbox.background = True
+        started = time.monotonic()
+        for number in range(5):
+            self.outbox.notify("failed", "Tahoe User Enrollment", group=number)
+            self.outbox.close(number)
+        self.assertLess(time.monotonic() - started, 0.1)
+
+    @patch("functions.get_session")
+    @patch("functions.shopify")
+    def test_one_message_per_order(self, shopify, get_session):
+        functions.notification_outbox = self.outbox
+        functions.enrollment_batcher = functions.EnrollmentBatcher(0, 1)
+        functions.tahoe_sites_tokens = "https://site-a.tahoe.com;token"
+        functions.users_cache.clear()
+        shopify.Shop.current.return_value = Mock(shop_owner="Admin", email="admin@shop.com")
+        functions.invalidate_store_admin()
+        shopify.Product.find.return_value = [
+            Mock(id=0, tags="https://site-a.tahoe.com"),
+            Mock(id=1, tags="https://site-a.tahoe.com"),
+        ]
+        skus = ("course-v1:a+1", "course-v1:a+2")
+        functions.courses_cache.put("https://site-a.tahoe.com", skus)
+        get_session.return_value = tahoe_session(skus)
+        functions.main(paid_order(skus))
+        # the function sent the order's message before answering
+        self.assertEqual(len(self.transport.sent), 1)
+        self.assertEqual(self.transport.sent[0]["text"].count("enrolled"), 2)
+
+    def test_sigterm_flushes_notifications(self):
+        functions.notification_outbox = self.outbox
+        self.outbox.notify("user registered", "Tahoe User Registration", digest=True)
+        previous = Mock()
+        with patch("functions.previous_sigterm_handler", previous):
+            functions.flush_notifications_on_sigterm(signal.SIGTERM, None)
+        self.assertEqual(len(self.transport.sent), 1)
+        previous.assert_called_once_with(signal.SIGTERM, None)
+
+
+class MetricsTests(unittest.TestCase):
+    @patch("functions.get_session")
+    @patch("functions.shopify")
+    def test_order_stages_are_traced(self, shopify, get_session):
+        default_metrics = functions.metrics
+        sink = Mock()
+        metrics = functions.metrics = functions.Metrics(sink)
+        functions.enrollment_batcher = functions.EnrollmentBatcher(0, 1)
+        functions.tahoe_sites_tokens = "https://site-a.tahoe.com;token"
+        functions.users_cache.clear()
+        functions.invalidate_store_admin()
+        shopify.Product.find.return_value = [
+            Mock(id=0, tags="https://site-a.tahoe.com")
+        ]
+        functions.courses_cache.put("https://site-a.tahoe.com", ["course-v1:a+1"])
+        get_session.return_value = tahoe_session(["course-v1:a+1"])
+        try:
+            functions.main(paid_order(["course-v1:a+1"]))
+        finally:
+            functions.metrics = default_metrics
+        spans = {call[0][0] for call in sink.span.call_args_list}
+        self.assertTrue({
+            "shopify_call", "order_context", "user_lookup", "register",
+            "course_exists", "enrollment_request", "enroll", "process_order",
+        } <= spans)
+        registrations = [
+            histogram for histogram in metrics.snapshot()["histograms"]
+            if histogram["name"] == "register"
+        ]
+        self.assertEqual(registrations[0]["count"], 1)
+        self.assertEqual(sink.export.call_count, 0)
+
+
 if __name__ == "__main__":
     unittest.main()